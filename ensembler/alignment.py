@@ -0,0 +1,584 @@
+import os
+import hashlib
+import sqlite3
+from collections import namedtuple
+import numpy as np
+import Bio.SubsMat.MatrixInfo
+
+# Precision used by Bio.pairwise2 when comparing floating point scores in the traceback
+_PRECISION = 1000
+
+# Bit flags used in the traceback matrices (same encoding as Bio.pairwise2)
+_ROW_OPEN = 1      # open gap in seqA
+_NOGAP = 2         # match/mismatch of seqA with seqB
+_COL_OPEN = 4      # open gap in seqB
+_ROW_EXTEND = 8    # extend gap in seqA
+_COL_EXTEND = 16   # extend gap in seqB
+
+default_template_block_size = 32
+
+AlignmentCacheEntry = namedtuple(
+    'AlignmentCacheEntry',
+    ['key', 'aligned_target', 'aligned_template', 'score', 'seq_identity', 'seq_identity_upper_bound']
+)
+
+
+class SubstitutionMatrix(object):
+    """Dense integer-indexed version of a Biopython substitution matrix dict, e.g.
+    Bio.SubsMat.MatrixInfo.gonnet.
+
+    Parameters
+    ----------
+    score_dict : dict
+        {(residue1, residue2): score}. Assumed to be symmetric, and may contain only one half of
+        the matrix (as is the case for the Bio.SubsMat.MatrixInfo matrices).
+
+    Attributes
+    ----------
+    alphabet : str
+    scores : np.ndarray
+        shape (len(alphabet), len(alphabet))
+    """
+    def __init__(self, score_dict):
+        self.alphabet = ''.join(sorted(set([res for pair in score_dict for res in pair])))
+        self._index = dict((res, i) for i, res in enumerate(self.alphabet))
+        nres = len(self.alphabet)
+        self.scores = np.zeros((nres, nres), dtype=np.float64)
+        for (res1, res2), score in score_dict.items():
+            self.scores[self._index[res1], self._index[res2]] = score
+            self.scores[self._index[res2], self._index[res1]] = score
+
+    def encode(self, seq):
+        """
+        Parameters
+        ----------
+        seq : str
+
+        Returns
+        -------
+        np.ndarray of int
+
+        Raises KeyError for residues not in the matrix alphabet, as Bio.pairwise2 does.
+        """
+        return np.array([self._index[res] for res in seq], dtype=np.intp)
+
+
+_substitution_matrices = {}
+
+
+def get_substitution_matrix(name='gonnet'):
+    """Return (and cache) a SubstitutionMatrix for a matrix name in Bio.SubsMat.MatrixInfo."""
+    if name not in _substitution_matrices:
+        _substitution_matrices[name] = SubstitutionMatrix(getattr(Bio.SubsMat.MatrixInfo, name))
+    return _substitution_matrices[name]
+
+
+def calc_affine_penalty(length, gap_open, gap_extend):
+    """Same arithmetic as Bio.pairwise2.calc_affine_penalty (with penalize_extend_when_opening=0),
+    so that scores are identical to the last bit."""
+    if length <= 0:
+        return 0
+    penalty = gap_open + gap_extend * length
+    penalty -= gap_extend
+    return penalty
+
+
+def _rint(x):
+    return np.trunc(x * _PRECISION + 0.5)
+
+
+def _pyrint(x):
+    return int(x * _PRECISION + 0.5)
+
+
+def align_target_templates(target_seq, template_seqs, matrix='gonnet', gap_open=-10, gap_extend=-0.5,
+                           block_size=default_template_block_size):
+    """Global alignment (affine gaps, end gaps penalized) of one target sequence against many
+    template sequences.
+
+    Gives the same result as aln = Bio.pairwise2.align.globalds(target_seq, template_seq, matrix,
+    gap_open, gap_extend)[0] for each template, but fills the dynamic programming matrices for a
+    whole block of templates at once, one anti-diagonal at a time, using NumPy.
+
+    Parameters
+    ----------
+    target_seq : str
+    template_seqs : list of str
+    matrix : str
+        Name of a substitution matrix in Bio.SubsMat.MatrixInfo
+    gap_open : float
+    gap_extend : float
+    block_size : int
+        Number of templates aligned together. Memory use per block is roughly
+        9 * block_size * len(target_seq) * max(len(template_seq)) bytes.
+
+    Returns
+    -------
+    alns : list
+        One entry per template, in the same order as template_seqs. Each entry uses the
+        Bio.pairwise2 return format, i.e. [(aligned_target, aligned_template, score, begin, end)].
+    """
+    target_seq = str(target_seq)
+    template_seqs = [str(seq) for seq in template_seqs]
+    substitution_matrix = get_substitution_matrix(matrix)
+    alns = [[] for seq in template_seqs]
+    if len(target_seq) == 0:
+        return alns
+
+    target_codes = substitution_matrix.encode(target_seq)
+
+    # Blocks of similar-length templates minimize padding
+    nonempty_indices = [i for i, seq in enumerate(template_seqs) if len(seq) > 0]
+    sorted_indices = sorted(nonempty_indices, key=lambda i: len(template_seqs[i]))
+    for block_start in range(0, len(sorted_indices), block_size):
+        block_indices = sorted_indices[block_start: block_start + block_size]
+        block_seqs = [template_seqs[i] for i in block_indices]
+        score_matrices, trace_matrices = _make_score_matrices_block(
+            target_codes, [substitution_matrix.encode(seq) for seq in block_seqs],
+            substitution_matrix.scores, gap_open, gap_extend
+        )
+        for b, template_index in enumerate(block_indices):
+            template_seq = block_seqs[b]
+            score_matrix = score_matrices[b, :, :len(template_seq) + 1]
+            trace_matrix = trace_matrices[b, :, :len(template_seq) + 1]
+            alns[template_index] = _recover_alignment(
+                target_seq, template_seq, score_matrix, trace_matrix, gap_open, gap_extend
+            )
+    return alns
+
+
+def calculate_seq_identity_upper_bounds(target_seq, template_seqs, matrix='gonnet', gap_open=-10,
+                                        gap_extend=-0.5, block_size=default_template_block_size):
+    """Score-only pass over the same alignment problem as align_target_templates, without keeping
+    traceback matrices (memory per template is proportional to len(target) + len(template)).
+
+    Alongside each score, the maximum number of identical aligned residues over all optimal
+    alignments is tracked. The alignment eventually selected by the traceback is one of these, so
+    the returned sequence identities are upper bounds on the values given by
+    ensembler.modeling.calculate_seq_identity, and are exact when the optimal alignment is unique.
+
+    Parameters
+    ----------
+    target_seq : str
+    template_seqs : list of str
+    matrix : str
+    gap_open : float
+    gap_extend : float
+    block_size : int
+
+    Returns
+    -------
+    scores : np.ndarray of float
+    seq_identity_upper_bounds : np.ndarray of float
+        percentages, calculated relative to the length of the shorter sequence
+    """
+    target_seq = str(target_seq)
+    template_seqs = [str(seq) for seq in template_seqs]
+    substitution_matrix = get_substitution_matrix(matrix)
+    scores = np.zeros(len(template_seqs), dtype=np.float64)
+    seq_identities = np.zeros(len(template_seqs), dtype=np.float64)
+    if len(target_seq) == 0:
+        return scores, seq_identities
+
+    target_codes = substitution_matrix.encode(target_seq)
+    nonempty_indices = [i for i, seq in enumerate(template_seqs) if len(seq) > 0]
+    sorted_indices = sorted(nonempty_indices, key=lambda i: len(template_seqs[i]))
+    for block_start in range(0, len(sorted_indices), block_size):
+        block_indices = sorted_indices[block_start: block_start + block_size]
+        block_seqs = [template_seqs[i] for i in block_indices]
+        block_scores, block_nidentities = _score_block(
+            target_codes, [substitution_matrix.encode(seq) for seq in block_seqs],
+            substitution_matrix.scores, gap_open, gap_extend
+        )
+        for b, template_index in enumerate(block_indices):
+            scores[template_index] = block_scores[b]
+            len_shorter_seq = min(len(target_seq), len(block_seqs[b]))
+            seq_identities[template_index] = 100 * float(block_nidentities[b]) / float(len_shorter_seq)
+    return scores, seq_identities
+
+
+def _score_block(target_codes, template_codes_list, scores, gap_open, gap_extend):
+    """Linear-memory equivalent of _make_score_matrices_block, which keeps only the last two
+    anti-diagonals, plus the maximum number of identities over the optimal paths to each cell.
+
+    Diagonal arrays are indexed by row. Returns the final score and identity count per template.
+    """
+    ntemplates = len(template_codes_list)
+    len_a = len(target_codes)
+    template_lens = np.array([len(codes) for codes in template_codes_list])
+    len_b = template_lens.max()
+    template_codes = np.zeros((ntemplates, len_b), dtype=np.intp)
+    for b, codes in enumerate(template_codes_list):
+        template_codes[b, :len(codes)] = codes
+
+    first_gap = calc_affine_penalty(1, gap_open, gap_extend)
+    final_scores = np.zeros(ntemplates, dtype=np.float64)
+    final_nidentities = np.zeros(ntemplates, dtype=np.int64)
+
+    # Diagonals d-2 and d-1 of the score matrix, and the matching identity counts
+    score_diag_prev2 = np.zeros((ntemplates, len_a + 1), dtype=np.float64)
+    score_diag_prev = np.zeros((ntemplates, len_a + 1), dtype=np.float64)
+    score_diag_prev[:, 0] = calc_affine_penalty(1, gap_open, gap_extend)
+    score_diag_prev[:, 1] = calc_affine_penalty(1, gap_open, gap_extend)
+    nid_diag_prev2 = np.zeros((ntemplates, len_a + 1), dtype=np.int64)
+    nid_diag_prev = np.zeros((ntemplates, len_a + 1), dtype=np.int64)
+
+    row_scores = np.empty((ntemplates, len_a + 1), dtype=np.float64)
+    row_scores[:] = [calc_affine_penalty(i, 2 * gap_open, gap_extend) for i in range(len_a + 1)]
+    row_nids = np.zeros((ntemplates, len_a + 1), dtype=np.int64)
+    col_scores = np.empty((ntemplates, len_b + 1), dtype=np.float64)
+    col_scores[:] = [0] + [calc_affine_penalty(j, 2 * gap_open, gap_extend) for j in range(1, len_b + 1)]
+    col_nids = np.zeros((ntemplates, len_b + 1), dtype=np.int64)
+
+    for diagonal in range(2, len_a + len_b + 1):
+        rows = np.arange(max(1, diagonal - len_b), min(len_a, diagonal - 1) + 1)
+        cols = diagonal - rows
+
+        target_res = target_codes[rows - 1][np.newaxis, :]
+        template_res = template_codes[:, cols - 1]
+        nogap_score = score_diag_prev2[:, rows - 1] + scores[target_res, template_res]
+        nogap_nid = nid_diag_prev2[:, rows - 1] + (target_res == template_res)
+
+        row_open = score_diag_prev[:, rows] + first_gap
+        row_extend = row_scores[:, rows] + gap_extend
+        row_score = np.maximum(row_open, row_extend)
+        row_score_rint = _rint(row_score)
+        row_nid = np.maximum(
+            np.where(_rint(row_open) == row_score_rint, nid_diag_prev[:, rows], 0),
+            np.where(_rint(row_extend) == row_score_rint, row_nids[:, rows], 0)
+        )
+
+        col_open = score_diag_prev[:, rows - 1] + first_gap
+        col_extend = col_scores[:, cols] + gap_extend
+        col_score = np.maximum(col_open, col_extend)
+        col_score_rint = _rint(col_score)
+        col_nid = np.maximum(
+            np.where(_rint(col_open) == col_score_rint, nid_diag_prev[:, rows - 1], 0),
+            np.where(_rint(col_extend) == col_score_rint, col_nids[:, cols], 0)
+        )
+
+        best_score = np.maximum(np.maximum(nogap_score, col_score), row_score)
+        best_score_rint = _rint(best_score)
+        best_nid = np.maximum(np.maximum(
+            np.where(_rint(nogap_score) == best_score_rint, nogap_nid, 0),
+            np.where(row_score_rint == best_score_rint, row_nid, 0)),
+            np.where(col_score_rint == best_score_rint, col_nid, 0)
+        )
+
+        row_scores[:, rows] = row_score
+        row_nids[:, rows] = row_nid
+        col_scores[:, cols] = col_score
+        col_nids[:, cols] = col_nid
+
+        score_diag = np.zeros((ntemplates, len_a + 1), dtype=np.float64)
+        nid_diag = np.zeros((ntemplates, len_a + 1), dtype=np.int64)
+        score_diag[:, rows] = best_score
+        nid_diag[:, rows] = best_nid
+        # First row and column cells lying on this diagonal
+        if diagonal <= len_a:
+            score_diag[:, diagonal] = calc_affine_penalty(diagonal, gap_open, gap_extend)
+        if diagonal <= len_b:
+            score_diag[:, 0] = calc_affine_penalty(diagonal, gap_open, gap_extend)
+
+        if diagonal - len_a >= 1:
+            finished = template_lens == diagonal - len_a
+            final_scores[finished] = score_diag[finished, len_a]
+            final_nidentities[finished] = nid_diag[finished, len_a]
+
+        score_diag_prev2, score_diag_prev = score_diag_prev, score_diag
+        nid_diag_prev2, nid_diag_prev = nid_diag_prev, nid_diag
+
+    return final_scores, final_nidentities
+
+
+def _make_score_matrices_block(target_codes, template_codes_list, scores, gap_open, gap_extend):
+    """Gotoh score and traceback matrices for a target against a block of templates.
+
+    Each anti-diagonal depends only on the previous two, so all cells of a diagonal, for all
+    templates in the block, are computed with a single set of array operations. Padding cells
+    beyond the end of shorter templates are never read when computing the cells of those templates.
+
+    Returns
+    -------
+    score_matrices : np.ndarray of float64, shape (ntemplates, len(target) + 1, max_template_len + 1)
+    trace_matrices : np.ndarray of uint8, same shape
+    """
+    ntemplates = len(template_codes_list)
+    len_a = len(target_codes)
+    len_b = max([len(codes) for codes in template_codes_list])
+    template_codes = np.zeros((ntemplates, len_b), dtype=np.intp)
+    for b, codes in enumerate(template_codes_list):
+        template_codes[b, :len(codes)] = codes
+
+    first_gap = calc_affine_penalty(1, gap_open, gap_extend)
+
+    score_matrices = np.empty((ntemplates, len_a + 1, len_b + 1), dtype=np.float64)
+    trace_matrices = np.zeros((ntemplates, len_a + 1, len_b + 1), dtype=np.uint8)
+    score_matrices[:, :, 0] = [calc_affine_penalty(i, gap_open, gap_extend) for i in range(len_a + 1)]
+    score_matrices[:, 0, :] = [calc_affine_penalty(j, gap_open, gap_extend) for j in range(len_b + 1)]
+
+    # Running "gap in seqA" score for each row, and "gap in seqB" score for each column
+    row_scores = np.empty((ntemplates, len_a + 1), dtype=np.float64)
+    row_scores[:] = [calc_affine_penalty(i, 2 * gap_open, gap_extend) for i in range(len_a + 1)]
+    col_scores = np.empty((ntemplates, len_b + 1), dtype=np.float64)
+    col_scores[:] = [0] + [calc_affine_penalty(j, 2 * gap_open, gap_extend) for j in range(1, len_b + 1)]
+
+    for diagonal in range(2, len_a + len_b + 1):
+        rows = np.arange(max(1, diagonal - len_b), min(len_a, diagonal - 1) + 1)
+        cols = diagonal - rows
+
+        match_scores = scores[target_codes[rows - 1][np.newaxis, :], template_codes[:, cols - 1]]
+        nogap_score = score_matrices[:, rows - 1, cols - 1] + match_scores
+
+        row_open = score_matrices[:, rows, cols - 1] + first_gap
+        row_extend = row_scores[:, rows] + gap_extend
+        row_score = np.maximum(row_open, row_extend)
+
+        col_open = score_matrices[:, rows - 1, cols] + first_gap
+        col_extend = col_scores[:, cols] + gap_extend
+        col_score = np.maximum(col_open, col_extend)
+
+        best_score = np.maximum(np.maximum(nogap_score, col_score), row_score)
+        score_matrices[:, rows, cols] = best_score
+        row_scores[:, rows] = row_score
+        col_scores[:, cols] = col_score
+
+        row_score_rint = _rint(row_score)
+        col_score_rint = _rint(col_score)
+        best_score_rint = _rint(best_score)
+        row_trace = (_ROW_OPEN * (_rint(row_open) == row_score_rint) +
+                     _ROW_EXTEND * (_rint(row_extend) == row_score_rint))
+        col_trace = (_COL_OPEN * (_rint(col_open) == col_score_rint) +
+                     _COL_EXTEND * (_rint(col_extend) == col_score_rint))
+        trace = (_NOGAP * (_rint(nogap_score) == best_score_rint) +
+                 row_trace * (row_score_rint == best_score_rint) +
+                 col_trace * (col_score_rint == best_score_rint))
+        trace_matrices[:, rows, cols] = trace
+
+    return score_matrices, trace_matrices
+
+
+def _recover_alignment(seq_a, seq_b, score_matrix, trace_matrix, gap_open, gap_extend):
+    """Backtrace to the first optimal alignment, in the order in which Bio.pairwise2 would return
+    it. Falls back to backtracing the transposed matrices if no path is found, as pairwise2 does.
+    """
+    best_score = score_matrix[-1, -1]
+    aln = _backtrace(seq_a, seq_b, score_matrix.tolist(), trace_matrix.tolist(), gap_open, gap_extend)
+    if aln is None:
+        reverse_trace_matrix = ((trace_matrix & _NOGAP) |
+                                ((trace_matrix & _ROW_OPEN) << 2) | ((trace_matrix & _COL_OPEN) >> 2) |
+                                ((trace_matrix & _ROW_EXTEND) << 1) | ((trace_matrix & _COL_EXTEND) >> 1))
+        aln = _backtrace(seq_b, seq_a, score_matrix.T.tolist(), reverse_trace_matrix.T.tolist(), gap_open, gap_extend)
+        if aln is None:
+            return []
+        aln = (aln[1], aln[0])
+    return [(aln[0], aln[1], float(best_score), 0, len(aln[0]))]
+
+
+def _backtrace(seq_a, seq_b, score_matrix, trace_matrix, gap_open, gap_extend):
+    """Port of the global-alignment path through Bio.pairwise2._recover_alignments, stopping at the
+    first complete traceback.
+
+    Returns
+    -------
+    (aligned_seq_a, aligned_seq_b) or None
+    """
+    len_a, len_b = len(seq_a), len(seq_b)
+    in_process = [('', '', len_a, len_b, False, trace_matrix[len_a][len_b])]
+    while in_process:
+        dead_end = False
+        ali_a, ali_b, row, col, col_gap, trace = in_process.pop()
+
+        while (row > 0 or col > 0) and not dead_end:
+            cache = (ali_a, ali_b, row, col, col_gap)
+
+            if not trace:
+                if col and col_gap:
+                    dead_end = True
+                else:
+                    if row:
+                        ali_a += seq_a[row - 1::-1]
+                    if col:
+                        ali_b += seq_b[col - 1::-1]
+                    if row > col:
+                        ali_b += '-' * (len(ali_a) - len(ali_b))
+                    elif col > row:
+                        ali_a += '-' * (len(ali_b) - len(ali_a))
+                break
+            elif trace % 2 == 1:
+                trace -= _ROW_OPEN
+                if col_gap:
+                    dead_end = True
+                else:
+                    col -= 1
+                    ali_a += '-'
+                    ali_b += seq_b[col]
+                    col_gap = False
+            elif trace % 4 == 2:
+                trace -= _NOGAP
+                row -= 1
+                col -= 1
+                ali_a += seq_a[row]
+                ali_b += seq_b[col]
+                col_gap = False
+            elif trace % 8 == 4:
+                trace -= _COL_OPEN
+                row -= 1
+                ali_a += seq_a[row]
+                ali_b += '-'
+                col_gap = True
+            elif trace in (8, 24):
+                trace -= _ROW_EXTEND
+                if col_gap:
+                    dead_end = True
+                else:
+                    col_gap = False
+                    ali_a, ali_b, row, col, dead_end = _find_gap_open(
+                        seq_a, seq_b, ali_a, ali_b, row, col, col_gap, score_matrix, trace_matrix,
+                        in_process, gap_open, gap_extend, 'col'
+                    )
+            elif trace == 16:
+                trace -= _COL_EXTEND
+                col_gap = True
+                ali_a, ali_b, row, col, dead_end = _find_gap_open(
+                    seq_a, seq_b, ali_a, ali_b, row, col, col_gap, score_matrix, trace_matrix,
+                    in_process, gap_open, gap_extend, 'row'
+                )
+
+            if trace:
+                in_process.append(cache + (trace,))
+            trace = trace_matrix[row][col]
+
+        if not dead_end:
+            return ali_a[::-1], ali_b[::-1]
+
+    return None
+
+
+def _find_gap_open(seq_a, seq_b, ali_a, ali_b, row, col, col_gap, score_matrix, trace_matrix,
+                   in_process, gap_open, gap_extend, direction):
+    """Find the starting point(s) of an extended gap, as in Bio.pairwise2._find_gap_open."""
+    dead_end = False
+    target_score = score_matrix[row][col]
+    nsteps = col if direction == 'col' else row
+    for n in range(nsteps):
+        if direction == 'col':
+            col -= 1
+            ali_a += '-'
+            ali_b += seq_b[col]
+        else:
+            row -= 1
+            ali_a += seq_a[row]
+            ali_b += '-'
+        actual_score = score_matrix[row][col] + calc_affine_penalty(n + 1, gap_open, gap_extend)
+        if _pyrint(actual_score) == _pyrint(target_score) and n > 0:
+            if not trace_matrix[row][col]:
+                break
+            else:
+                in_process.append((ali_a, ali_b, row, col, col_gap, trace_matrix[row][col]))
+        if not trace_matrix[row][col]:
+            dead_end = True
+    return ali_a, ali_b, row, col, dead_end
+
+
+class AlignmentCache(object):
+    """Persistent store of pairwise alignments, held in a single SQLite file.
+
+    Entries are keyed on a hash of the target sequence, template sequence, substitution matrix name
+    and gap penalties, so that an entry is reused regardless of target or template IDs, and is
+    never reused if any of the alignment inputs change.
+
+    Entries may hold a full alignment (plus score and sequence identity), or only the sequence
+    identity upper bound from calculate_seq_identity_upper_bounds, for templates which were
+    rejected by a sequence identity cutoff.
+
+    Parameters
+    ----------
+    filepath : str
+    matrix : str
+    gap_open : float
+    gap_extend : float
+
+    Examples
+    --------
+    >>> cache = AlignmentCache('models/alignment-cache.sqlite')
+    >>> entries = cache.get_many(target_seq, template_seqs)
+    """
+    def __init__(self, filepath, matrix='gonnet', gap_open=-10, gap_extend=-0.5):
+        self.filepath = filepath
+        self.matrix = matrix
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        self._connection = None
+
+    def key(self, target_seq, template_seq):
+        key_str = '\n'.join([
+            str(target_seq), str(template_seq), self.matrix, repr(float(self.gap_open)), repr(float(self.gap_extend))
+        ])
+        return hashlib.sha1(key_str.encode('ascii')).hexdigest()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, timeout=600)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS alignments ('
+                'key TEXT PRIMARY KEY, aligned_target TEXT, aligned_template TEXT, score REAL, '
+                'seq_identity REAL, seq_identity_upper_bound REAL)'
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get_many(self, target_seq, template_seqs):
+        """
+        Parameters
+        ----------
+        target_seq : str
+        template_seqs : list of str
+
+        Returns
+        -------
+        entries : list of AlignmentCacheEntry or None
+            None for pairs not found in the cache.
+        """
+        keys = [self.key(target_seq, template_seq) for template_seq in template_seqs]
+        if not os.path.exists(self.filepath):
+            return [None] * len(keys)
+        connection = self._connect()
+        found = {}
+        chunk_size = 500   # SQLite limits the number of bound parameters per statement
+        for chunk_start in range(0, len(keys), chunk_size):
+            chunk = keys[chunk_start: chunk_start + chunk_size]
+            rows = connection.execute(
+                'SELECT key, aligned_target, aligned_template, score, seq_identity, seq_identity_upper_bound '
+                'FROM alignments WHERE key IN (%s)' % ','.join(['?'] * len(chunk)),
+                chunk
+            )
+            for row in rows:
+                key, aligned_target, aligned_template = [str(x) if x is not None else None for x in row[:3]]
+                found[key] = AlignmentCacheEntry(key, aligned_target, aligned_template, row[3], row[4], row[5])
+        return [found.get(key) for key in keys]
+
+    def add_many(self, entries):
+        """
+        Parameters
+        ----------
+        entries : list of AlignmentCacheEntry
+        """
+        if len(entries) == 0:
+            return
+        connection = self._connect()
+        connection.executemany(
+            'INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?)',
+            [tuple(entry) for entry in entries]
+        )
+        connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def aln_from_cache_entry(entry):
+    """Convert an AlignmentCacheEntry holding a full alignment to the Bio.pairwise2 return format."""
+    return [(entry.aligned_target, entry.aligned_template, entry.score, 0, len(entry.aligned_target))]
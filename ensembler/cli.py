@@ -1,3 +1,4 @@
+import multiprocessing
 from docopt import docopt
 import ensembler.cli_commands
 
@@ -37,7 +38,14 @@ def main():
                 if not args['init'] and not args['testrun_pipeline'] and not args['quickmodel']:
                     ensembler.core.check_project_toplevel_dir()
                 command = getattr(ensembler.cli_commands, command_str)
-                command.dispatch(args)
+                if args['--executor'] == 'local':
+                    nworkers = int(args['--nworkers']) if args['--nworkers'] else multiprocessing.cpu_count()
+                    with ensembler.core.mpistate.local_executor(nworkers):
+                        command.dispatch(args)
+                elif args['--executor'] in (None, 'mpi'):
+                    command.dispatch(args)
+                else:
+                    raise Exception('Unrecognized executor: %s' % args['--executor'])
             command_dispatched = True
 
     if not command_dispatched and args['--help']:
@@ -11,6 +11,7 @@ command_list = [
     'solvate',
     'refine_explicit',
     'package_models',
+    'import_models',
     'quickmodel',
 ]
 
@@ -27,4 +28,5 @@ import refine_implicit
 import solvate
 import refine_explicit
 import package_models
+import import_models
 import quickmodel
\ No newline at end of file
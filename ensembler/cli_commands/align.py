@@ -31,6 +31,11 @@ helpstring_nonunique_options = [
   --templates <template>       Define one or more template IDs to work on (comma-separated), e.g.
                                "--templates ABL1_HUMAN_D0_1OPL_A" (default: all templates)""",
 
+    """\
+  --template_seqid_cutoff <cutoff>  Only write alignments for templates with sequence identity
+                                    (percentage) greater than the given cutoff. A fast score-only
+                                    pass is used to skip full alignment of most other templates.""",
+
     """\
   -v --verbose                 """,
 ]
@@ -58,4 +63,14 @@ def dispatch(args):
     else:
         templates = False
 
-    ensembler.modeling.align_targets_and_templates(process_only_these_targets=targets, process_only_these_templates=templates, loglevel=loglevel)
\ No newline at end of file
+    if args['--template_seqid_cutoff']:
+        template_seqid_cutoff = float(args['--template_seqid_cutoff'])
+    else:
+        template_seqid_cutoff = False
+
+    ensembler.modeling.align_targets_and_templates(
+        process_only_these_targets=targets,
+        process_only_these_templates=templates,
+        template_seqid_cutoff=template_seqid_cutoff,
+        loglevel=loglevel
+    )
\ No newline at end of file
@@ -18,6 +18,15 @@ helpstring_unique_options = [
     """\
   --template_seqid_cutoff <cutoff>  Select only templates with sequence identity (percentage)
                                     greater than the given cutoff.""",
+
+    """\
+  --nmodeller_workers <n>           Number of Modeller worker processes to run per MPI rank, i.e.
+                                    number of models built concurrently per rank (default: 1)""",
+
+    """\
+  --write_coordinate_store          Also add models to a per-target coordinate store
+                                    (models/[target]/coords-build_models.h5), from which later stages
+                                    and analysis tools can load all models in a single read.""",
 ]
 
 helpstring_nonunique_options = [
@@ -60,6 +69,11 @@ def dispatch(args):
     else:
         template_seqid_cutoff = False
 
+    if args['--nmodeller_workers']:
+        nmodeller_workers = int(args['--nmodeller_workers'])
+    else:
+        nmodeller_workers = 1
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -70,5 +84,7 @@ def dispatch(args):
         process_only_these_templates=templates,
         template_seqid_cutoff=template_seqid_cutoff,
         write_modeller_restraints_file=args['--write_modeller_restraints_file'],
+        nmodeller_workers=nmodeller_workers,
+        write_coordinate_store=args['--write_coordinate_store'],
         loglevel=loglevel
     )
\ No newline at end of file
@@ -7,7 +7,8 @@ Filter out non-unique models by clustering on RMSD.
 Unique models are designated by writing an empty file named "unique_by_clustering" in their model
 directory.
 
-Runs serially.
+Runs serially, unless --distributed or --incremental is passed, in which case the RMSD calculations
+are split across MPI ranks.
 
 Options:"""
 
@@ -15,6 +16,21 @@ helpstring_unique_options = [
     """\
   --cutoff <cutoff>               Minimum distance cutoff for RMSD-based clustering (nm)
                                   (default: 0.06)""",
+
+    """\
+  --distributed                   Distribute the RMSD calculations across MPI ranks (or local
+                                  workers), loading C-alpha coordinates for blocks of models at a
+                                  time, rather than clustering all models at once on a single rank.""",
+
+    """\
+  --block_size <n>                Number of models per block in distributed mode. Bounds the number
+                                  of models held in memory at once (default: 500)""",
+
+    """\
+  --incremental                   Keep existing clustering results, and compare only models built
+                                  since the last clustering run against the existing unique models,
+                                  using cached C-alpha coordinates. Falls back to clustering all
+                                  models if no cached results are available for a target.""",
 ]
 
 helpstring_nonunique_options = [
@@ -47,9 +63,12 @@ def dispatch(args):
     if args['--cutoff']:
         dispatch_args['cutoff'] = float(args['--cutoff'])
 
+    if args['--block_size']:
+        dispatch_args['block_size'] = int(args['--block_size'])
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
         loglevel = 'info'
 
-    ensembler.modeling.cluster_models(process_only_these_targets=targets, loglevel=loglevel, **dispatch_args)
\ No newline at end of file
+    ensembler.modeling.cluster_models(process_only_these_targets=targets, distributed=args['--distributed'], incremental=args['--incremental'], loglevel=loglevel, **dispatch_args)
\ No newline at end of file
@@ -12,29 +12,42 @@ Usage:
       [--dbapi_uri <uri>] [--uniprot_domain_regex <regex>] [--chainids <chainids>]
       [--structure_paths <path>] [-v | --verbose]
   ensembler loopmodel [-h | --help] [--templates <templates>] [--overwrite_structures]
-      [-v | --verbose]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler align [-h | --help] [--targets <targets>] [--targetsfile <targetsfile>]
-      [--templates <templates>] [-v | --verbose]
+      [--templates <templates>] [--template_seqid_cutoff <cutoff>]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler build_models [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--template_seqid_cutoff <cutoff>] [--write_modeller_restraints_file]
-      [-v | --verbose]
+      [--nmodeller_workers <n>] [--write_coordinate_store]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler cluster [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
-      [--cutoff <cutoff>] [-v | --verbose]
+      [--cutoff <cutoff>] [--distributed] [--block_size <n>] [--incremental]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler refine_implicit [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--template_seqid_cutoff <cutoff>] [--gpupn <gpupn>]
       [--openmm_platform <platform>] [--simlength <simlength>] [--retry_failed_runs] [--ff <ffname>]
-      [--water_model <modelname>] [--api_params <params>] [-v | --verbose]
+      [--water_model <modelname>] [--api_params <params>] [--write_coordinate_store]
+      [--checkpoint_interval <n>] [--adaptive_simlength] [--hmr] [--cpu_packing]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler solvate [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--template_seqid_cutoff <cutoff>] [--padding <padding>]
-      [--ff <ffname>] [--water_model <modelname>] [-v | --verbose]
+      [--ff <ffname>] [--water_model <modelname>] [--estimate_nwaters]
+      [--calibration_sample_size <n>] [--keep_solvated_models]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler refine_explicit [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--template_seqid_cutoff <cutoff>] [--gpupn <gpupn>]
       [--openmm_platform <platform>] [--simlength <simlength>] [--retry_failed_runs]
       [--write_solvated_model] [--ff <ffname>] [--water_model <modelname>] [--api_params <params>]
-      [-v | --verbose]
+      [--write_coordinate_store] [--checkpoint_interval <n>] [--adaptive_simlength] [--hmr]
+      [--cpu_packing]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler package_models [-h | --help] [--package_for <choice>] [--targets <target>]
       [--targetsfile <targetsfile>] [--templates <template>] [--template_seqid_cutoff <cutoff>]
-      [--nfahclones <n>] [--archivefahproject]
+      [--nfahclones <n>] [--archivefahproject] [--archive_compression <format>] [--hmr]
+      [--transfer_files <patterns>] [--transfer_bundle_size <MB>]
+      [--executor <executor>] [--nworkers <n>]
+  ensembler import_models [-h | --help] [--bundles <bundles>]
+      [--executor <executor>] [--nworkers <n>] [-v | --verbose]
   ensembler testrun_pipeline [-h | --help]
   ensembler quickmodel [-h | --help] [--targetid <id>] [--templateids <ids>]
       [--target_uniprot_entry_name <entry_name>] [--uniprot_domain_regex <regex>]
@@ -48,6 +61,11 @@ Commands:
 
 General options:
   -h --help                     Print command line help
+  --executor <executor>         How to run MPI-enabled commands in parallel {mpi|local} [default: mpi]
+                                  - "mpi": use MPI ranks (run with e.g. mpirun)
+                                  - "local": fork worker processes on the local machine
+  --nworkers <n>                Number of worker processes to use with "--executor local"
+                                (default: number of CPUs)
 """
 
 gather_from_helpstring = """\
@@ -0,0 +1,50 @@
+import os
+import glob
+import ensembler
+import ensembler.packaging
+
+helpstring_header = """\
+Unpack model transfer bundles (written by "ensembler package_models --package_for transfer") into
+this project. Where a file is contained in bundles from more than one export, the copy from the
+latest export is used. File checksums are checked against the bundle manifests.
+
+MPI-enabled.
+
+Options:"""
+
+helpstring_unique_options = [
+    """\
+  --bundles <bundles>               Bundle files, or directories containing bundles (comma-separated),
+                                    e.g. "--bundles transfer/EGFR_HUMAN_D0" (required). Shell-style
+                                    wildcards are expanded.""",
+]
+
+helpstring_nonunique_options = [
+    """\
+  -v --verbose                      """,
+]
+
+helpstring = '\n\n'.join([helpstring_header, '\n\n'.join(helpstring_unique_options), '\n\n'.join(helpstring_nonunique_options)])
+docopt_helpstring = '\n\n'.join(helpstring_unique_options)
+
+
+def dispatch(args):
+    if not args['--bundles']:
+        raise KeyError('--bundles must be defined')
+
+    bundle_filepaths = []
+    for bundles_arg in args['--bundles'].split(','):
+        for path in sorted(glob.glob(bundles_arg)):
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    bundle_filepaths += [os.path.join(dirpath, filename) for filename in filenames if filename.endswith('.tgz') and '-bundle' in filename]
+            else:
+                bundle_filepaths.append(path)
+
+    if len(bundle_filepaths) == 0:
+        raise Exception('No transfer bundles found: %s' % args['--bundles'])
+
+    ensembler.packaging.import_transfer_bundles(
+        bundle_filepaths,
+        verbose=args['--verbose'],
+    )
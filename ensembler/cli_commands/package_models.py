@@ -4,7 +4,9 @@ import ensembler.packaging
 helpstring_header = """\
 Package models for transfer or for set-up as a Folding@Home project.
 
-Packaged models are written in directories of the form "packaged_models/fah-projects/[target id]".
+Packaged models are written in directories of the form "packaged_models/fah-projects/[target id]"
+(Folding@Home) or "packaged_models/transfer/[target id]" (transfer). Transfer bundles are unpacked
+into another project with "ensembler import_models".
 
 MPI-enabled.
 
@@ -13,7 +15,9 @@ Options."""
 helpstring_unique_options = [
     """\
   --package_for <choice>                Specify which packaging method to use (required).
-                                        - transfer: compress results into a single .tgz file
+                                        - transfer: compress models into .tgz bundles, including
+                                          only models which have changed since the previous
+                                          export.
                                         - FAH: set up the input files and directory structure
                                           necessary to start a Folding@Home project.""",
 
@@ -23,7 +27,24 @@ helpstring_unique_options = [
 
     """\
   --archivefahproject                   If packaging for Folding@Home, choose whether to compress
-                                        the results into a .tgz file.""",
+                                        each RUN directory into an archive. Archive sizes and
+                                        checksums are listed in archive-index.yaml.""",
+
+    """\
+  --transfer_files <patterns>           If packaging for transfer, include only files matching these
+                                        filename patterns, or written by these stages
+                                        (comma-separated), e.g.
+                                        "--transfer_files explicit-refined.pdb.gz,*-log.yaml" or
+                                        "--transfer_files refine_explicit_md" (default: all files)""",
+
+    """\
+  --transfer_bundle_size <MB>           If packaging for transfer, the maximum (uncompressed) size of
+                                        each bundle, in megabytes [default: 2048].""",
+
+    """\
+  --archive_compression <format>        Compression format for --archivefahproject: gzip (RUN[n].tgz)
+                                        or zstd (RUN[n].tar.zst, requires the zstandard module)
+                                        [default: gzip].""",
 ]
 
 helpstring_nonunique_options = [
@@ -42,6 +63,10 @@ helpstring_nonunique_options = [
     """\
   --template_seqid_cutoff <cutoff>  Select only templates with sequence identity (percentage)
                                     greater than the given cutoff.""",
+
+    """\
+  --hmr                             If packaging for Folding@Home, use hydrogen mass repartitioning,
+                                    with a 4 fs timestep.""",
 ]
 
 helpstring = '\n\n'.join([helpstring_header, '\n\n'.join(helpstring_unique_options), '\n\n'.join(helpstring_nonunique_options)])
@@ -81,10 +106,27 @@ def dispatch(args):
     else:
         archive = False
 
+    if args['--archive_compression']:
+        archive_compression = args['--archive_compression']
+    else:
+        archive_compression = 'gzip'
+
+    if args['--transfer_files']:
+        transfer_file_patterns = args['--transfer_files'].split(',')
+    else:
+        transfer_file_patterns = None
+
+    if args['--transfer_bundle_size']:
+        transfer_bundle_size = int(float(args['--transfer_bundle_size']) * 1024**2)
+    else:
+        transfer_bundle_size = 2 * 1024**3
+
     if package_for.lower() == 'transfer':
         ensembler.packaging.package_for_transfer(
             process_only_these_targets=targets,
             process_only_these_templates=templates,
+            file_patterns=transfer_file_patterns,
+            bundle_size=transfer_bundle_size,
         )
 
     elif package_for.lower() == 'fah':
@@ -94,4 +136,6 @@ def dispatch(args):
             template_seqid_cutoff=template_seqid_cutoff,
             nclones=n_fah_clones,
             archive=archive,
+            archive_compression=archive_compression,
+            hmr=args['--hmr'],
         )
\ No newline at end of file
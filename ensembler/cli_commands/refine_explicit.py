@@ -63,6 +63,31 @@ helpstring_nonunique_options = [
   --api_params <params>             See API documentation for
                                     ensembler.refinement.refine_implicit_md""",
 
+    """\
+  --write_coordinate_store          Also add models to a per-target coordinate store
+                                    (models/[target]/coords-refine_explicit_md.h5), from which later stages
+                                    and analysis tools can load all models in a single read.""",
+
+    """\
+  --checkpoint_interval <n>         Write a checkpoint every n iterations (of 500 steps), from which
+                                    unfinished simulations are resumed (default: no checkpoints).""",
+
+    """\
+  --adaptive_simlength              Stop each simulation once its potential energy has plateaued,
+                                    treating --simlength as the maximum length. See API
+                                    documentation for ensembler.refinement.refine_implicit_md""",
+
+    """\
+  --hmr                             Use hydrogen mass repartitioning, with a 4 fs timestep (unless
+                                    a timestep is given via --api_params).""",
+
+    """\
+  --cpu_packing                     Use the OpenMM CPU platform, splitting the available CPU cores
+                                    between concurrent simulations, each pinned to its own cores.
+                                    Run as a single process to choose the number of concurrent
+                                    simulations from the system size. See API documentation for
+                                    ensembler.refinement.refine_implicit_md""",
+
     """\
   -v --verbose                 """,
 ]
@@ -104,11 +129,20 @@ def dispatch(args):
     else:
         loglevel = 'info'
 
+    if args['--checkpoint_interval']:
+        checkpoint_interval = int(args['--checkpoint_interval'])
+    else:
+        checkpoint_interval = None
+
     if args['--api_params']:
         api_params = parse_api_params_string(args['--api_params'])
     else:
         api_params = {}
 
+    if args['--hmr']:
+        api_params.setdefault('hmr', True)
+        api_params.setdefault('timestep', 4.0 * unit.femtoseconds)
+
     ensembler.refinement.refine_explicit_md(
         openmm_platform=args['--openmm_platform'],
         gpupn=gpupn,
@@ -117,6 +151,10 @@ def dispatch(args):
         process_only_these_templates=templates,
         template_seqid_cutoff=template_seqid_cutoff,
         retry_failed_runs=args['--retry_failed_runs'],
+        write_coordinate_store=args['--write_coordinate_store'],
+        checkpoint_interval=checkpoint_interval,
+        adaptive_sim_length=args['--adaptive_simlength'],
+        cpu_packing=args['--cpu_packing'],
         write_solvated_model=args['--write_solvated_model'],
         ff=args['--ff'],
         water_model=args['--water_model'],
@@ -7,8 +7,9 @@ Determines the number of waters to add when solvating models with explicit water
 The models for each target are to be given the same number of waters.
 
 The function proceeds by first solvating each model individually, given a padding distance
-(default: 1 nm). A list of the number of waters added for each model is written to a file
-"nwaters.txt" in the "models/[target_id]" directory. A percentile value from the distribution of
+(default: 1 nm), or, with --estimate_nwaters, by estimating the number of waters from the volume of
+the padded solvent box not occupied by the model. A list of the number of waters added for each
+model is written to a file "nwaters.txt" in the "models/[target_id]" directory. A percentile value from the distribution of
 the number of waters is selected as the number to use for all models, and this number is written to
 the file nwaters-use.txt.
 
@@ -19,6 +20,20 @@ Options:"""
 helpstring_unique_options = [
     """\
   --padding <padding>          Padding distance for solvation (Angstroms) (default: 10 Angstroms).""",
+
+    """\
+  --estimate_nwaters           Estimate the number of waters analytically, rather than solvating
+                               each model. See API documentation for
+                               ensembler.refinement.solvate_models""",
+
+    """\
+  --calibration_sample_size <n>  If estimating the number of waters, calibrate the estimate against
+                               solvation of a sample of n models per target (default: 0).""",
+
+    """\
+  --keep_solvated_models       Store each solvated model (as solvated-model.npz in the model
+                               directory), so that refine_explicit can trim it to the chosen
+                               number of waters rather than solvating again.""",
 ]
 
 helpstring_nonunique_options = [
@@ -74,6 +89,11 @@ def dispatch(args):
 
     padding = ensembler.utils.set_arg_with_default(args['--padding'], default_arg=10.0)
 
+    if args['--calibration_sample_size']:
+        calibration_sample_size = int(args['--calibration_sample_size'])
+    else:
+        calibration_sample_size = 0
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -84,6 +104,9 @@ def dispatch(args):
         process_only_these_templates=templates,
         template_seqid_cutoff=template_seqid_cutoff,
         padding=padding,
+        estimate_nwaters_analytically=args['--estimate_nwaters'],
+        calibration_sample_size=calibration_sample_size,
+        keep_solvated_models=args['--keep_solvated_models'],
         ff=args['--ff'],
         water_model=args['--water_model'],
         verbose=args['--verbose'],
@@ -0,0 +1,293 @@
+import os
+import numpy as np
+import mdtraj
+import mdtraj.formats
+import ensembler
+from ensembler.core import mpistate, logger
+
+
+class CoordinateStore(object):
+    """Per-target store of the model coordinates output by a given Ensembler stage.
+
+    Models are stored as frames of a single mdtraj HDF5 file ('coords-[ensembler_stage].h5' in the
+    target models directory), so that a set of models can be loaded in one read, rather than by
+    parsing one PDB file per model. The frame holding each model is listed in an accompanying index
+    file ('coords-[ensembler_stage]-index.txt'), with one "[templateid] [frame index] [file size]
+    [file mtime]" line per model. Frames are written before their index line, so an interrupted append
+    can only leave unindexed frames, which are ignored.
+
+    The size and mtime of each model file are recorded when it is stored. If a model file is later
+    rewritten (e.g. a model is rebuilt), its stored coordinates are considered stale: append_models
+    stores the new coordinates as an additional frame, with an index line which supersedes the old
+    one, and load_models parses the model files rather than loading stale coordinates.
+
+    All models in a store must share the same topology. Unit cell information is not stored.
+    Only one process should append to a given store at a time.
+
+    Parameters
+    ----------
+    models_target_dir : str
+    ensembler_stage : str
+        build_models|refine_implicit_md|refine_explicit_md
+
+    Examples
+    --------
+    >>> store = CoordinateStore('models/EGFR_HUMAN_D0', 'build_models')
+    >>> store.append_models(['KC1D_HUMAN_D0_4KB8_D', 'KC1D_HUMAN_D0_4HNF_A'])
+    >>> traj = store.load(['KC1D_HUMAN_D0_4KB8_D', 'KC1D_HUMAN_D0_4HNF_A'])
+    """
+    def __init__(self, models_target_dir, ensembler_stage):
+        self.models_target_dir = models_target_dir
+        self.ensembler_stage = ensembler_stage
+        self.model_filename = ensembler.core.model_filenames_by_ensembler_stage[ensembler_stage]
+        self.filepath = os.path.join(models_target_dir, 'coords-%s.h5' % ensembler_stage)
+        self.index_filepath = os.path.join(models_target_dir, 'coords-%s-index.txt' % ensembler_stage)
+
+    def exists(self):
+        return os.path.exists(self.filepath) and os.path.exists(self.index_filepath)
+
+    def read_index(self):
+        """
+        Returns
+        -------
+        frame_indices : dict
+            {templateid: frame index}
+        """
+        return {templateid: frame_index for templateid, (frame_index, signature) in self.read_index_entries().items()}
+
+    def read_index_entries(self):
+        """Where a templateid is listed more than once, the last line takes precedence.
+
+        Returns
+        -------
+        index_entries : dict
+            {templateid: (frame index, model file signature)}. The signature is None for index
+            lines written without one.
+        """
+        index_entries = {}
+        if not os.path.exists(self.index_filepath):
+            return index_entries
+        with open(self.index_filepath) as index_file:
+            for line in index_file:
+                words = line.split()
+                if len(words) == 2:
+                    index_entries[words[0]] = (int(words[1]), None)
+                elif len(words) == 4:
+                    index_entries[words[0]] = (int(words[1]), (words[2], words[3]))
+        return index_entries
+
+    def model_signature(self, templateid):
+        """
+        Returns
+        -------
+        signature : tuple of str or None
+            (file size, file mtime) of the model file, as recorded in the index, or None if the
+            model file does not exist.
+        """
+        model_filepath = os.path.join(self.models_target_dir, templateid, self.model_filename)
+        try:
+            model_stat = os.stat(model_filepath)
+        except OSError:
+            return None
+        return ('%d' % model_stat.st_size, '%.6f' % model_stat.st_mtime)
+
+    def stale_templateids(self, templateids):
+        """Templates whose model file has changed since it was stored.
+
+        Models which are not in the store, or whose model file no longer exists, are not included.
+
+        Parameters
+        ----------
+        templateids : list of str
+
+        Returns
+        -------
+        stale_templateids : list of str
+        """
+        index_entries = self.read_index_entries()
+        stale_templateids = []
+        for templateid in templateids:
+            if templateid not in index_entries:
+                continue
+            signature = self.model_signature(templateid)
+            if signature is not None and signature != index_entries[templateid][1]:
+                stale_templateids.append(templateid)
+        return stale_templateids
+
+    def append_models(self, templateids):
+        """Append models which are not yet in the store, or whose stored coordinates are stale.
+
+        Templates for which no model file exists are skipped, as are models whose topology does not
+        match that of the store.
+
+        Parameters
+        ----------
+        templateids : list of str
+
+        Returns
+        -------
+        appended_templateids : list of str
+        """
+        index_entries = self.read_index_entries()
+        appended_templateids = []
+        h5file = None
+        try:
+            for templateid in templateids:
+                signature = self.model_signature(templateid)
+                if signature is None:
+                    continue
+                if templateid in index_entries and index_entries[templateid][1] == signature:
+                    continue
+                model_filepath = os.path.join(self.models_target_dir, templateid, self.model_filename)
+                model = mdtraj.load_pdb(model_filepath)
+
+                if h5file is None:
+                    if os.path.exists(self.filepath):
+                        h5file = mdtraj.formats.HDF5TrajectoryFile(self.filepath, mode='a')
+                        nframes = len(h5file)
+                    else:
+                        h5file = mdtraj.formats.HDF5TrajectoryFile(self.filepath, mode='w')
+                        h5file.topology = model.topology
+                        nframes = 0
+                    natoms = h5file.topology.n_atoms
+
+                if model.n_atoms != natoms:
+                    logger.warning(
+                        'Model %s has %d atoms, but the %s coordinate store has %d; not stored.'
+                        % (model_filepath, model.n_atoms, self.ensembler_stage, natoms)
+                    )
+                    continue
+
+                h5file.write(coordinates=model.xyz)
+                h5file.flush()
+                with open(self.index_filepath, 'a') as index_file:
+                    index_file.write('%s %d %s %s\n' % ((templateid, nframes) + signature))
+                index_entries[templateid] = (nframes, signature)
+                nframes += 1
+                appended_templateids.append(templateid)
+        finally:
+            if h5file is not None:
+                h5file.close()
+
+        return appended_templateids
+
+    def load(self, templateids, atom_indices=None):
+        """Load the given models as a single trajectory, with frames in the order given.
+
+        Only the frames for the given models are read from the store file. Runs of consecutive
+        frames are read together.
+
+        Parameters
+        ----------
+        templateids : list of str
+        atom_indices : array_like, optional
+            Load only these atoms.
+
+        Returns
+        -------
+        traj : mdtraj.Trajectory
+        """
+        frame_indices = self.read_index()
+        missing_templateids = [templateid for templateid in templateids if templateid not in frame_indices]
+        if len(missing_templateids) > 0:
+            raise KeyError('Models not found in %s: %s' % (self.filepath, ', '.join(missing_templateids)))
+        model_frame_indices = [frame_indices[templateid] for templateid in templateids]
+
+        xyz_by_frame_index = {}
+        h5file = mdtraj.formats.HDF5TrajectoryFile(self.filepath, mode='r')
+        try:
+            topology = h5file.topology
+            for run_start, run_length in contiguous_runs(sorted(set(model_frame_indices))):
+                h5file.seek(run_start)
+                frames = h5file.read(n_frames=run_length, atom_indices=atom_indices)
+                for i in range(run_length):
+                    xyz_by_frame_index[run_start + i] = frames.coordinates[i]
+        finally:
+            h5file.close()
+
+        if atom_indices is not None:
+            topology = topology.subset(atom_indices)
+        if len(model_frame_indices) > 0:
+            xyz = np.array([xyz_by_frame_index[frame_index] for frame_index in model_frame_indices])
+        else:
+            xyz = np.zeros((0, topology.n_atoms, 3), dtype=np.float32)
+        return mdtraj.Trajectory(xyz, topology)
+
+
+def contiguous_runs(sorted_indices):
+    """
+    Parameters
+    ----------
+    sorted_indices : list of int
+        Unique indices, in ascending order.
+
+    Returns
+    -------
+    runs : list of (int, int)
+        (first index, length) of each run of consecutive indices.
+    """
+    runs = []
+    for index in sorted_indices:
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] == index:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((index, 1))
+    return runs
+
+
+def load_models(models_target_dir, ensembler_stage, templateids, atom_indices=None):
+    """Load a set of models as a single trajectory.
+
+    The models are read from the target's coordinate store for the given stage if it holds all of
+    them and none of their model files have changed since they were stored, and otherwise by
+    parsing each model file.
+
+    Parameters
+    ----------
+    models_target_dir : str
+    ensembler_stage : str
+        build_models|refine_implicit_md|refine_explicit_md
+    templateids : list of str
+    atom_indices : array_like, optional
+        Load only these atoms.
+
+    Returns
+    -------
+    traj : mdtraj.Trajectory
+    """
+    store = CoordinateStore(models_target_dir, ensembler_stage)
+    if store.exists():
+        frame_indices = store.read_index()
+        if all([templateid in frame_indices for templateid in templateids]):
+            stale_templateids = store.stale_templateids(templateids)
+            if len(stale_templateids) > 0:
+                logger.debug(
+                    '%d models in %s are stale; parsing model files instead'
+                    % (len(stale_templateids), store.filepath)
+                )
+            else:
+                logger.debug('Loading %d models from %s' % (len(templateids), store.filepath))
+                return store.load(templateids, atom_indices=atom_indices)
+    model_filename = ensembler.core.model_filenames_by_ensembler_stage[ensembler_stage]
+    return mdtraj.load([os.path.join(models_target_dir, templateid, model_filename) for templateid in templateids], atom_indices=atom_indices)
+
+
+def update_coordinate_store(models_target_dir, ensembler_stage, templateids):
+    """Append any new models for a target to its coordinate store, once all MPI ranks have finished
+    the given stage for that target.
+
+    MPI-enabled - must be called by all ranks. Appends are done on rank 0 only.
+
+    Parameters
+    ----------
+    models_target_dir : str
+    ensembler_stage : str
+        build_models|refine_implicit_md|refine_explicit_md
+    templateids : list of str
+    """
+    mpistate.comm.Barrier()
+    if mpistate.rank == 0:
+        store = CoordinateStore(models_target_dir, ensembler_stage)
+        appended_templateids = store.append_models(templateids)
+        logger.info('Added %d models to coordinate store %s' % (len(appended_templateids), store.filepath))
+    mpistate.comm.Barrier()
@@ -3,6 +3,14 @@ import logging
 import sys
 import re
 import warnings
+import threading
+import multiprocessing
+import Queue
+import contextlib
+import traceback
+import signal
+import socket
+import subprocess
 import numpy as np
 import Bio
 import Bio.SeqIO
@@ -19,6 +27,14 @@ datestamp_format_string = '%Y-%m-%d %H:%M:%S UTC'
 
 manual_overrides_filename = 'manual-overrides.yaml'
 
+alignment_cache_filename = 'alignment-cache.sqlite'
+
+clustering_cache_filename = 'unique-models-CA.npz'
+
+protonation_variants_filename = 'protonation-variants.yaml'
+
+solvated_model_filename = 'solvated-model.npz'
+
 template_acceptable_ratio_resolved_residues = 0.7
 
 # listed in order
@@ -87,21 +103,534 @@ model_filenames_by_ensembler_stage = {
 # MPI
 # ========
 
-class MPIState:
+class MPIState(object):
+    """Holds the MPI communicator, rank and size.
+
+    MPI is only initialized (by importing mpi4py.MPI) when comm, rank or size is first used, so that
+    the local executor can fork its worker processes before then - forking after MPI has been
+    initialized is not supported by MPI implementations such as Open MPI.
+    """
     def __init__(self):
+        self._comm = None
+        self._rank = None
+        self._size = None
+        self.executor = 'mpi'
+
+    def _initialize(self):
+        if self._comm is not None:
+            return
         try:
             import mpi4py.MPI
-            self.comm = mpi4py.MPI.COMM_WORLD
-            self.rank = self.comm.rank
-            self.size = self.comm.size
+            self._comm = mpi4py.MPI.COMM_WORLD
+            self._rank = self._comm.rank
+            self._size = self._comm.size
         except Exception as e:
             logger.debug('Error initializing MPIState:\n%s' % e)
-            self.comm = None
-            self.rank = 0
-            self.size = 1
+            self._comm = LocalComm(rank=0, size=1)
+            self._rank = 0
+            self._size = 1
+
+    @property
+    def comm(self):
+        self._initialize()
+        return self._comm
+
+    @property
+    def rank(self):
+        self._initialize()
+        return self._rank
+
+    @property
+    def size(self):
+        self._initialize()
+        return self._size
+
+    def is_single_process(self):
+        """Whether this is the only process, i.e. not one of several MPI ranks or local executor
+        workers, and the local executor can still be started. Unlike size, this does not
+        initialize MPI, so the local executor can still be used afterwards. Returns False once MPI
+        has been initialized, even with a single rank, since processes can then no longer be
+        forked.
+        """
+        if mpi_initialized():
+            return False
+        if self._size is not None:
+            return self._size == 1
+        return mpi_launcher_size() == 1
+
+    @contextlib.contextmanager
+    def local_executor(self, nworkers):
+        """Run the enclosed code on nworkers local processes, which take the place of MPI ranks.
+
+        nworkers-1 child processes are forked on entry, and each continues executing the enclosed
+        code with its own rank, communicating via a LocalComm. As with MPI, all stage functions are
+        therefore run by every process, and work is distributed and gathered by the same code.
+        Child processes exit at the end of the enclosed code; the parent waits for them to finish.
+        Used by the CLI option "--executor local".
+
+        If any process raises an exception, the other processes are notified (see LocalComm), and
+        the parent terminates the child processes and raises a LocalWorkerError.
+
+        Must be entered before MPI is initialized, i.e. before mpistate.comm, rank or size is used
+        (mpistate.is_single_process can be used beforehand).
+
+        Parameters
+        ----------
+        nworkers : int
+
+        Examples
+        --------
+        >>> with mpistate.local_executor(nworkers=8):
+        ...     ensembler.modeling.build_models()
+        """
+        if mpi_initialized():
+            raise Exception('The local executor cannot be used once MPI has been initialized.')
+        if mpi_launcher_size() > 1:
+            raise Exception('The local executor cannot be used when running under MPI with more than one rank.')
+        inboxes = [multiprocessing.Queue() for rank in range(nworkers)]
+        task_counter = multiprocessing.Value('l', 0)
+        initial_state = (self._comm, self._rank, self._size, self.executor)
+        parent_pid = os.getpid()
+        child_pids = []
+        rank = 0
+        for child_rank in range(1, nworkers):
+            pid = os.fork()
+            if pid == 0:
+                rank = child_rank
+                child_pids = []
+                break
+            child_pids.append(pid)
+
+        self._comm = LocalComm(
+            rank=rank, size=nworkers, inboxes=inboxes, task_counter=task_counter,
+            parent_pid=parent_pid, child_pids=child_pids
+        )
+        self._rank = rank
+        self._size = nworkers
+        self.executor = 'local'
+
+        if rank != 0:
+            exit_status = 0
+            try:
+                yield
+            except LocalWorkerError as e:
+                # Another process failed
+                logger.error('Local worker rank %d stopping: %s' % (rank, e))
+                exit_status = 1
+            except:
+                logger.error('Local worker rank %d failed:\n%s' % (rank, traceback.format_exc()))
+                self._comm.abort('Local worker rank %d failed:\n%s' % (rank, traceback.format_exc()))
+                exit_status = 1
+            finally:
+                # Flush any messages still buffered for sending before exiting
+                for inbox in inboxes:
+                    inbox.close()
+                    inbox.join_thread()
+                os._exit(exit_status)
+
+        try:
+            yield
+        except:
+            # Child processes would otherwise wait indefinitely for rank 0
+            for pid in child_pids:
+                if pid not in self._comm.child_exit_statuses:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+            raise
+        finally:
+            nfailed = 0
+            for pid in child_pids:
+                if pid in self._comm.child_exit_statuses:
+                    exit_status = self._comm.child_exit_statuses[pid]
+                else:
+                    pid, exit_status = os.waitpid(pid, 0)
+                if exit_status != 0:
+                    nfailed += 1
+            self._comm, self._rank, self._size, self.executor = initial_state
+        if nfailed > 0:
+            raise LocalWorkerError('%d local worker processes exited with an error.' % nfailed)
+
+    def iter_tasks(self, tasks, key=None):
+        """Distribute tasks dynamically across MPI ranks.
+
+        Rank 0 runs a master thread which hands out tasks one at a time to whichever rank (including
+        rank 0 itself) asks for one next, so that ranks which happen to get short tasks keep working
+        while others are busy with long ones. Must be called by all ranks, with the same list of
+        tasks, and the returned generator must be run to exhaustion on every rank.
+
+        Parameters
+        ----------
+        tasks : list
+        key : function
+            Called with each task to give its expected cost. Tasks are handed out in order of
+            decreasing cost (longest-expected-first), which reduces the time spent waiting on a
+            long task started at the end of the queue. Evaluated on rank 0 only. If None, tasks
+            are handed out in the order given.
+
+        If a rank stops iterating early (e.g. the generator is closed after an exception in the
+        loop body), it tells the master thread that it is finished, and the remaining tasks go to
+        the other ranks. Since the failed rank will then miss any later collective operations,
+        loop bodies should nevertheless catch and record errors for individual tasks.
+
+        Yields
+        ------
+        task
+            The tasks to be processed by this rank.
+
+        Notes
+        -----
+        If mpi4py was initialized with a thread support level below MPI_THREAD_MULTIPLE, the
+        (sorted) tasks are instead split statically across ranks.
+
+        Examples
+        --------
+        >>> for template in mpistate.iter_tasks(templates, key=lambda template: len(template.seq)):
+        ...     build_model(target, template)
+        """
+        tasks = list(tasks)
+        order = None
+        if self.rank == 0:
+            order = range(len(tasks))
+            if key is not None:
+                order = sorted(order, key=lambda task_index: key(tasks[task_index]), reverse=True)
+
+        if self.size == 1:
+            for task_index in order:
+                yield tasks[task_index]
+            return
+
+        # Non-zero ranks cannot send task requests until this bcast completes, and rank 0 only gets
+        # here once the master thread from any previous call has finished, so messages from
+        # successive task queues can never be mixed up.
+        order = self.comm.bcast(order, root=0)
+
+        if isinstance(self.comm, LocalComm):
+            # Local processes share a task counter in place of the master thread. The barrier
+            # ensures no process is still drawing from the counter when rank 0 resets it.
+            while True:
+                queue_index = self.comm.next_task_index()
+                if queue_index >= len(order):
+                    break
+                yield tasks[order[queue_index]]
+            self.comm.Barrier()
+            if self.rank == 0:
+                self.comm.reset_task_counter()
+            return
+
+        import mpi4py.MPI
+        if mpi4py.MPI.Query_thread() < mpi4py.MPI.THREAD_MULTIPLE:
+            logger.debug('MPI thread support level below MPI_THREAD_MULTIPLE - splitting tasks statically')
+            for task_index in order[self.rank::self.size]:
+                yield tasks[task_index]
+            return
+
+        master_thread = None
+        if self.rank == 0:
+            master_thread = threading.Thread(target=self._serve_tasks, args=(len(order),))
+            master_thread.daemon = True
+            master_thread.start()
+
+        finished = False
+        try:
+            while True:
+                self.comm.send(None, dest=0, tag=_task_request_tag)
+                queue_index = self.comm.recv(source=0, tag=_task_reply_tag)
+                if queue_index is None:
+                    finished = True
+                    break
+                yield tasks[order[queue_index]]
+        finally:
+            if not finished:
+                # Exited early, so the master thread would otherwise wait for this rank's final
+                # request indefinitely
+                self.comm.send(_task_queue_exit, dest=0, tag=_task_request_tag)
+
+        if master_thread is not None:
+            master_thread.join()
+
+    def node_cpu_share(self):
+        """Returns the CPUs this rank should run on, such that the CPUs available on each node (see
+        get_available_cpus) are split into contiguous core sets, one per rank running on that node
+        (as identified by hostname). If the ranks on a node already have different CPU
+        affinities (e.g. bound by the MPI launcher), or outnumber its CPUs, each rank keeps all
+        of its available CPUs. Must be called by all ranks.
+        """
+        rank_cpus = self.comm.gather((socket.gethostname(), get_available_cpus()), root=0)
+        rank_cpus = self.comm.bcast(rank_cpus, root=0)
+        hostname, cpus = rank_cpus[self.rank]
+        node_ranks = [rank for rank in range(self.size) if rank_cpus[rank][0] == hostname]
+        if any(rank_cpus[rank][1] != cpus for rank in node_ranks) or len(node_ranks) > len(cpus):
+            return cpus
+        return split_cpus(cpus, len(node_ranks))[node_ranks.index(self.rank)]
+
+    def _serve_tasks(self, ntasks):
+        """Master loop run on rank 0 by iter_tasks: answers each task request with the next queue
+        index, then with None once the queue is empty, until every rank has been told to stop or
+        has exited the task queue early."""
+        import mpi4py.MPI
+        status = mpi4py.MPI.Status()
+        next_queue_index = 0
+        nranks_finished = 0
+        while nranks_finished < self.size:
+            request = self.comm.recv(source=mpi4py.MPI.ANY_SOURCE, tag=_task_request_tag, status=status)
+            if request == _task_queue_exit:
+                nranks_finished += 1
+            elif next_queue_index < ntasks:
+                self.comm.send(next_queue_index, dest=status.Get_source(), tag=_task_reply_tag)
+                next_queue_index += 1
+            else:
+                self.comm.send(None, dest=status.Get_source(), tag=_task_reply_tag)
+                nranks_finished += 1
+
+_task_request_tag = 7301
+_task_queue_exit = 'exit'
+_task_reply_tag = 7302
+_bcast_tag = 7303
+_gather_tag = 7304
+_abort_tag = 7305
+
+
+class LocalWorkerError(Exception):
+    pass
+
+
+class LocalComm(object):
+    """Implements the subset of the mpi4py communicator interface used by Ensembler (send, recv,
+    bcast, gather and Barrier) for processes on a single machine, using one multiprocessing queue
+    per rank as its inbox.
+
+    With size=1 this acts as a trivial communicator, which is used by MPIState if mpi4py is not
+    available, so that stage functions need not check whether MPI is in use.
+
+    A process which fails sends an abort message to every other rank (see abort), upon which recv
+    (and hence bcast, gather and Barrier) raises a LocalWorkerError. While waiting for a message,
+    recv also checks every poll_interval seconds that the other processes are still running: rank
+    0 checks its child processes, and the child processes check rank 0.
+    """
+    ANY_SOURCE = -1
+    ANY_TAG = -1
+    poll_interval = 1.0
+
+    def __init__(self, rank=0, size=1, inboxes=None, task_counter=None, parent_pid=None, child_pids=None):
+        self.rank = rank
+        self.size = size
+        if inboxes is None:
+            inboxes = [Queue.Queue() for r in range(size)]
+        self.inboxes = inboxes
+        self.task_counter = task_counter
+        self.parent_pid = parent_pid
+        self.child_pids = child_pids if child_pids is not None else []
+        self.child_exit_statuses = {}
+        self._unmatched_messages = []
+
+    def send(self, obj, dest, tag=0):
+        self.inboxes[dest].put((self.rank, tag, obj))
+
+    def recv(self, source=ANY_SOURCE, tag=ANY_TAG):
+        def matches(message):
+            return source in (self.ANY_SOURCE, message[0]) and tag in (self.ANY_TAG, message[1])
+
+        for message_index, message in enumerate(self._unmatched_messages):
+            if matches(message):
+                return self._unmatched_messages.pop(message_index)[2]
+        while True:
+            try:
+                message = self.inboxes[self.rank].get(timeout=self.poll_interval)
+            except Queue.Empty:
+                self._check_processes()
+                continue
+            if message[1] == _abort_tag:
+                raise LocalWorkerError(message[2])
+            if matches(message):
+                return message[2]
+            self._unmatched_messages.append(message)
+
+    def abort(self, error_message):
+        """Notify all other ranks that this process has failed."""
+        for dest in range(self.size):
+            if dest != self.rank:
+                self.send(error_message, dest, tag=_abort_tag)
+
+    def _check_processes(self):
+        if self.rank == 0:
+            for pid in self.child_pids:
+                if pid in self.child_exit_statuses:
+                    continue
+                exited_pid, exit_status = os.waitpid(pid, os.WNOHANG)
+                if exited_pid != 0:
+                    self.child_exit_statuses[pid] = exit_status
+                    if exit_status != 0:
+                        raise LocalWorkerError('Local worker process %d exited unexpectedly (status %d).' % (pid, exit_status))
+        elif self.parent_pid is not None and os.getppid() != self.parent_pid:
+            raise LocalWorkerError('Local worker rank 0 exited unexpectedly.')
+
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            for dest in range(self.size):
+                if dest != root:
+                    self.send(obj, dest, tag=_bcast_tag)
+            return obj
+        return self.recv(source=root, tag=_bcast_tag)
+
+    def gather(self, obj, root=0):
+        if self.rank == root:
+            return [obj if source == root else self.recv(source=source, tag=_gather_tag) for source in range(self.size)]
+        self.send(obj, root, tag=_gather_tag)
+        return None
+
+    def Barrier(self):
+        self.gather(None, root=0)
+        self.bcast(None, root=0)
+
+    def _check_aborts(self):
+        """Raise a LocalWorkerError if another process has failed, without waiting for messages."""
+        while True:
+            try:
+                message = self.inboxes[self.rank].get_nowait()
+            except Queue.Empty:
+                break
+            if message[1] == _abort_tag:
+                raise LocalWorkerError(message[2])
+            self._unmatched_messages.append(message)
+        self._check_processes()
+
+    def next_task_index(self):
+        """Draw the next index from the shared task counter. Raises a LocalWorkerError if another
+        process has failed, so that the remaining processes stop between tasks.
+        """
+        self._check_aborts()
+        with self.task_counter.get_lock():
+            task_index = self.task_counter.value
+            self.task_counter.value += 1
+        return task_index
+
+    def reset_task_counter(self):
+        with self.task_counter.get_lock():
+            self.task_counter.value = 0
+
+def mpi_initialized():
+    """Whether MPI has been initialized in this process (by mpistate or otherwise), after which
+    processes should not be forked.
+    """
+    mpi_module = sys.modules.get('mpi4py.MPI')
+    return mpi_module is not None and mpi_module.Is_initialized()
+
+
+def mpi_launcher_size():
+    """Number of ranks this process was started with by an MPI launcher (1 if not started by
+    one), determined from the environment, i.e. without initializing MPI.
+    """
+    # Set by the Open MPI and MPICH launchers respectively
+    for launcher_size_variable in ['OMPI_COMM_WORLD_SIZE', 'PMI_SIZE']:
+        if launcher_size_variable in os.environ:
+            return int(os.environ[launcher_size_variable])
+    return 1
 
 mpistate = MPIState()
 
+# ========
+# CPU affinity
+# ========
+
+def parse_cpu_list(cpu_list_str):
+    """Parse a Linux CPU list string, e.g. '0-3,8,10-11', as found in /proc/[pid]/status.
+    """
+    cpus = []
+    for cpu_range in cpu_list_str.strip().split(','):
+        if '-' in cpu_range:
+            first, last = cpu_range.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif cpu_range:
+            cpus.append(int(cpu_range))
+    return cpus
+
+
+def get_cgroup_cpu_quota():
+    """Returns the number of CPUs' worth of time allowed by the cgroup CPU quota of this process
+    (cgroup v2 or v1), or None if there is no quota.
+    """
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max_file:
+            quota, period = cpu_max_file.read().split()
+        if quota != 'max':
+            return float(quota) / float(period)
+        return None
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota_file:
+            quota = int(quota_file.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period_file:
+            period = int(period_file.read())
+        if quota > 0:
+            return float(quota) / period
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def get_available_cpus():
+    """Returns a sorted list of the CPUs which this process may run on, taking into account its
+    CPU affinity (e.g. as set by a batch system or MPI launcher) and any cgroup CPU quota (e.g. in
+    a container). If the quota is less than the number of CPUs in the affinity mask, only that
+    many CPUs are returned.
+    """
+    cpus = None
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        try:
+            with open('/proc/self/status') as status_file:
+                for line in status_file:
+                    if line.startswith('Cpus_allowed_list:'):
+                        cpus = parse_cpu_list(line.split(':')[1])
+        except (IOError, OSError):
+            pass
+    if not cpus:
+        cpus = range(multiprocessing.cpu_count())
+
+    quota = get_cgroup_cpu_quota()
+    if quota is not None:
+        cpus = cpus[:max(1, int(quota))]
+    return list(cpus)
+
+
+def set_cpu_affinity(cpus):
+    """Restrict this process to run on the given CPUs. Threads started subsequently (e.g. by the
+    OpenMM CPU Platform) inherit the affinity.
+
+    Uses os.sched_setaffinity if available, otherwise psutil, otherwise the taskset utility.
+
+    Returns
+    -------
+    success : bool
+    """
+    cpus = list(cpus)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return True
+    try:
+        import psutil
+        psutil.Process().cpu_affinity(cpus)
+        return True
+    except ImportError:
+        pass
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['taskset', '-p', '-c', ','.join([str(cpu) for cpu in cpus]), str(os.getpid())], stdout=devnull)
+        return True
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning('Could not set CPU affinity: %r' % e)
+        return False
+
+
+def split_cpus(cpus, nparts):
+    """Split a list of CPUs into nparts contiguous core sets, whose sizes differ by at most one.
+    """
+    return [[int(cpu) for cpu in part] for part in np.array_split(np.array(cpus, dtype=int), nparts)]
+
 # ========
 # YAML
 # ========
@@ -295,6 +824,8 @@ class ProjectMetadata:
             return metadata_dir_dict[project_stage]
         elif project_stage in ['build_models', 'cluster_models', 'refine_implicit_md', 'solvate_models', 'determine_nwaters', 'refine_explicit_md']:
             return os.path.join('models', target_id)
+        elif project_stage == 'package_for_fah':
+            return os.path.join(default_project_dirnames.packaged_models, 'fah-projects', target_id)
 
     def metadata_file_basename_mapper(self, project_stage):
         if project_stage in ['build_models', 'cluster_models', 'refine_implicit_md', 'solvate_models', 'determine_nwaters', 'refine_explicit_md']:
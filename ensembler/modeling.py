@@ -8,18 +8,21 @@ import glob
 from collections import namedtuple
 import tempfile
 import traceback
+import multiprocessing
+import Queue
 import Bio.SeqUtils
 import simtk.openmm
 import yaml
 import warnings
 import ensembler
 import ensembler.version
+import ensembler.alignment
+import ensembler.coordinate_store
 import Bio
 import Bio.SeqIO
-import Bio.pairwise2
-import Bio.SubsMat.MatrixInfo
 import modeller
 import modeller.automodel
+import numpy as np
 import mdtraj
 import msmbuilder.cluster
 from ensembler.core import get_targets_and_templates
@@ -39,6 +42,13 @@ TargetSetupData = namedtuple(
 )
 
 
+ModellerBuildRequest = namedtuple(
+    'ModellerBuildRequest',
+    ['target_id', 'template_id', 'model_dir', 'aln_filepath', 'model_pdbfilepath',
+     'template_structure_dir', 'write_modeller_restraints_file', 'log_file']
+)
+
+
 class LoopmodelOutput:
     def __init__(self, output_text=None, loopmodel_exception=None, exception=None, trbk=None, successful=False, no_missing_residues=False):
         self.output_text = output_text
@@ -74,20 +84,20 @@ def pdbfix_templates(templates_full_seq, process_only_these_templates=None, over
     """
     missing_residues_sublist = []
     ntemplates = len(templates_full_seq)
-    for template_index in range(mpistate.rank, ntemplates, mpistate.size):
+    for template_index in mpistate.iter_tasks(range(ntemplates), key=lambda i: len(templates_full_seq[i].seq)):
         template_full_seq = templates_full_seq[template_index]
         if process_only_these_templates and template_full_seq.id not in process_only_these_templates:
-            missing_residues_sublist.append(None)
             continue
-        missing_residues_sublist.append(pdbfix_template(template_full_seq, overwrite_structures=overwrite_structures))
+        missing_residues_sublist.append((template_index, pdbfix_template(template_full_seq, overwrite_structures=overwrite_structures)))
 
     missing_residues_gathered = mpistate.comm.gather(missing_residues_sublist, root=0)
 
     missing_residues_list = []
     if mpistate.rank == 0:
         missing_residues_list = [None] * ntemplates
-        for template_index in range(ntemplates):
-            missing_residues_list[template_index] = missing_residues_gathered[template_index % mpistate.size][template_index // mpistate.size]
+        for sublist in missing_residues_gathered:
+            for template_index, missing_residues in sublist:
+                missing_residues_list[template_index] = missing_residues
 
     missing_residues_list = mpistate.comm.bcast(missing_residues_list, root=0)
 
@@ -162,7 +172,8 @@ def loopmodel_templates(templates, missing_residues, process_only_these_template
     :param missing_residues: list of list of OpenMM Residue
     :param overwrite_structures: bool
     """
-    for template_index in range(mpistate.rank, len(templates), mpistate.size):
+    # Templates with the most missing residues take longest, so are modeled first
+    for template_index in mpistate.iter_tasks(range(len(templates)), key=lambda i: _count_missing_residues(missing_residues[i])):
         template = templates[template_index]
         if process_only_these_templates and template.id not in process_only_these_templates:
             continue
@@ -173,6 +184,12 @@ def loopmodel_templates(templates, missing_residues, process_only_these_template
         loopmodel_template(template, missing_residues[template_index], overwrite_structures=overwrite_structures)
 
 
+def _count_missing_residues(missing_residues):
+    if not missing_residues:
+        return 0
+    return sum([len(residues) for residues in missing_residues.values()])
+
+
 def loopmodel_template(template, missing_residues, overwrite_structures=False):
     template_filepath = os.path.abspath(os.path.join(ensembler.core.default_project_dirnames.templates_structures_modeled_loops, template.id + '-pdbfixed.pdb'))
     output_pdb_filepath = os.path.abspath(os.path.join(ensembler.core.default_project_dirnames.templates_structures_modeled_loops, template.id + '.pdb'))
@@ -289,21 +306,39 @@ def check_loopmodel_complete_and_successful(template):
 
 
 @ensembler.utils.notify_when_done
-def align_targets_and_templates(process_only_these_targets=None, process_only_these_templates=None, loglevel=None):
+def align_targets_and_templates(process_only_these_targets=None, process_only_these_templates=None,
+                                template_seqid_cutoff=None, use_alignment_cache=True, loglevel=None):
     """
     Conducts pairwise alignments of target sequences against template sequences.
     Stores Modeller-compatible 'alignment.pir' files in each model directory,
     and also outputs a table of model IDs, sorted by sequence identity.
 
+    If template_seqid_cutoff is given, alignment proceeds in two phases. A score-only pass
+    (without traceback) first gives an upper bound on the sequence identity of each pair. Full
+    alignments are then only computed for templates which pass the cutoff, and model directories
+    and 'alignment.pir' files are only written for templates with sequence identity greater than
+    the cutoff. Only those templates are listed in 'sequence-identities.txt'.
+
+    Unless use_alignment_cache is False, alignments are stored in 'models/alignment-cache.sqlite',
+    and only target/template sequence pairs not found in the cache are aligned.
+
     :param process_only_these_targets:
     :param process_only_these_templates:
+    :param template_seqid_cutoff: float
+    :param use_alignment_cache: bool
     :param loglevel:
     :return:
     """
     ensembler.utils.loglevel_setter(logger, loglevel)
     targets, templates_resolved_seq, templates_full_seq = ensembler.core.get_targets_and_templates()
     ntemplates = len(templates_resolved_seq)
-    nselected_templates = len(process_only_these_templates) if process_only_these_templates else ntemplates
+
+    alignment_cache = None
+    if use_alignment_cache:
+        alignment_cache = ensembler.alignment.AlignmentCache(
+            os.path.join(ensembler.core.default_project_dirnames.models, ensembler.core.alignment_cache_filename)
+        )
+
     for target in targets:
         if process_only_these_targets and target.id not in process_only_these_targets: continue
 
@@ -313,38 +348,125 @@ def align_targets_and_templates(process_only_these_targets=None, process_only_th
         models_target_dir = os.path.join(ensembler.core.default_project_dirnames.models, target.id)
         ensembler.utils.create_dir(models_target_dir)
 
-        seq_identity_data_sublist = []
-
+        selected_templates = []
+        selected_template_indices = []
         for template_index in range(mpistate.rank, ntemplates, mpistate.size):
             template = templates_full_seq[template_index]
             if not os.path.exists(os.path.join(ensembler.core.default_project_dirnames.templates_structures_modeled_loops, template.id + '.pdb')):
                 template = templates_resolved_seq[template_index]
 
             if process_only_these_templates and template.id not in process_only_these_templates: continue
+            selected_templates.append(template)
+            selected_template_indices.append(template_index)
 
+        aln_results, new_cache_entries = align_target_against_templates(
+            target, selected_templates, template_seqid_cutoff=template_seqid_cutoff,
+            alignment_cache=alignment_cache
+        )
+
+        seq_identity_data_sublist = []
+
+        for template_index, template, aln_result in zip(selected_template_indices, selected_templates, aln_results):
+            if aln_result is None:
+                continue
+            aln, seq_identity = aln_result
             model_dir = os.path.abspath(os.path.join(ensembler.core.default_project_dirnames.models, target.id, template.id))
             ensembler.utils.create_dir(model_dir)
-            aln = align_target_template(target, template)
             aln_filepath = os.path.join(model_dir, 'alignment.pir')
             write_modeller_pir_aln_file(aln, target, template, pir_aln_filepath=aln_filepath)
             seq_identity_data_sublist.append({
+                'template_index': template_index,
                 'templateid': template.id,
-                'seq_identity': calculate_seq_identity(aln),
+                'seq_identity': seq_identity,
             })
 
         seq_identity_data_gathered = mpistate.comm.gather(seq_identity_data_sublist, root=0)
+        new_cache_entries_gathered = mpistate.comm.gather(new_cache_entries, root=0)
 
         seq_identity_data = []
         if mpistate.rank == 0:
-            seq_identity_data = [None] * nselected_templates
-            for i in range(nselected_templates):
-                seq_identity_data[i] = seq_identity_data_gathered[i % mpistate.size][i // mpistate.size]
+            # Restore template order before sorting, so that ties are listed in the same order
+            # regardless of the number of MPI ranks
+            seq_identity_data = [x for sublist in seq_identity_data_gathered for x in sublist]
+            seq_identity_data = sorted(seq_identity_data, key=lambda x: x['template_index'])
+            # Only rank 0 writes to the cache (before the bcast, so other ranks never read during a write)
+            if alignment_cache is not None:
+                alignment_cache.add_many([x for sublist in new_cache_entries_gathered for x in sublist])
 
         seq_identity_data = mpistate.comm.bcast(seq_identity_data, root=0)
 
         seq_identity_data = sorted(seq_identity_data, key=lambda x: x['seq_identity'], reverse=True)
         write_sorted_seq_identities(target, seq_identity_data)
 
+    if alignment_cache is not None:
+        alignment_cache.close()
+
+
+def align_target_against_templates(target, templates, template_seqid_cutoff=None, alignment_cache=None):
+    """
+    Align a target against a list of templates, using cached alignments where available.
+
+    :param target: BioPython SeqRecord
+    :param templates: list of BioPython SeqRecord
+    :param template_seqid_cutoff: float
+    :param alignment_cache: ensembler.alignment.AlignmentCache
+    :return: aln_results: list of (aln, seq_identity) tuples, with None for templates which do not
+        pass template_seqid_cutoff
+    :return: new_cache_entries: list of ensembler.alignment.AlignmentCacheEntry
+    """
+    template_seqs = [str(template.seq) for template in templates]
+    if alignment_cache is not None:
+        cache_entries = alignment_cache.get_many(target.seq, template_seqs)
+    else:
+        cache_entries = [None] * len(templates)
+
+    aln_results = [None] * len(templates)
+    new_cache_entries = []
+    to_align = []
+    for i, cache_entry in enumerate(cache_entries):
+        if cache_entry is None:
+            to_align.append(i)
+        elif cache_entry.aligned_target is not None:
+            aln_results[i] = (ensembler.alignment.aln_from_cache_entry(cache_entry), cache_entry.seq_identity)
+        elif template_seqid_cutoff and not cache_entry.seq_identity_upper_bound > template_seqid_cutoff:
+            continue
+        else:
+            to_align.append(i)
+    logger.debug('MPI rank %d: %d/%d alignments for target %s found in cache' % (mpistate.rank, len(templates) - len(to_align), len(templates), target.id))
+
+    if template_seqid_cutoff:
+        scores, seqid_upper_bounds = ensembler.alignment.calculate_seq_identity_upper_bounds(
+            target.seq, [template_seqs[i] for i in to_align]
+        )
+        passed = []
+        for i, score, seqid_upper_bound in zip(to_align, scores, seqid_upper_bounds):
+            if seqid_upper_bound > template_seqid_cutoff:
+                passed.append(i)
+            elif alignment_cache is not None:
+                new_cache_entries.append(ensembler.alignment.AlignmentCacheEntry(
+                    alignment_cache.key(target.seq, template_seqs[i]), None, None, float(score), None, float(seqid_upper_bound)
+                ))
+        logger.debug('MPI rank %d: %d/%d templates passed the score-only pass for target %s' % (mpistate.rank, len(passed), len(to_align), target.id))
+        to_align = passed
+
+    # Align the target against the remaining templates, in blocks
+    alns = ensembler.alignment.align_target_templates(target.seq, [template_seqs[i] for i in to_align])
+
+    for i, aln in zip(to_align, alns):
+        seq_identity = calculate_seq_identity(aln)
+        aln_results[i] = (aln, seq_identity)
+        if alignment_cache is not None:
+            new_cache_entries.append(ensembler.alignment.AlignmentCacheEntry(
+                alignment_cache.key(target.seq, template_seqs[i]), aln[0][0], aln[0][1], float(aln[0][2]), seq_identity, seq_identity
+            ))
+
+    if template_seqid_cutoff:
+        for i, aln_result in enumerate(aln_results):
+            if aln_result is not None and not aln_result[1] > template_seqid_cutoff:
+                aln_results[i] = None
+
+    return aln_results, new_cache_entries
+
 
 def align_target_template(target, template, gap_open=-10, gap_extend=-0.5):
     """
@@ -354,8 +476,9 @@ def align_target_template(target, template, gap_open=-10, gap_extend=-0.5):
     :param gap_extend: float or int
     :return: alignment
     """
-    matrix = Bio.SubsMat.MatrixInfo.gonnet
-    aln = Bio.pairwise2.align.globalds(str(target.seq), str(template.seq), matrix, gap_open, gap_extend)
+    aln = ensembler.alignment.align_target_templates(
+        target.seq, [template.seq], matrix='gonnet', gap_open=gap_open, gap_extend=gap_extend
+    )[0]
     return aln
 
 
@@ -380,49 +503,67 @@ def write_sorted_seq_identities(target, seq_identity_data):
 
 @ensembler.utils.notify_when_done
 def build_models(process_only_these_targets=None, process_only_these_templates=None,
-                 template_seqid_cutoff=None, write_modeller_restraints_file=False, loglevel=None):
+                 template_seqid_cutoff=None, write_modeller_restraints_file=False,
+                 nmodeller_workers=1, write_coordinate_store=False, loglevel=None):
     """Uses the build_model method to build homology models for a given set of
     targets and templates.
 
-    MPI-enabled.
+    MPI-enabled. Each MPI rank builds up to nmodeller_workers models concurrently.
+
+    If write_coordinate_store is True, models are also added to a per-target coordinate store
+    (see ensembler.coordinate_store.CoordinateStore).
     """
-    # Note that this code uses an os.chdir call to switch into a temp directory before running Modeller.
-    # This is because Modeller writes various output files in the current directory, and there is NO WAY
-    # to define where these files are written, other than to chdir beforehand. If running this routine
-    # in parallel, it is likely that occasional exceptions will occur, due to concurrent processes
-    # making os.chdir calls.
+    # Modeller writes various output files in the current directory, and there is no way to define
+    # where these files are written, other than to chdir beforehand. Models are therefore built by
+    # a pool of Modeller worker processes (see ModellerWorkerPool), each of which runs in its own
+    # scratch directory. The pool is started first, as worker processes cannot be forked once MPI
+    # has been initialized.
     ensembler.utils.loglevel_setter(logger, loglevel)
-    targets, templates_resolved_seq, templates_full_seq = get_targets_and_templates()
+    with ModellerWorkerPool(nworkers=nmodeller_workers) as modeller_pool:
+        targets, templates_resolved_seq, templates_full_seq = get_targets_and_templates()
 
-    if process_only_these_templates:
-        selected_template_indices = [i for i, seq in enumerate(templates_resolved_seq) if seq.id in process_only_these_templates]
-    else:
-        selected_template_indices = range(len(templates_resolved_seq))
-
-    for target in targets:
-        if process_only_these_targets and target.id not in process_only_these_targets: continue
-        target_setup_data = build_models_target_setup(target)
-
-        if template_seqid_cutoff:
-            process_only_these_templates = ensembler.core.select_templates_by_seqid_cutoff(target.id, seqid_cutoff=template_seqid_cutoff)
+        if process_only_these_templates:
             selected_template_indices = [i for i, seq in enumerate(templates_resolved_seq) if seq.id in process_only_these_templates]
-
-        ntemplates_selected = len(selected_template_indices)
-
-        for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
-            template_resolved_seq = templates_resolved_seq[selected_template_indices[template_index]]
-            template_full_seq = templates_full_seq[selected_template_indices[template_index]]
-            if process_only_these_templates and template_resolved_seq.id not in process_only_these_templates: continue
-            build_model(target, template_resolved_seq, template_full_seq, target_setup_data,
-                        write_modeller_restraints_file=write_modeller_restraints_file,
-                        loglevel=loglevel)
-        write_build_models_metadata(target, target_setup_data, process_only_these_targets,
-                                    process_only_these_templates, template_seqid_cutoff,
-                                    write_modeller_restraints_file)
+        else:
+            selected_template_indices = range(len(templates_resolved_seq))
+
+        for target in targets:
+            if process_only_these_targets and target.id not in process_only_these_targets: continue
+            target_setup_data = build_models_target_setup(target)
+
+            if template_seqid_cutoff:
+                process_only_these_templates = ensembler.core.select_templates_by_seqid_cutoff(target.id, seqid_cutoff=template_seqid_cutoff)
+                selected_template_indices = [i for i, seq in enumerate(templates_resolved_seq) if seq.id in process_only_these_templates]
+
+            ntemplates_selected = len(selected_template_indices)
+
+            def expected_build_model_cost(template_index):
+                template_resolved_seq = templates_resolved_seq[selected_template_indices[template_index]]
+                model_dir = os.path.join(target_setup_data.models_target_dir, template_resolved_seq.id)
+                if os.path.exists(os.path.join(model_dir, 'model.pdb.gz')) or not os.path.exists(os.path.join(model_dir, 'alignment.pir')):
+                    return 0
+                return len(templates_full_seq[selected_template_indices[template_index]].seq)
+
+            for template_index in mpistate.iter_tasks(range(ntemplates_selected), key=expected_build_model_cost):
+                template_resolved_seq = templates_resolved_seq[selected_template_indices[template_index]]
+                template_full_seq = templates_full_seq[selected_template_indices[template_index]]
+                if process_only_these_templates and template_resolved_seq.id not in process_only_these_templates: continue
+                build_model(target, template_resolved_seq, template_full_seq, target_setup_data,
+                            write_modeller_restraints_file=write_modeller_restraints_file,
+                            modeller_pool=modeller_pool, loglevel=loglevel)
+            modeller_pool.wait()
+            if write_coordinate_store:
+                ensembler.coordinate_store.update_coordinate_store(
+                    target_setup_data.models_target_dir, 'build_models',
+                    [templates_resolved_seq[template_index].id for template_index in selected_template_indices]
+                )
+            write_build_models_metadata(target, target_setup_data, process_only_these_targets,
+                                        process_only_these_templates, template_seqid_cutoff,
+                                        write_modeller_restraints_file)
 
 
 def build_model(target, template_resolved_seq, template_full_seq, target_setup_data,
-                write_modeller_restraints_file=False, loglevel=None):
+                write_modeller_restraints_file=False, modeller_pool=None, loglevel=None):
     """Uses Modeller to build a homology model for a given target and
     template.
 
@@ -441,6 +582,10 @@ def build_model(target, template_resolved_seq, template_full_seq, target_setup_d
     write_modeller_restraints_file : bool
         Write file containing restraints used by Modeller - note that this file can be relatively
         large, e.g. ~300KB per model for a protein kinase domain target.
+    modeller_pool : ModellerWorkerPool
+        If given, the model is submitted to this pool, and may still be in progress when this
+        function returns (see ModellerWorkerPool.wait). Otherwise the model is built in the calling
+        process (see build_in_scratch_dir).
     loglevel : bool
     """
     ensembler.utils.loglevel_setter(logger, loglevel)
@@ -452,13 +597,15 @@ def build_model(target, template_resolved_seq, template_full_seq, target_setup_d
         template = template_resolved_seq
 
     model_dir = os.path.abspath(os.path.join(target_setup_data.models_target_dir, template.id))
-    if not os.path.exists(model_dir):
-        ensembler.utils.create_dir(model_dir)
+    aln_filepath = os.path.abspath(os.path.join(model_dir, 'alignment.pir'))
+    if not os.path.exists(aln_filepath):
+        # e.g. alignment was skipped due to the align command's template_seqid_cutoff
+        logger.debug("No alignment file found for target '%s' // template '%s'; skipping." % (target.id, template.id))
+        return
     model_pdbfilepath = os.path.abspath(os.path.join(model_dir, 'model.pdb.gz'))
     modeling_log_filepath = os.path.abspath(os.path.join(model_dir, 'modeling-log.yaml'))
 
     check_model_pdbfilepath_ends_in_pdbgz(model_pdbfilepath)
-    model_pdbfilepath_uncompressed = model_pdbfilepath[:-3]
 
     if check_all_model_files_present(model_dir):
         logger.debug("Output files already exist for target '%s' // template '%s'; files were not overwritten." % (target.id, template.id))
@@ -472,24 +619,260 @@ def build_model(target, template_resolved_seq, template_full_seq, target_setup_d
     )
 
     # aln = align_target_template(target, template)
-    aln_filepath = os.path.abspath(os.path.join(model_dir, 'alignment.pir'))
     # write_modeller_pir_aln_file(aln, target, template, pir_aln_filepath=aln_filepath)
     log_file = init_build_model_logfile(modeling_log_filepath)
 
-    with ensembler.utils.enter_temp_dir():
-        try:
-            start = datetime.datetime.utcnow()
-            shutil.copy(aln_filepath, 'alignment.pir')
-            run_modeller(target, template, model_dir, model_pdbfilepath,
-                         model_pdbfilepath_uncompressed, template_structure_dir,
-                         write_modeller_restraints_file=write_modeller_restraints_file)
-            if os.path.getsize(model_pdbfilepath) < 1:
-                raise Exception('Output PDB file is empty.')
+    build_request = ModellerBuildRequest(
+        target_id=target.id,
+        template_id=template.id,
+        model_dir=model_dir,
+        aln_filepath=aln_filepath,
+        model_pdbfilepath=model_pdbfilepath,
+        template_structure_dir=template_structure_dir,
+        write_modeller_restraints_file=write_modeller_restraints_file,
+        log_file=log_file,
+    )
+
+    if modeller_pool is not None:
+        modeller_pool.submit(build_request)
+    else:
+        build_in_scratch_dir(build_request)
+
+
+class ModellerWorkerPool(object):
+    """Pool of worker processes which build Modeller models.
+
+    Modeller writes its output files to the current directory. Each worker process therefore
+    changes into its own scratch directory once, on startup, so models can be built concurrently
+    without os.chdir calls in the calling process. Each worker also sets up a single
+    modeller.environ, which is reused for every model it builds. The scratch directories are
+    created, and removed on close, by the calling process, so they are also removed if the workers
+    have to be terminated.
+
+    Each request is sent to an idle worker. submit blocks while all workers are busy, so that
+    tasks are not taken from the MPI task queue (see MPIState.iter_tasks) before they can be
+    started. A worker which dies (e.g. from a segfault in Modeller) is replaced, and its model is
+    reported as unsuccessful.
+
+    Worker processes cannot be forked once MPI has been initialized. In that case, or if nworkers
+    is 0, models are instead built in the calling process when submitted (see
+    build_in_scratch_dir). Likewise, dead workers are not replaced once MPI has been initialized,
+    and models are built in the calling process once no workers remain.
+
+    Parameters
+    ----------
+    nworkers : int
+
+    Examples
+    --------
+    >>> with ModellerWorkerPool(nworkers=4) as modeller_pool:
+    ...     for template in templates:
+    ...         build_model(target, template, template, target_setup_data, modeller_pool=modeller_pool)
+    ...     successful = modeller_pool.wait()
+    """
+    poll_interval = 10
+
+    def __init__(self, nworkers=1):
+        if nworkers > 0 and ensembler.core.mpi_initialized():
+            logger.warning('MPI has already been initialized, so models will be built without Modeller worker processes.')
+            nworkers = 0
+        self._result_queue = multiprocessing.Queue()
+        self._workers = []
+        self._busy_workers = {}
+        self._results = []
+        for worker_index in range(nworkers):
+            self._workers.append(self._start_worker(worker_index))
+
+    def _start_worker(self, worker_index):
+        scratch_dir = tempfile.mkdtemp(prefix='ensembler-modeller-')
+        request_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_modeller_worker, args=(worker_index, scratch_dir, request_queue, self._result_queue))
+        process.daemon = True
+        process.start()
+        return ModellerWorker(process=process, scratch_dir=scratch_dir, request_queue=request_queue)
+
+    def submit(self, build_request):
+        """
+        Parameters
+        ----------
+        build_request : ModellerBuildRequest
+        """
+        request_index = len(self._results)
+        self._results.append(None)
+        while True:
+            idle_worker_indices = [
+                worker_index for worker_index, worker in enumerate(self._workers)
+                if worker is not None and worker_index not in self._busy_workers
+            ]
+            if len(idle_worker_indices) > 0 or len(self._busy_workers) == 0:
+                break
+            self._wait_for_result()
+        if len(idle_worker_indices) == 0:
+            self._results[request_index] = build_in_scratch_dir(build_request)
+            return
+        worker_index = idle_worker_indices[0]
+        self._workers[worker_index].request_queue.put(build_request)
+        self._busy_workers[worker_index] = request_index
+
+    def wait(self):
+        """Wait until all submitted models have been built.
+
+        Returns
+        -------
+        successful : list of bool
+            Whether each model submitted since the previous call to wait was built successfully,
+            in the order submitted.
+        """
+        while len(self._busy_workers) > 0:
+            self._wait_for_result()
+        results = self._results
+        self._results = []
+        return results
+
+    def _wait_for_result(self):
+        while True:
+            try:
+                worker_index, successful = self._result_queue.get(timeout=self.poll_interval)
+                self._results[self._busy_workers.pop(worker_index)] = successful
+                return
+            except Queue.Empty:
+                # A worker killed by e.g. a segfault in Modeller will never report back. Its
+                # model is left without a complete log, and will be attempted again next time.
+                for worker_index in sorted(self._busy_workers):
+                    worker = self._workers[worker_index]
+                    if worker.process.is_alive():
+                        continue
+                    logger.error('Modeller worker process %d exited unexpectedly (exit code %s)' % (worker.process.pid, worker.process.exitcode))
+                    self._results[self._busy_workers.pop(worker_index)] = False
+                    shutil.rmtree(worker.scratch_dir, ignore_errors=True)
+                    if ensembler.core.mpi_initialized():
+                        self._workers[worker_index] = None
+                    else:
+                        self._workers[worker_index] = self._start_worker(worker_index)
+                    return
+
+    def close(self):
+        self.wait()
+        workers = [worker for worker in self._workers if worker is not None]
+        for worker in workers:
+            worker.request_queue.put(None)
+        for worker in workers:
+            worker.process.join()
+        self._remove_scratch_dirs()
+
+    def terminate(self):
+        workers = [worker for worker in self._workers if worker is not None]
+        for worker in workers:
+            worker.process.terminate()
+        for worker in workers:
+            worker.process.join()
+        self._remove_scratch_dirs()
+
+    def _remove_scratch_dirs(self):
+        for worker in self._workers:
+            if worker is not None:
+                shutil.rmtree(worker.scratch_dir, ignore_errors=True)
+        self._workers = []
+        self._busy_workers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trbk):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+ModellerWorker = namedtuple('ModellerWorker', ['process', 'scratch_dir', 'request_queue'])
+
+
+def _modeller_worker(worker_index, scratch_dir, request_queue, result_queue):
+    os.chdir(scratch_dir)
+    env = get_modeller_env()
+    while True:
+        build_request = request_queue.get()
+        if build_request is None:
+            break
+        result_queue.put((worker_index, run_modeller_build_request(env, build_request)))
+        clear_directory(scratch_dir)
+
+
+_modeller_env = None
+
+
+def get_modeller_env():
+    """The modeller.environ for this process, which is set up on first use and reused for every
+    model built by the process.
+    """
+    global _modeller_env
+    if _modeller_env is None:
+        modeller.log.none()
+        _modeller_env = modeller.environ()
+    return _modeller_env
+
 
-            end_successful_build_model_logfile(log_file, start)
+def build_in_scratch_dir(build_request):
+    """Build a model in the calling process, in a temporary scratch directory (the current directory
+    is restored afterwards).
 
-        except Exception as e:
-            end_exception_build_model_logfile(e, log_file)
+    Parameters
+    ----------
+    build_request : ModellerBuildRequest
+
+    Returns
+    -------
+    successful : bool
+    """
+    cwd = os.getcwd()
+    scratch_dir = tempfile.mkdtemp(prefix='ensembler-modeller-')
+    try:
+        os.chdir(scratch_dir)
+        return run_modeller_build_request(get_modeller_env(), build_request)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch_dir)
+
+
+def clear_directory(dirpath):
+    for filename in os.listdir(dirpath):
+        filepath = os.path.join(dirpath, filename)
+        if os.path.isdir(filepath):
+            shutil.rmtree(filepath)
+        else:
+            os.remove(filepath)
+
+
+def run_modeller_build_request(env, build_request):
+    """Build a model in the current directory, recording the outcome in the modeling log file.
+
+    Parameters
+    ----------
+    env : modeller.environ
+    build_request : ModellerBuildRequest
+
+    Returns
+    -------
+    successful : bool
+    """
+    log_file = build_request.log_file
+    try:
+        start = datetime.datetime.utcnow()
+        shutil.copy(build_request.aln_filepath, 'alignment.pir')
+        run_modeller(build_request.target_id, build_request.template_id, build_request.model_dir,
+                     build_request.model_pdbfilepath, build_request.template_structure_dir,
+                     write_modeller_restraints_file=build_request.write_modeller_restraints_file,
+                     env=env)
+        if os.path.getsize(build_request.model_pdbfilepath) < 1:
+            raise Exception('Output PDB file is empty.')
+
+        end_successful_build_model_logfile(log_file, start)
+        return True
+
+    except Exception as e:
+        end_exception_build_model_logfile(e, log_file)
+        return False
 
 
 def get_modeller_version():
@@ -616,36 +999,34 @@ def write_modeller_pir_aln_file(aln, target, template, pir_aln_filepath='alignme
         outfile.write(contents)
 
 
-def run_modeller(target, template, model_dir, model_pdbfilepath, model_pdbfilepath_uncompressed,
+def run_modeller(target_id, template_id, model_dir, model_pdbfilepath,
                  template_structure_dir, aln_filepath='alignment.pir',
-                 write_modeller_restraints_file=False):
-    modeller.log.none()
-    env = modeller.environ()
+                 write_modeller_restraints_file=False, env=None):
+    if env is None:
+        env = get_modeller_env()
     env.io.atom_files_directory = [template_structure_dir]
     a = modeller.automodel.allhmodel(
         env,
         alnfile=aln_filepath,
-        knowns=template.id,
-        sequence=target.id
+        knowns=template_id,
+        sequence=target_id
     )
     a.make()  # do homology modeling
 
-    save_modeller_output_files(target, model_dir, a, env, model_pdbfilepath,
-                               model_pdbfilepath_uncompressed,
+    save_modeller_output_files(target_id, model_dir, a, env, model_pdbfilepath,
                                write_modeller_restraints_file=write_modeller_restraints_file)
 
 
-def save_modeller_output_files(target, model_dir, a, env, model_pdbfilepath,
-                               model_pdbfilepath_uncompressed,
+def save_modeller_output_files(target_id, model_dir, a, env, model_pdbfilepath,
                                write_modeller_restraints_file=False):
     # save PDB file
-    # Note that the uncompressed pdb file needs to be kept until after the clustering step has completed
+    # The model written by Modeller to the (scratch) working directory is streamed straight into
+    # the gzipped output file - no uncompressed copy is written to the model directory
     tmp_model_pdbfilepath = a.outputs[0]['name']
     target_model = modeller.model(env, file=tmp_model_pdbfilepath)
-    target_model.write(file=model_pdbfilepath_uncompressed)
-    with open(model_pdbfilepath_uncompressed) as model_pdbfile:
-        with gzip.open(model_pdbfilepath, 'w') as model_pdbfilegz:
-            model_pdbfilegz.write(model_pdbfile.read())
+    with open(tmp_model_pdbfilepath) as model_pdbfile:
+        with gzip.open(model_pdbfilepath, 'wb') as model_pdbfilegz:
+            shutil.copyfileobj(model_pdbfile, model_pdbfilegz)
 
     # Write sequence identity.
     seqid_filepath = os.path.abspath(os.path.join(model_dir, 'sequence-identity.txt'))
@@ -655,9 +1036,9 @@ def save_modeller_output_files(target, model_dir, a, env, model_pdbfilepath,
     # Copy restraints.
     if write_modeller_restraints_file:
         restraint_filepath = os.path.abspath(os.path.join(model_dir, 'restraints.rsr.gz'))
-        with open('%s.rsr' % target.id, 'r') as rsrfile:
+        with open('%s.rsr' % target_id, 'r') as rsrfile:
             with gzip.open(restraint_filepath, 'wb') as rsrgzfile:
-                rsrgzfile.write(rsrfile.read())
+                shutil.copyfileobj(rsrfile, rsrgzfile)
 
 
 def end_successful_build_model_logfile(log_file, start):
@@ -691,9 +1072,8 @@ def write_build_models_metadata(target, target_setup_data, process_only_these_ta
     project_metadata.write()
 
 
-@ensembler.utils.mpirank0only_and_end_with_barrier
 @ensembler.utils.notify_when_done
-def cluster_models(process_only_these_targets=None, cutoff=0.06, loglevel=None):
+def cluster_models(process_only_these_targets=None, cutoff=0.06, distributed=False, block_size=500, incremental=False, loglevel=None):
     '''Cluster models based on RMSD, and filter out non-unique models as
     determined by a given cutoff.
 
@@ -702,8 +1082,21 @@ def cluster_models(process_only_these_targets=None, cutoff=0.06, loglevel=None):
 
     cutoff : float
         Minimum distance cutoff for RMSD clustering (nm)
-
-    Runs serially.
+    distributed : bool
+        Distribute the RMSD calculations across MPI ranks, loading C-alpha coordinates in blocks of
+        block_size models (see models_distributed_regular_spatial_clustering). Otherwise the
+        clustering is done with MSMBuilder on rank 0, with all models loaded at once.
+    block_size : int
+        Number of models per block, in distributed or incremental mode. Bounds the number of models
+        held in memory (in addition to the cluster centers).
+    incremental : bool
+        Keep the existing clustering results, and compare only models which were not included in
+        the previous clustering run against the existing unique models, whose C-alpha coordinates
+        are cached in models/[target]/unique-models-CA.npz. Existing unique models are not
+        reconsidered. All models are clustered if no cache is available, if the cutoff differs from
+        that used previously, or if any previously clustered models have since been removed.
+
+    MPI-enabled if distributed or incremental is True; otherwise runs serially.
     '''
     # TODO refactor
     ensembler.utils.loglevel_setter(logger, loglevel)
@@ -728,47 +1121,87 @@ def cluster_models(process_only_these_targets=None, cutoff=0.06, loglevel=None):
         valid_templateids = []
         for t, template in enumerate(templates):
             model_dir = os.path.join(models_target_dir, template.id)
-            model_pdbfilename = os.path.join(model_dir, 'model.pdb')
+            model_pdbfilename = os.path.join(model_dir, 'model.pdb.gz')
             if not os.path.exists(model_pdbfilename):
-                model_pdbfilename_compressed = os.path.join(model_dir, 'model.pdb.gz')
-                if not os.path.exists(model_pdbfilename_compressed):
-                    continue
-                else:
-                    with gzip.open(model_pdbfilename_compressed) as model_pdbfile_compressed:
-                        with open(model_pdbfilename, 'w') as model_pdbfile:
-                            model_pdbfile.write(model_pdbfile_compressed.read())
+                continue
             model_pdbfilenames.append(model_pdbfilename)
             valid_templateids.append(template.id)
 
-        logger.info('Constructing a trajectory containing all valid models...')
+        clustering_cache = None
+        if incremental:
+            clustering_cache = read_clustering_cache(models_target_dir)
+            if clustering_cache is None:
+                logger.info('No clustering cache found for target %s; clustering all models.' % target.id)
+            elif clustering_cache['cutoff'] != cutoff:
+                logger.info('Cutoff differs from that of the cached clustering results for target %s (%.3f nm); clustering all models.' % (target.id, clustering_cache['cutoff']))
+                clustering_cache = None
+            elif not set(clustering_cache['templateids']).issubset(valid_templateids):
+                logger.info('Models have been removed since target %s was last clustered; clustering all models.' % target.id)
+                clustering_cache = None
+
+        unique_CA_xyz = None
+
+        if clustering_cache is not None:
+            clustered_templateids = set(clustering_cache['templateids'])
+            new_templateids = [templateid for templateid in valid_templateids if templateid not in clustered_templateids]
+            logger.info('Comparing %d new models against %d existing unique models...' % (len(new_templateids), len(clustering_cache['unique_templateids'])))
+            new_unique_templateids = models_distributed_regular_spatial_clustering(
+                models_target_dir, new_templateids, cutoff=cutoff, block_size=block_size,
+                centers_xyz=clustering_cache['unique_CA_xyz']
+            )
+            if mpistate.rank != 0:
+                continue
+            unique_templateids = clustering_cache['unique_templateids'] + new_unique_templateids
+            unique_CA_xyz = clustering_cache['unique_CA_xyz']
+            if len(new_unique_templateids) > 0:
+                unique_CA_xyz = np.concatenate([unique_CA_xyz, load_models_CA_xyz(models_target_dir, new_unique_templateids)])
+
+        elif distributed:
+            logger.info('Conducting distributed RMSD-based clustering...')
+            unique_templateids = models_distributed_regular_spatial_clustering(
+                models_target_dir, valid_templateids, cutoff=cutoff, block_size=block_size
+            )
+            if mpistate.rank != 0:
+                continue
 
-        traj = mdtraj.load(model_pdbfilenames)
+        elif mpistate.rank == 0:
+            logger.info('Constructing a trajectory containing all valid models...')
 
-        # =============================
-        # Clustering
-        # =============================
+            # Uses the coordinate store if available; otherwise mdtraj decompresses the gzipped models in memory
+            traj = ensembler.coordinate_store.load_models(models_target_dir, 'build_models', valid_templateids)
+
+            # =============================
+            # Clustering
+            # =============================
+
+            logger.info('Conducting RMSD-based clustering...')
+
+            CAatoms = [a.index for a in traj.topology.atoms if a.name == 'CA']
+            unique_templateids = models_regular_spatial_clustering(valid_templateids, traj, atom_indices=CAatoms, cutoff=cutoff)
 
-        logger.info('Conducting RMSD-based clustering...')
+            unique_traj = traj.atom_slice(CAatoms)[[valid_templateids.index(templateid) for templateid in unique_templateids]]
+            unique_traj.center_coordinates()
+            unique_CA_xyz = unique_traj.xyz
 
-        # Remove any existing unique_by_clustering files
-        for f in glob.glob( models_target_dir+'/*_PK_*/unique_by_clustering' ):
-            os.unlink(f)
+        else:
+            continue
+
+        if clustering_cache is None:
+            # Remove any existing unique_by_clustering files
+            for f in glob.glob( models_target_dir+'/*_PK_*/unique_by_clustering' ):
+                os.unlink(f)
 
-        CAatoms = [a.index for a in traj.topology.atoms if a.name == 'CA']
-        unique_templateids = models_regular_spatial_clustering(valid_templateids, traj, atom_indices=CAatoms, cutoff=cutoff)
         write_unique_by_clustering_files(unique_templateids, models_target_dir)
 
+        if unique_CA_xyz is None:
+            unique_CA_xyz = load_models_CA_xyz(models_target_dir, unique_templateids)
+        write_clustering_cache(models_target_dir, valid_templateids, unique_templateids, unique_CA_xyz, cutoff)
+
         with open(os.path.join(models_target_dir, 'unique-models.txt'), 'w') as uniques_file:
             for u in unique_templateids:
                 uniques_file.write(u+'\n')
             logger.info('%d unique models (from original set of %d) using cutoff of %.3f nm' % (len(unique_templateids), len(valid_templateids), cutoff))
 
-        for template in templates:
-            model_dir = os.path.join(models_target_dir, template.id)
-            model_pdbfilename = os.path.join(model_dir, 'model.pdb')
-            if os.path.exists(model_pdbfilename):
-                os.remove(model_pdbfilename)
-
         # ========
         # Metadata
         # ========
@@ -795,6 +1228,8 @@ def cluster_models(process_only_these_targets=None, cutoff=0.06, loglevel=None):
         project_metadata.add_data(metadata)
         project_metadata.write()
 
+    mpistate.comm.Barrier()
+
 
 def models_regular_spatial_clustering(templateids, traj, atom_indices=None, cutoff=0.06):
     """
@@ -814,11 +1249,176 @@ def models_regular_spatial_clustering(templateids, traj, atom_indices=None, cuto
         reduced_traj = traj
 
     cluster = msmbuilder.cluster.RegularSpatial(cutoff, metric='rmsd')
-    cluster_labels = cluster.fit_predict([reduced_traj])[0]
-    unique_templateids = list(set([templateids[t] for t in cluster_labels]))
+    cluster.fit([reduced_traj])
+    unique_templateids = [templateids[t] for t in cluster.cluster_center_indices_]
+    return unique_templateids
+
+
+def models_distributed_regular_spatial_clustering(models_target_dir, templateids, cutoff=0.06, block_size=500, centers_xyz=None):
+    """
+    Perform RMSD-based regular spatial clustering on a set of models, using C-alpha atoms only,
+    with the RMSD calculations distributed across MPI ranks.
+
+    Gives the same cluster centers as models_regular_spatial_clustering: models are considered in
+    the order given, and each becomes a new cluster center if its RMSD to every existing center is
+    greater than the cutoff. Models are processed in blocks of block_size. Each rank loads a
+    contiguous share of a block (reading only those frames, if the models are in the target's
+    coordinate store) and calculates the RMSDs of those models against the centers found so far;
+    models within the cutoff of any center are discarded, and the remaining candidates are then
+    resolved against each other in order on rank 0. Only the current block and the cluster centers
+    are held in memory.
+
+    MPI-enabled - must be called by all ranks.
+
+    Parameters
+    ----------
+    models_target_dir: str
+    templateids: list of str
+        IDs of templates for which build_models output files exist
+    cutoff: float
+        Minimum distance cutoff for RMSD clustering (nm)
+    block_size: int
+    centers_xyz: np.array, optional
+        Centered C-alpha coordinates of existing cluster centers, e.g. from a previous clustering
+        run (see load_models_CA_xyz), against which the models are also compared.
+
+    Returns
+    -------
+    unique_templateids: list of str
+        IDs of the templates whose models are new cluster centers, in the order given
+    """
+    if len(templateids) == 0:
+        return []
+
+    first_model = ensembler.coordinate_store.load_models(models_target_dir, 'build_models', templateids[:1])
+    CAatoms = first_model.topology.select('name CA')
+    topology = first_model.topology.subset(CAatoms)
+
+    unique_templateids = []
+    if centers_xyz is None or len(centers_xyz) == 0:
+        centers_xyz = np.zeros((0, len(CAatoms), 3), dtype=np.float32)
+    elif centers_xyz.shape[1] != len(CAatoms):
+        raise Exception('Existing cluster centers have %d C-alpha atoms, but models for %s have %d.' % (centers_xyz.shape[1], models_target_dir, len(CAatoms)))
+
+    for block_start in range(0, len(templateids), block_size):
+        block_templateids = templateids[block_start:block_start+block_size]
+        rank_block_indices = range(
+            len(block_templateids) * mpistate.rank // mpistate.size,
+            len(block_templateids) * (mpistate.rank + 1) // mpistate.size
+        )
+
+        rank_candidates = []
+        if len(rank_block_indices) > 0:
+            block_traj = ensembler.coordinate_store.load_models(
+                models_target_dir, 'build_models', [block_templateids[i] for i in rank_block_indices], atom_indices=CAatoms
+            )
+            block_traj.center_coordinates()
+            centers_traj = mdtraj.Trajectory(centers_xyz, topology)
+            for frame, block_index in enumerate(rank_block_indices):
+                if centers_traj.n_frames > 0:
+                    rmsds = mdtraj.rmsd(centers_traj, block_traj, frame=frame, precentered=True)
+                    if not np.all(rmsds > cutoff):
+                        continue
+                rank_candidates.append((block_index, block_traj.xyz[frame]))
+            del block_traj
+
+        gathered_candidates = mpistate.comm.gather(rank_candidates, root=0)
+
+        new_centers = None
+        if mpistate.rank == 0:
+            candidates = sorted([candidate for rank_candidates in gathered_candidates for candidate in rank_candidates], key=lambda candidate: candidate[0])
+            new_centers = []
+            for block_index, xyz in candidates:
+                if len(new_centers) > 0:
+                    new_centers_traj = mdtraj.Trajectory(np.array([center_xyz for center_index, center_xyz in new_centers]), topology)
+                    candidate_traj = mdtraj.Trajectory(np.array([xyz]), topology)
+                    rmsds = mdtraj.rmsd(new_centers_traj, candidate_traj, frame=0, precentered=True)
+                    if not np.all(rmsds > cutoff):
+                        continue
+                new_centers.append((block_index, xyz))
+        new_centers = mpistate.comm.bcast(new_centers, root=0)
+
+        for block_index, xyz in new_centers:
+            unique_templateids.append(block_templateids[block_index])
+        if len(new_centers) > 0:
+            centers_xyz = np.concatenate([centers_xyz, np.array([xyz for block_index, xyz in new_centers])])
+
+        logger.debug('Clustered %d/%d models; %d cluster centers so far' % (block_start + len(block_templateids), len(templateids), len(unique_templateids)))
+
     return unique_templateids
 
 
+def load_models_CA_xyz(models_target_dir, templateids):
+    """
+    Load the C-alpha coordinates of a set of models, each centered at the origin.
+
+    Parameters
+    ----------
+    models_target_dir: str
+    templateids: list of str
+
+    Returns
+    -------
+    CA_xyz: np.array
+        shape (len(templateids), n_CA_atoms, 3), dtype float32
+    """
+    if len(templateids) == 0:
+        return np.zeros((0, 0, 3), dtype=np.float32)
+    first_model = ensembler.coordinate_store.load_models(models_target_dir, 'build_models', templateids[:1])
+    CAatoms = first_model.topology.select('name CA')
+    traj = ensembler.coordinate_store.load_models(models_target_dir, 'build_models', templateids, atom_indices=CAatoms)
+    traj.center_coordinates()
+    return traj.xyz
+
+
+def read_clustering_cache(models_target_dir):
+    """
+    Read the results of the previous clustering run for a target, if available.
+
+    Returns
+    -------
+    clustering_cache: dict or None
+        {'templateids': list of str, 'unique_templateids': list of str, 'unique_CA_xyz': np.array, 'cutoff': float}
+    """
+    clustering_cache_filepath = os.path.join(models_target_dir, ensembler.core.clustering_cache_filename)
+    if not os.path.exists(clustering_cache_filepath):
+        return None
+    with open(clustering_cache_filepath, 'rb') as clustering_cache_file:
+        npz = np.load(clustering_cache_file)
+        clustering_cache = {
+            'templateids': [str(templateid) for templateid in npz['templateids']],
+            'unique_templateids': [str(templateid) for templateid in npz['unique_templateids']],
+            'unique_CA_xyz': npz['unique_CA_xyz'],
+            'cutoff': float(npz['cutoff']),
+        }
+    return clustering_cache
+
+
+def write_clustering_cache(models_target_dir, templateids, unique_templateids, unique_CA_xyz, cutoff):
+    """
+    Cache the results of a clustering run for a target, for use by subsequent incremental runs.
+
+    Parameters
+    ----------
+    models_target_dir: str
+    templateids: list of str
+        IDs of all templates whose models were clustered
+    unique_templateids: list of str
+    unique_CA_xyz: np.array
+        Centered C-alpha coordinates of the unique models, in the same order as unique_templateids
+    cutoff: float
+    """
+    clustering_cache_filepath = os.path.join(models_target_dir, ensembler.core.clustering_cache_filename)
+    with open(clustering_cache_filepath, 'wb') as clustering_cache_file:
+        np.savez(
+            clustering_cache_file,
+            templateids=np.array(templateids, dtype=str),
+            unique_templateids=np.array(unique_templateids, dtype=str),
+            unique_CA_xyz=np.array(unique_CA_xyz, dtype=np.float32),
+            cutoff=cutoff,
+        )
+
+
 def write_unique_by_clustering_files(unique_templateids, models_target_dir):
     for templateid in unique_templateids:
         unique_filename = os.path.join(models_target_dir, templateid, 'unique_by_clustering')
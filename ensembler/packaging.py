@@ -1,15 +1,33 @@
 import os
-import subprocess
+import io
+import re
+import sys
+import zlib
+import time
+import fnmatch
+import Queue
+import hashlib
+import tarfile
+import threading
+import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import yaml
 import numpy as np
+import Bio
 import ensembler
+import ensembler.version
+import ensembler.refinement
 from ensembler.core import mpistate, logger
 import simtk.unit as unit
 import simtk.openmm as openmm
+import simtk.openmm.version
 
 
 def package_for_fah(process_only_these_targets=None,
                     process_only_these_templates=None, template_seqid_cutoff=None,
-                    verbose=False, nclones=1, archive=False):
+                    verbose=False, nclones=1, archive=False, archive_compression='gzip',
+                    hmr=False, hydrogen_mass=4.0*unit.amu, deduplicate=True):
     '''Create the input files and directory structure necessary to start a Folding@Home project.
 
     MPI-enabled.
@@ -17,7 +35,39 @@ def package_for_fah(process_only_these_targets=None,
     Parameters
     ----------
     archive : Bool
-        A .tgz compressed archive will be created for each individual RUN directory.
+        A compressed archive will be created for each individual RUN directory, and an index of
+        the archive sizes and checksums written to [project_dir]/archive-index.yaml (see
+        RunArchiver).
+    archive_compression : str
+        gzip|zstd
+        gzip archives (RUN[n].tgz) are compressed in independent blocks, across multiple threads;
+        zstd archives (RUN[n].tar.zst) require the zstandard module.
+    hmr : Bool
+        Repartition hydrogen masses in the System (see
+        ensembler.refinement.repartition_hydrogen_mass), and use a 4 fs timestep in the Integrator.
+        Systems which were already repartitioned during refine_explicit_md are unaffected by the
+        repartitioning.
+    hydrogen_mass : simtk.unit.Quantity
+    deduplicate : Bool
+        Write system.xml and integrator.xml as hardlinks to content-addressed files in
+        [project_dir]/payloads (see write_deduplicated_file), so that identical files are stored
+        only once per project. The integrator is the same for every RUN, and Systems for models
+        with the same number of waters and box often are too. Files in existing RUNs are always
+        replaced rather than rewritten in place (see replace_file_contents), so that rebuilding
+        with deduplicate=False leaves the payloads and other RUNs unchanged.
+
+    Each RUN is recorded in [project_dir]/packaging-manifest.yaml (see
+    append_packaging_manifest_record), with its status, file checksums and timing. Each rank
+    appends the record as soon as the RUN is built, to a manifest file of its own, and rank 0
+    merges these into the project manifest once all RUNs for the target have been built (or on
+    rerun, after an interruption). On rerun, RUNs recorded as complete (for the same template,
+    number of clones, timestep, hydrogen mass and deduplication) are skipped, and RUNs which failed
+    or were not built are distributed across ranks. Complete RUNs are rearchived if their archive
+    is missing or was not written with the same compression.
+
+    The initial velocities of each clone are drawn from the Maxwell-Boltzmann distribution at
+    300 K, with the components along constrained bonds removed (see maxwell_boltzmann_velocities
+    and constrain_velocities), using a random seed determined by the RUN and CLONE indices.
     '''
     models_dir = ensembler.core.default_project_dirnames.models
     packaged_models_dir = ensembler.core.default_project_dirnames.packaged_models
@@ -34,143 +84,151 @@ def package_for_fah(process_only_these_targets=None,
     else:
         selected_template_indices = range(len(templates_resolved_seq))
 
-    def generateRun(run):
+    def generateRun(run, skip_existing=True):
         """
         Build Folding@Home RUN and CLONE subdirectories from (possibly compressed) OpenMM serialized XML files.
 
         ARGUMENTS
 
         run (int) - run index
+        skip_existing (bool) - if False, any existing files in the RUN directory are overwritten
         """
 
         if verbose: print "Building RUN %d" % run
-     
-        try:
-            import os, shutil
-            import gzip
-            
-            # Determine directory and pathnames.
-            rundir = os.path.join(project_dir, 'RUN%d' % run)
-            template_filename = os.path.join(rundir, 'template.txt')
-            seqid_filename = os.path.join(rundir, 'sequence-identity.txt')
-            system_filename = os.path.join(rundir, 'system.xml')
-            integrator_filename = os.path.join(rundir, 'integrator.xml')
-            protein_structure_filename = os.path.join(rundir, 'protein.pdb')
-            system_structure_filename = os.path.join(rundir, 'system.pdb')
-            final_state_filename = os.path.join(rundir, 'state%d.xml' % (nclones - 1))
-            protein_structure_gz_filename_source = os.path.join(source_dir, 'implicit-refined.pdb.gz')
-            system_structure_gz_filename_source = os.path.join(source_dir, 'explicit-refined.pdb.gz')
-
-            # Return if this directory has already been set up.
-            if os.path.exists(rundir): 
-                if os.path.exists(template_filename)\
-                        and os.path.exists(seqid_filename)\
-                        and os.path.exists(system_filename)\
-                        and os.path.exists(integrator_filename)\
-                        and os.path.exists(protein_structure_filename)\
-                        and os.path.exists(system_structure_filename)\
-                        and os.path.exists(final_state_filename):
-                    return
+
+        import os, shutil
+        import gzip
+        
+        # Determine directory and pathnames.
+        rundir = os.path.join(project_dir, 'RUN%d' % run)
+        template_filename = os.path.join(rundir, 'template.txt')
+        seqid_filename = os.path.join(rundir, 'sequence-identity.txt')
+        system_filename = os.path.join(rundir, 'system.xml')
+        integrator_filename = os.path.join(rundir, 'integrator.xml')
+        protein_structure_filename = os.path.join(rundir, 'protein.pdb')
+        system_structure_filename = os.path.join(rundir, 'system.pdb')
+        final_state_filename = os.path.join(rundir, 'state%d.xml' % (nclones - 1))
+        protein_structure_gz_filename_source = os.path.join(source_dir, 'implicit-refined.pdb.gz')
+        system_structure_gz_filename_source = os.path.join(source_dir, 'explicit-refined.pdb.gz')
+
+        # Return if this directory has already been set up.
+        if os.path.exists(rundir):
+            if skip_existing\
+                    and os.path.exists(template_filename)\
+                    and os.path.exists(seqid_filename)\
+                    and os.path.exists(system_filename)\
+                    and os.path.exists(integrator_filename)\
+                    and os.path.exists(protein_structure_filename)\
+                    and os.path.exists(system_structure_filename)\
+                    and os.path.exists(final_state_filename):
+                return
+        else:
+            # Construct run directory if it does not exist.
+            if not os.path.exists(rundir):
+                os.makedirs(rundir)
+
+        # Write template information.
+        [filepath, template_name] = os.path.split(source_dir)
+        with open(template_filename, 'w') as outfile:
+            outfile.write(template_name + '\n')
+
+        # Write the protein and system structure pdbs (streamed, rather than read into memory)
+        with gzip.open(protein_structure_gz_filename_source) as protein_structure_file_source:
+            with open(protein_structure_filename, 'w') as protein_structure_file:
+                shutil.copyfileobj(protein_structure_file_source, protein_structure_file)
+
+        with gzip.open(system_structure_gz_filename_source) as system_structure_file_source:
+            with open(system_structure_filename, 'w') as system_structure_file:
+                shutil.copyfileobj(system_structure_file_source, system_structure_file)
+
+        # Read system, integrator, and state.
+        def readFileContents(filename):
+            fullpath = os.path.join(source_dir, filename)
+
+            if os.path.exists(fullpath):
+                infile = open(fullpath, 'r')
+            elif os.path.exists(fullpath+'.gz'):
+                infile = gzip.open(fullpath+'.gz', 'r')
             else:
-                # Construct run directory if it does not exist.
-                if not os.path.exists(rundir):
-                    os.makedirs(rundir)
-
-            # Write template information.
-            [filepath, template_name] = os.path.split(source_dir)
-            with open(template_filename, 'w') as outfile:
-                outfile.write(template_name + '\n')
-
-            # Write the protein and system structure pdbs
-            with gzip.open(protein_structure_gz_filename_source) as protein_structure_file_source:
-                with open(protein_structure_filename, 'w') as protein_structure_file:
-                    protein_structure_file.write(protein_structure_file_source.read())
-
-            with gzip.open(system_structure_gz_filename_source) as system_structure_file_source:
-                with open(system_structure_filename, 'w') as system_structure_file:
-                    system_structure_file.write(system_structure_file_source.read())
-
-            # Read system, integrator, and state.
-            def readFileContents(filename):
-                fullpath = os.path.join(source_dir, filename)
-
-                if os.path.exists(fullpath):
-                    infile = open(fullpath, 'r')
-                elif os.path.exists(fullpath+'.gz'):
-                    infile = gzip.open(fullpath+'.gz', 'r')
-                else:
-                    import ipdb; ipdb.set_trace()
-                    raise IOError('File %s not found' % filename)
-
-                contents = infile.read()
-                infile.close()
-                return contents
-
-            def writeFileContents(filepath, contents):
-                with open(filepath, 'w') as outfile:
-                    outfile.write(contents)
-
-            system = openmm.XmlSerializer.deserialize(readFileContents('explicit-system.xml'))
-            state = openmm.XmlSerializer.deserialize(readFileContents('explicit-state.xml'))
-
-            # Substitute default box vectors.
-            box_vectors = state.getPeriodicBoxVectors()
-            system.setDefaultPeriodicBoxVectors(*box_vectors)
-
-            # Write sequence identity.
-            contents = readFileContents('sequence-identity.txt')
-            writeFileContents(seqid_filename, contents)
-
-            # Integrator settings.
-            constraint_tolerance = 1.0e-5 
-            timestep = 2.0 * unit.femtoseconds
-            collision_rate = 1.0 / unit.picosecond
-            temperature = 300.0 * unit.kelvin
-
-            # Create new integrator to use.
-            integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
-            
-            # TODO: Make sure MonteCarloBarostat temperature matches set temperature.
-
-            # Serialize System.
-            writeFileContents(system_filename, openmm.XmlSerializer.serialize(system))
-
-            # Serialize Integrator
-            writeFileContents(integrator_filename, openmm.XmlSerializer.serialize(integrator))
-
-            # Create Context so we can randomize velocities.
-            platform = openmm.Platform.getPlatformByName('Reference')
-            context = openmm.Context(system, integrator, platform)
-            context.setPositions(state.getPositions())
-            context.setVelocities(state.getVelocities())
-            box_vectors = state.getPeriodicBoxVectors()
-            context.setPeriodicBoxVectors(*box_vectors)
-
-            # Create clones with different random initial velocities.
-            for clone_index in range(nclones):
-                state_filename = os.path.join(rundir, 'state%d.xml' % clone_index)
-                if os.path.exists(state_filename):
-                    continue
-                context.setVelocitiesToTemperature(temperature)
-                state = context.getState(getPositions=True, getVelocities=True, getForces=True, getEnergy=True, getParameters=True, enforcePeriodicBox=True)
-                writeFileContents(state_filename, openmm.XmlSerializer.serialize(state))
+                raise IOError('File %s not found' % filename)
+
+            contents = infile.read()
+            infile.close()
+            return contents
+
+        def writeFileContents(filepath, contents):
+            # Replaced rather than modified in place, since filepath may be a hardlink to a
+            # payload written with deduplicate=True
+            replace_file_contents(filepath, contents)
+
+        def writeSharedFileContents(filepath, contents):
+            # Identical payloads (e.g. integrator.xml) are stored once per project
+            if deduplicate:
+                write_deduplicated_file(filepath, contents, os.path.join(project_dir, payloads_dirname))
+            else:
+                writeFileContents(filepath, contents)
 
-            # Clean up.
-            del context, integrator, state, system
+        system = openmm.XmlSerializer.deserialize(readFileContents('explicit-system.xml'))
+        state_xml = readFileContents('explicit-state.xml')
+        state = openmm.XmlSerializer.deserialize(state_xml)
 
-        except Exception as e:
-            import traceback
-            print traceback.format_exc()
-            print str(e)    
+        # Substitute default box vectors.
+        box_vectors = state.getPeriodicBoxVectors()
+        system.setDefaultPeriodicBoxVectors(*box_vectors)
 
-        return
+        # Write sequence identity.
+        contents = readFileContents('sequence-identity.txt')
+        writeFileContents(seqid_filename, contents)
 
+        if hmr:
+            ensembler.refinement.repartition_hydrogen_mass(system, hydrogen_mass=hydrogen_mass)
 
-    def archiveRun():
-        archive_filename = os.path.join(project_dir, 'RUN%d.tgz' % run_index)
-        run_dir = os.path.join(project_dir, 'RUN%d' % run_index)
-        subprocess.call(['tar', 'zcf', archive_filename, run_dir])
+        # Integrator settings.
+        constraint_tolerance = 1.0e-5 
+        timestep = fah_timestep
+        collision_rate = 1.0 / unit.picosecond
+        temperature = 300.0 * unit.kelvin
 
+        # Create new integrator to use.
+        integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
+        
+        # TODO: Make sure MonteCarloBarostat temperature matches set temperature.
+
+        # Serialize System.
+        writeSharedFileContents(system_filename, openmm.XmlSerializer.serialize(system))
+
+        # Serialize Integrator
+        writeSharedFileContents(integrator_filename, openmm.XmlSerializer.serialize(integrator))
+
+        # Create clones with different random initial velocities, drawn directly from the
+        # Maxwell-Boltzmann distribution, without the need for a Context.
+        masses = np.array([system.getParticleMass(particle_index) / unit.amu for particle_index in range(system.getNumParticles())])
+        positions = state.getPositions(asNumpy=True) / unit.nanometers
+        box_lengths = np.diag(state.getPeriodicBoxVectors(asNumpy=True) / unit.nanometers)
+        constraint_batches = batch_constraints(system, masses)
+        for clone_index in range(nclones):
+            state_filename = os.path.join(rundir, 'state%d.xml' % clone_index)
+            if skip_existing and os.path.exists(state_filename):
+                continue
+            random_state = np.random.RandomState([run, clone_index])
+            velocities = maxwell_boltzmann_velocities(masses, temperature, random_state)
+            constrain_velocities(velocities, positions, masses, constraint_batches, box_lengths=box_lengths)
+            writeFileContents(state_filename, replace_state_velocities(state_xml, velocities, masses))
+
+        # Clean up.
+        del integrator, state, system
+
+
+
+    if hmr:
+        fah_timestep = 4.0 * unit.femtoseconds
+    else:
+        fah_timestep = 2.0 * unit.femtoseconds
+
+    if archive:
+        # Each rank compresses with the CPUs in its share of the node
+        narchive_threads = len(mpistate.node_cpu_share())
+        run_archiver = RunArchiver(compression=archive_compression, nthreads=narchive_threads)
 
     for target in targets:
 
@@ -178,8 +236,7 @@ def package_for_fah(process_only_these_targets=None,
         if process_only_these_targets and (target.id not in process_only_these_targets): continue
 
         models_target_dir = os.path.join(models_dir, target.id)
-        if mpistate.rank == 0:
-            if not os.path.exists(models_target_dir): continue
+        if not os.path.exists(models_target_dir): continue
 
         mpistate.comm.Barrier()
 
@@ -194,7 +251,7 @@ def package_for_fah(process_only_these_targets=None,
 
         # Process all templates.
         if verbose: print "Building list of valid templates..."
-        valid_templates = list()
+        valid_template_indices = list()
 
         if template_seqid_cutoff:
             process_only_these_templates = ensembler.core.select_templates_by_seqid_cutoff(target.id, seqid_cutoff=template_seqid_cutoff)
@@ -219,7 +276,14 @@ def package_for_fah(process_only_these_targets=None,
 
             # Append if valid.
             if is_valid:
-                valid_templates.append(template)
+                valid_template_indices.append(selected_template_indices[template_index])
+
+        # Combine the valid templates found by each rank, in their original order
+        valid_template_indices = mpistate.comm.gather(valid_template_indices, root=0)
+        if mpistate.rank == 0:
+            valid_template_indices = sorted([index for rank_indices in valid_template_indices for index in rank_indices])
+        valid_template_indices = mpistate.comm.bcast(valid_template_indices, root=0)
+        valid_templates = [templates_resolved_seq[index] for index in valid_template_indices]
 
         nvalid = len(valid_templates)
         if verbose: print "%d valid unique initial starting conditions found" % nvalid
@@ -250,62 +314,1153 @@ def package_for_fah(process_only_these_targets=None,
         if mpistate.rank == 0:
             if not os.path.exists(project_dir):
                 os.makedirs(project_dir)
+            if deduplicate and not os.path.exists(os.path.join(project_dir, payloads_dirname)):
+                os.mkdir(os.path.join(project_dir, payloads_dirname))
 
         mpistate.comm.Barrier()
 
+        # ========
+        # Determine which RUNs need to be built, from the packaging manifest
+        # ========
+
+        run_parameters = {
+            'nclones': nclones,
+            'timestep': '%s' % fah_timestep,
+            'hydrogen_mass': '%s' % hydrogen_mass if hmr else None,
+            'deduplicate': deduplicate,
+            'archive_compression': archive_compression if archive else None,
+        }
+
+        if mpistate.rank == 0:
+            # Records left in the rank manifests by an interrupted run
+            merge_packaging_manifests(project_dir)
+            packaging_manifest = read_packaging_manifest(project_dir)
+            run_indices_to_build = []
+            rearchive_records = {}
+            for run_index, template in enumerate(valid_templates):
+                record = packaging_manifest.get(run_index)
+                if record is not None and record['status'] == 'complete'\
+                        and record['template'] == template.id\
+                        and record['nclones'] >= nclones\
+                        and record['timestep'] == run_parameters['timestep']\
+                        and record.get('hydrogen_mass') == run_parameters['hydrogen_mass']\
+                        and record.get('deduplicate') == deduplicate:
+                    if archive and (record.get('archive_compression') != archive_compression
+                                    or not os.path.exists(os.path.join(project_dir, 'RUN%d%s' % (run_index, archive_extensions[archive_compression])))):
+                        rearchive_records[run_index] = record
+                    continue
+                run_indices_to_build.append(run_index)
+            nfailed = len([run_index for run_index in run_indices_to_build if run_index in packaging_manifest and packaging_manifest[run_index]['status'] == 'failed'])
+            print "%d RUNs already built; %d RUNs to build (%d previously failed)" % (
+                len(valid_templates) - len(run_indices_to_build), len(run_indices_to_build), nfailed
+            )
+            # RUNs packaged before the manifest was introduced are skipped if their files exist
+            unrecorded_run_indices = [run_index for run_index in run_indices_to_build if run_index not in packaging_manifest]
+        else:
+            run_indices_to_build, rearchive_records, unrecorded_run_indices = None, None, None
+        run_indices_to_build, rearchive_records, unrecorded_run_indices = mpistate.comm.bcast(
+            (run_indices_to_build, rearchive_records, unrecorded_run_indices), root=0
+        )
+        unrecorded_run_indices = set(unrecorded_run_indices)
+
         # ========
         # Build runs in parallel
         # ========
 
         if verbose: print "Building RUNs in parallel..."
-        for run_index in range(mpistate.rank, len(valid_templates), mpistate.size):
-            print "-------------------------------------------------------------------------"
-            print "Building RUN for template %s" % valid_templates[run_index].id
-            print "-------------------------------------------------------------------------"
+        for run_index in mpistate.iter_tasks(run_indices_to_build + sorted(rearchive_records)):
+            if run_index not in rearchive_records:
+                print "-------------------------------------------------------------------------"
+                print "Building RUN for template %s" % valid_templates[run_index].id
+                print "-------------------------------------------------------------------------"
+
+                source_dir = os.path.join(models_target_dir, valid_templates[run_index].id)
+                start_time = time.time()
+                record = dict(run_parameters)
+                record.update({
+                    'run': run_index,
+                    'template': valid_templates[run_index].id,
+                    'rank': mpistate.rank,
+                })
+                try:
+                    generateRun(run_index, skip_existing=run_index in unrecorded_run_indices)
+                except Exception as e:
+                    logger.error('Failed to build RUN%d (template %s):\n%s' % (run_index, valid_templates[run_index].id, traceback.format_exc()))
+                    record.update({
+                        'status': 'failed',
+                        'error': '%s: %s' % (type(e).__name__, ' '.join(str(e).split())),
+                        'time': round(time.time() - start_time, 2),
+                        'datestamp': ensembler.core.get_utcnow_formatted(),
+                    })
+                    append_packaging_manifest_record(project_dir, record, rank=mpistate.rank)
+                    continue
+                rundir = os.path.join(project_dir, 'RUN%d' % run_index)
+                record.update({
+                    'status': 'complete',
+                    'checksums': dict([(filename, file_sha256(os.path.join(rundir, filename))) for filename in sorted(os.listdir(rundir))]),
+                    'time': round(time.time() - start_time, 2),
+                    'datestamp': ensembler.core.get_utcnow_formatted(),
+                })
+                append_packaging_manifest_record(project_dir, record, rank=mpistate.rank)
+            else:
+                # Recorded with the compression of the new archive
+                record = dict(rearchive_records[run_index])
+                record.update({
+                    'archive_compression': archive_compression,
+                    'rank': mpistate.rank,
+                    'datestamp': ensembler.core.get_utcnow_formatted(),
+                })
+                append_packaging_manifest_record(project_dir, record, rank=mpistate.rank)
 
-            source_dir = os.path.join(models_target_dir, valid_templates[run_index].id)
-            generateRun(run_index)
             if archive:
-                archiveRun()
-
-        # TODO - get this working
-
-        # if mpistate.rank == 0:
-        #
-        #     # ========
-        #     # Metadata
-        #     # ========
-        #
-        #     import sys
-        #     import yaml
-        #     import ensembler.version
-        #     import simtk.openmm.version
-        #     datestamp = ensembler.core.get_utcnow_formatted()
-        #
-        #     meta_filepath = os.path.join(models_target_dir, 'meta.yaml')
-        #     with open(meta_filepath) as meta_file:
-        #         metadata = yaml.load(meta_file, Loader=ensembler.core.YamlLoader)
-        #
-        #     metadata['package_for_fah'] = {
-        #         'target_id': target.id,
-        #         'datestamp': datestamp,
-        #         'python_version': sys.version.split('|')[0].strip(),
-        #         'python_full_version': ensembler.core.literal_str(sys.version),
-        #         'ensembler_version': ensembler.version.short_version,
-        #         'ensembler_commit': ensembler.version.git_revision,
-        #         'biopython_version': Bio.__version__,
-        #         'openmm_version': simtk.openmm.version.short_version,
-        #         'openmm_commit': simtk.openmm.version.git_revision
-        #     }
-        #
-        #     meta_filepath = os.path.join(project_dir, 'meta.yaml')
-        #     metadata = ensembler.core.ProjectMetadata(metadata)
-        #     metadata.write(meta_filepath)
+                # Archived in the background, while the next RUN is generated
+                run_archiver.submit(
+                    project_dir, 'RUN%d' % run_index,
+                    os.path.join(project_dir, 'RUN%d%s' % (run_index, archive_extensions[archive_compression]))
+                )
+
+        if archive:
+            archive_index_entries = mpistate.comm.gather(run_archiver.wait(), root=0)
+            if mpistate.rank == 0:
+                write_archive_index(project_dir, [entry for rank_entries in archive_index_entries for entry in rank_entries])
+
+        mpistate.comm.Barrier()
+
+        if mpistate.rank == 0:
+            merge_packaging_manifests(project_dir)
+            packaging_manifest = read_packaging_manifest(project_dir)
+            nruns_failed = len([run_index for run_index in range(nvalid) if packaging_manifest.get(run_index, {}).get('status') == 'failed'])
+            if nruns_failed > 0:
+                print "%d RUNs failed; rerun to retry them." % nruns_failed
+
+            # ========
+            # Metadata
+            # ========
+
+            project_metadata = ensembler.core.ProjectMetadata(project_stage='package_for_fah', target_id=target.id)
+            datestamp = ensembler.core.get_utcnow_formatted()
+
+            metadata = {
+                'target_id': target.id,
+                'datestamp': datestamp,
+                'template_seqid_cutoff': template_seqid_cutoff,
+                'process_only_these_targets': process_only_these_targets,
+                'process_only_these_templates': process_only_these_templates,
+                'nclones': nclones,
+                'nruns': nvalid,
+                'nruns_failed': nruns_failed,
+                'deduplicate': deduplicate,
+                'archive': archive,
+                'archive_compression': archive_compression if archive else None,
+                'timestep': '%s' % fah_timestep,
+                'hmr': hmr,
+                'hydrogen_mass': '%s' % hydrogen_mass if hmr else None,
+                'python_version': sys.version.split('|')[0].strip(),
+                'python_full_version': ensembler.core.literal_str(sys.version),
+                'ensembler_version': ensembler.version.short_version,
+                'ensembler_commit': ensembler.version.git_revision,
+                'biopython_version': Bio.__version__,
+                'openmm_version': simtk.openmm.version.short_version,
+                'openmm_commit': simtk.openmm.version.git_revision,
+            }
+
+            project_metadata.add_data(metadata)
+            project_metadata.write()
+
+    if archive:
+        run_archiver.close()
 
     mpistate.comm.Barrier()
     if mpistate.rank == 0:
         print 'Done.'
 
 
-def package_for_transfer(process_only_these_targets=None):
-    raise Exception, 'Not implemented yet.'
+def maxwell_boltzmann_velocities(masses, temperature, random_state):
+    '''Draw particle velocities from the Maxwell-Boltzmann distribution.
+
+    Parameters
+    ----------
+    masses : numpy array of float
+        Particle masses (amu). Massless particles (e.g. virtual sites) are given zero velocity.
+    temperature : simtk.unit.Quantity
+    random_state : numpy.random.RandomState
+
+    Returns
+    -------
+    velocities : numpy array of float, shape (nparticles, 3)
+        Velocities (nm/ps)
+    '''
+    kT = (unit.MOLAR_GAS_CONSTANT_R * temperature) / (unit.kilojoules_per_mole)
+    sigmas = np.zeros(len(masses))
+    sigmas[masses > 0.0] = np.sqrt(kT / masses[masses > 0.0])
+    return random_state.normal(size=(len(masses), 3)) * sigmas[:, np.newaxis]
+
+
+def batch_constraints(system, masses):
+    '''Split the constraints of a System into batches in which no particle appears more than once,
+    so that the constraints within a batch can be applied simultaneously. Constraints involving
+    massless particles are omitted.
+
+    Returns
+    -------
+    constraint_batches : list of numpy arrays of int, shape (nconstraints_in_batch, 2)
+    '''
+    batches = []
+    particle_batches = {}
+    for constraint_index in range(system.getNumConstraints()):
+        particle1, particle2, distance = system.getConstraintParameters(constraint_index)
+        if masses[particle1] == 0.0 or masses[particle2] == 0.0:
+            continue
+        used_batches = particle_batches.get(particle1, set()) | particle_batches.get(particle2, set())
+        batch_index = 0
+        while batch_index in used_batches:
+            batch_index += 1
+        if batch_index == len(batches):
+            batches.append([])
+        batches[batch_index].append((particle1, particle2))
+        particle_batches.setdefault(particle1, set()).add(batch_index)
+        particle_batches.setdefault(particle2, set()).add(batch_index)
+    return [np.array(batch, dtype=int) for batch in batches]
+
+
+def constrain_velocities(velocities, positions, masses, constraint_batches, box_lengths=None, tolerance=1e-8, max_iterations=1000):
+    '''Remove the components of the velocities along constrained bonds (as done by OpenMM
+    following setVelocitiesToTemperature), by iteratively applying each batch of constraints
+    in turn until the relative velocity along every constraint is below tolerance.
+
+    Parameters
+    ----------
+    velocities : numpy array of float, shape (nparticles, 3)
+        Modified in place (nm/ps)
+    positions : numpy array of float, shape (nparticles, 3)
+        (nm)
+    masses : numpy array of float
+        (amu)
+    constraint_batches : list of numpy arrays of int
+        See batch_constraints
+    box_lengths : numpy array of float, shape (3,)
+        If given, the minimum image convention is used for constrained bonds (nm)
+    tolerance : float
+        (nm/ps)
+    max_iterations : int
+    '''
+    batch_directions = []
+    for batch in constraint_batches:
+        displacements = positions[batch[:, 0]] - positions[batch[:, 1]]
+        if box_lengths is not None:
+            displacements -= box_lengths * np.round(displacements / box_lengths)
+        directions = displacements / np.sqrt((displacements ** 2).sum(axis=1))[:, np.newaxis]
+        batch_directions.append(directions)
+
+    for iteration in range(max_iterations):
+        max_relative_velocity = 0.0
+        for batch, directions in zip(constraint_batches, batch_directions):
+            inverse_masses1 = 1.0 / masses[batch[:, 0]]
+            inverse_masses2 = 1.0 / masses[batch[:, 1]]
+            relative_velocities = ((velocities[batch[:, 0]] - velocities[batch[:, 1]]) * directions).sum(axis=1)
+            impulses = relative_velocities / (inverse_masses1 + inverse_masses2)
+            velocities[batch[:, 0]] -= (impulses * inverse_masses1)[:, np.newaxis] * directions
+            velocities[batch[:, 1]] += (impulses * inverse_masses2)[:, np.newaxis] * directions
+            if len(batch) > 0:
+                max_relative_velocity = max(max_relative_velocity, np.abs(relative_velocities).max())
+        if max_relative_velocity < tolerance:
+            return
+    logger.warning('Velocity constraints did not converge within %d iterations' % max_iterations)
+
+
+def replace_state_velocities(state_xml, velocities, masses):
+    '''Substitute new velocities into a serialized OpenMM State, updating its kinetic energy and
+    resetting its time to zero. Positions, forces, potential energy and box vectors are retained.
+
+    Parameters
+    ----------
+    state_xml : str
+        Serialized State, which must include velocities
+    velocities : numpy array of float, shape (nparticles, 3)
+        (nm/ps)
+    masses : numpy array of float
+        (amu)
+
+    Returns
+    -------
+    state_xml : str
+    '''
+    velocities_match = re.search(r'(\n(\s*)<Velocities>\n).*?(\n\s*</Velocities>)', state_xml, re.DOTALL)
+    if velocities_match is None:
+        raise Exception('Serialized State does not contain velocities')
+    indent = velocities_match.group(2) + '\t'
+    velocity_lines = '\n'.join([indent + '<Velocity x="%.17g" y="%.17g" z="%.17g"/>' % tuple(velocity) for velocity in velocities])
+    state_xml = state_xml[:velocities_match.start()] + velocities_match.group(1) + velocity_lines + velocities_match.group(3) + state_xml[velocities_match.end():]
+
+    kinetic_energy = 0.5 * (masses * (velocities ** 2).sum(axis=1)).sum()
+    state_xml = re.sub(r'KineticEnergy="[^"]*"', 'KineticEnergy="%.17g"' % kinetic_energy, state_xml, count=1)
+    state_xml = re.sub(r'(<State [^>]*\btime=")[^"]*(")', r'\g<1>0\g<2>', state_xml, count=1)
+    state_xml = re.sub(r'(<State [^>]*\bstepCount=")[^"]*(")', r'\g<1>0\g<2>', state_xml, count=1)
+    return state_xml
+
+
+
+# ========
+# Packaging manifest
+# ========
+
+packaging_manifest_filename = 'packaging-manifest.yaml'
+packaging_manifest_rank_filename = 'packaging-manifest.rank%d.yaml'
+packaging_manifest_rank_filename_regex = re.compile(r'packaging-manifest\.rank(\d+)\.yaml$')
+
+
+def get_packaging_manifest_filepath(project_dir, rank=0):
+    '''Path of the packaging manifest written by the given rank: the project manifest,
+    [project_dir]/packaging-manifest.yaml, for rank 0, or [project_dir]/packaging-manifest.rank[N].yaml.
+    '''
+    if rank == 0:
+        return os.path.join(project_dir, packaging_manifest_filename)
+    return os.path.join(project_dir, packaging_manifest_rank_filename % rank)
+
+
+def append_packaging_manifest_record(project_dir, record, rank=0):
+    '''Append a RUN record to the packaging manifest written by the given rank (see
+    get_packaging_manifest_filepath).
+
+    The manifest is a YAML list, with one flow-style item per line, which is appended to with a
+    single write to a file opened in append mode. Should a write be interrupted, only the last line
+    can be incomplete, and read_packaging_manifest skips it. Appends from different processes are
+    not guaranteed to be atomic (e.g. on NFS or Lustre), so each rank appends to its own manifest,
+    which rank 0 later merges into the project manifest (see merge_packaging_manifests).
+
+    Parameters
+    ----------
+    project_dir : str
+    record : dict
+        e.g. {'run': 0, 'template': template id, 'status': 'complete'|'failed', ...}. Strings
+        should not contain line breaks.
+    rank : int
+    '''
+    line = '- %s\n' % yaml.dump(record, default_flow_style=True, width=2**30, Dumper=ensembler.core.YamlDumper).strip()
+    manifest_fd = os.open(get_packaging_manifest_filepath(project_dir, rank=rank), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(manifest_fd, line)
+    finally:
+        os.close(manifest_fd)
+
+
+def read_packaging_manifest_records(manifest_filepath):
+    '''Read the records in a single packaging manifest file, in the order written, skipping any
+    unreadable (e.g. truncated) records.
+
+    Returns
+    -------
+    records : list of dict
+        Empty if the file does not exist.
+    '''
+    if not os.path.exists(manifest_filepath):
+        return []
+    with open(manifest_filepath) as manifest_file:
+        contents = manifest_file.read()
+    try:
+        return yaml.load(contents, Loader=ensembler.core.YamlLoader) or []
+    except yaml.YAMLError:
+        # e.g. a record truncated by a crash; read line by line, skipping unreadable records
+        record_list = []
+        for line in contents.splitlines():
+            try:
+                record_list += yaml.load(line, Loader=ensembler.core.YamlLoader) or []
+            except yaml.YAMLError:
+                logger.warning('Skipping unreadable packaging manifest record: %s' % line)
+        return record_list
+
+
+def list_rank_packaging_manifests(project_dir):
+    '''Paths of the manifests written by ranks other than 0 and not yet merged, in rank order.
+    '''
+    rank_manifests = []
+    for filename in os.listdir(project_dir):
+        match = packaging_manifest_rank_filename_regex.match(filename)
+        if match:
+            rank_manifests.append((int(match.group(1)), os.path.join(project_dir, filename)))
+    return [manifest_filepath for rank, manifest_filepath in sorted(rank_manifests)]
+
+
+def merge_packaging_manifests(project_dir):
+    '''Append the records from the rank manifests (see append_packaging_manifest_record) to the
+    project manifest, in RUN order, and remove the rank manifests. Should only be called by rank 0,
+    while no other ranks are writing records.
+    '''
+    for manifest_filepath in list_rank_packaging_manifests(project_dir):
+        for record in sorted(read_packaging_manifest_records(manifest_filepath), key=lambda record: record['run']):
+            append_packaging_manifest_record(project_dir, record)
+        os.remove(manifest_filepath)
+
+
+def read_packaging_manifest(project_dir):
+    '''Read the packaging manifest, including any records in rank manifests which have not yet
+    been merged (see append_packaging_manifest_record).
+
+    Returns
+    -------
+    records : dict
+        {run index: latest record for that RUN}. Empty if there is no manifest.
+    '''
+    record_list = read_packaging_manifest_records(get_packaging_manifest_filepath(project_dir))
+    for manifest_filepath in list_rank_packaging_manifests(project_dir):
+        record_list += read_packaging_manifest_records(manifest_filepath)
+    records = {}
+    for record in record_list:
+        records[record['run']] = record
+    return records
+
+
+# ========
+# Deduplicated files
+# ========
+
+payloads_dirname = 'payloads'
+
+
+def replace_file_contents(filepath, contents):
+    '''Write contents to filepath by writing a temporary file and renaming it into place, so that
+    an existing file at filepath is replaced rather than modified in place. Any other hardlinks to
+    the existing file (see write_deduplicated_file) are therefore left unchanged.
+
+    Parameters
+    ----------
+    filepath : str
+    contents : str
+    '''
+    partial_filepath = '%s.%d.partial' % (filepath, os.getpid())
+    with open(partial_filepath, 'w') as outfile:
+        outfile.write(contents)
+    os.rename(partial_filepath, filepath)
+
+
+def write_deduplicated_file(filepath, contents, payloads_dir):
+    '''Write contents to filepath as a hardlink to a content-addressed copy,
+    [payloads_dir]/[SHA-256 of contents], so that identical files share storage. If hardlinks are
+    not supported (e.g. payloads_dir is on another filesystem), a separate copy is written.
+
+    Since hardlinked files share their contents, they should be replaced rather than modified in
+    place.
+
+    Parameters
+    ----------
+    filepath : str
+    contents : str
+    payloads_dir : str
+
+    Returns
+    -------
+    new_payload : bool
+        False if identical contents had already been written to payloads_dir.
+    '''
+    payload_filepath = os.path.join(payloads_dir, hashlib.sha256(contents).hexdigest())
+    new_payload = not os.path.exists(payload_filepath)
+    if new_payload:
+        # Written under a temporary name, since other ranks may be writing the same payload
+        partial_filepath = '%s.%d.partial' % (payload_filepath, os.getpid())
+        with open(partial_filepath, 'w') as payload_file:
+            payload_file.write(contents)
+        os.rename(partial_filepath, payload_filepath)
+
+    partial_filepath = '%s.%d.partial' % (filepath, os.getpid())
+    if os.path.exists(partial_filepath):
+        os.remove(partial_filepath)
+    try:
+        os.link(payload_filepath, partial_filepath)
+    except OSError:
+        replace_file_contents(filepath, contents)
+        return new_payload
+    os.rename(partial_filepath, filepath)
+    return new_payload
+
+
+# ========
+# RUN archives
+# ========
+
+archive_extensions = {
+    'gzip': '.tgz',
+    'zstd': '.tar.zst',
+}
+
+archive_index_filename = 'archive-index.yaml'
+
+
+class RunArchiver(object):
+    """Archives RUN directories in a background thread, so that archiving of one RUN overlaps with
+    generation of the next. Each directory is streamed into a tar archive in-process; gzip
+    compression is carried out in independent blocks across a pool of nthreads threads (see
+    ParallelGzipFile), while zstd compression uses the multi-threaded compressor of the zstandard
+    module.
+
+    Parameters
+    ----------
+    compression : str
+        gzip|zstd
+    nthreads : int
+        Number of compression threads.
+    compresslevel : int or None
+        Defaults to 6 for gzip and 3 for zstd.
+
+    Example
+    -------
+    >>> run_archiver = RunArchiver(nthreads=4)
+    >>> run_archiver.submit(project_dir, 'RUN0', os.path.join(project_dir, 'RUN0.tgz'))
+    >>> index_entries = run_archiver.wait()
+    >>> run_archiver.close()
+    """
+    def __init__(self, compression='gzip', nthreads=1, compresslevel=None):
+        if compression not in archive_extensions:
+            raise Exception('Archive compression "%s" not recognized. Options: %s' % (compression, ', '.join(sorted(archive_extensions))))
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('zstd archive compression requires the zstandard module.')
+        self.compression = compression
+        self.nthreads = max(1, nthreads)
+        self.compresslevel = compresslevel
+        self.pool = ThreadPool(self.nthreads) if compression == 'gzip' else None
+        # At most one RUN waits to be archived, so that generation cannot get far ahead of archiving
+        self._queue = Queue.Queue(maxsize=1)
+        self._entries = []
+        self._thread = threading.Thread(target=self._archive_runs)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, parent_dir, dirname, archive_filepath):
+        """Archive the directory [parent_dir]/[dirname] to archive_filepath, with archive member
+        names relative to parent_dir. Blocks if a previously submitted directory is still waiting
+        to be archived.
+        """
+        self._queue.put((parent_dir, dirname, archive_filepath))
+
+    def wait(self):
+        """Wait until all submitted directories have been archived.
+
+        Returns
+        -------
+        index_entries : list of dict
+            Index entries for the archives written since the last call to wait (see
+            archive_directory). Directories which failed to archive are omitted (the error is
+            logged).
+        """
+        self._queue.join()
+        index_entries, self._entries = self._entries, []
+        return index_entries
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def _archive_runs(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                parent_dir, dirname, archive_filepath = task
+                self._entries.append(archive_directory(
+                    parent_dir, dirname, archive_filepath, compression=self.compression,
+                    pool=self.pool, nthreads=self.nthreads, compresslevel=self.compresslevel
+                ))
+            except Exception:
+                logger.error('Failed to archive %s:\n%s' % (task[1], traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+
+def archive_directory(parent_dir, dirname, archive_filepath, compression='gzip', pool=None, nthreads=1, compresslevel=None):
+    """Stream the directory [parent_dir]/[dirname] into a compressed tar archive. Members are added
+    in sorted order, and no timestamps are written to the compressed stream, so archiving
+    unchanged files gives the same checksum. The archive is written to a temporary file, which is
+    renamed once complete.
+
+    Parameters
+    ----------
+    parent_dir : str
+    dirname : str
+    archive_filepath : str
+    compression : str
+        gzip|zstd
+    pool : multiprocessing.pool.ThreadPool or None
+        Pool used for gzip block compression. If None, a pool of nthreads threads is created.
+    nthreads : int
+    compresslevel : int or None
+
+    Returns
+    -------
+    index_entry : dict
+        {'run': dirname, 'filename': archive filename, 'compression': compression,
+        'size': archive size in bytes, 'sha256': SHA-256 hex digest of the archive}
+    """
+    partial_filepath = archive_filepath + '.partial'
+    close_pool = False
+    if compression == 'gzip' and pool is None:
+        pool = ThreadPool(nthreads)
+        close_pool = True
+    try:
+        with open(partial_filepath, 'wb') as archive_file:
+            checksummed_file = ChecksummedFile(archive_file)
+            if compression == 'gzip':
+                compressed_file = ParallelGzipFile(
+                    checksummed_file, pool, nthreads, compresslevel=6 if compresslevel is None else compresslevel
+                )
+            elif compression == 'zstd':
+                import zstandard
+                compressor = zstandard.ZstdCompressor(level=3 if compresslevel is None else compresslevel, threads=nthreads)
+                compressed_file = ZstdFile(checksummed_file, compressor)
+            else:
+                raise Exception('Archive compression "%s" not recognized.' % compression)
+
+            tar = tarfile.open(fileobj=compressed_file, mode='w|')
+            source_dir = os.path.join(parent_dir, dirname)
+            tar.add(source_dir, arcname=dirname, recursive=False)
+            for dirpath, subdirnames, filenames in os.walk(source_dir):
+                subdirnames.sort()
+                arc_dirpath = os.path.join(dirname, os.path.relpath(dirpath, source_dir))
+                for name in subdirnames + sorted(filenames):
+                    tar.add(os.path.join(dirpath, name), arcname=os.path.normpath(os.path.join(arc_dirpath, name)), recursive=False)
+            tar.close()
+            compressed_file.close()
+    except:
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        raise
+    finally:
+        if close_pool:
+            pool.close()
+            pool.join()
+
+    os.rename(partial_filepath, archive_filepath)
+    return {
+        'run': dirname,
+        'filename': os.path.basename(archive_filepath),
+        'compression': compression,
+        'size': checksummed_file.size,
+        'sha256': checksummed_file.hexdigest(),
+    }
+
+
+def write_archive_index(project_dir, index_entries):
+    """Add entries to the index of RUN archives, [project_dir]/archive-index.yaml, keyed by RUN.
+    Entries for RUNs which are not being updated are retained.
+    """
+    index_filepath = os.path.join(project_dir, archive_index_filename)
+    archive_index = {}
+    if os.path.exists(index_filepath):
+        with open(index_filepath) as index_file:
+            archive_index = yaml.load(index_file, Loader=ensembler.core.YamlLoader) or {}
+    for index_entry in index_entries:
+        archive_index[index_entry['run']] = dict([(key, value) for key, value in index_entry.items() if key != 'run'])
+    with open(index_filepath + '.partial', 'w') as index_file:
+        yaml.dump(archive_index, index_file, default_flow_style=False, Dumper=ensembler.core.YamlDumper)
+    os.rename(index_filepath + '.partial', index_filepath)
+
+
+class ChecksummedFile(object):
+    """Write-only file wrapper which keeps count of the bytes written, and their SHA-256 checksum.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+        self._sha256.update(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+class ParallelGzipFile(object):
+    """Write-only file object which gzip-compresses its input in independent blocks of block_size
+    bytes, across a thread pool (zlib releases the GIL while compressing). Each block is written as
+    a separate gzip member; a concatenation of gzip members is itself a valid gzip file, readable
+    by gzip, tar and the Python gzip module. Compressed blocks are written in order, with at most
+    2*nthreads blocks held in memory.
+    """
+    def __init__(self, fileobj, pool, nthreads, block_size=4*1024*1024, compresslevel=6):
+        self.fileobj = fileobj
+        self.pool = pool
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.max_pending_blocks = 2 * nthreads
+        self._buffer = []
+        self._buffer_size = 0
+        self._pending_blocks = deque()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self.block_size:
+            self._submit_blocks(final=False)
+
+    def close(self):
+        self._submit_blocks(final=True)
+        while self._pending_blocks:
+            self._write_next_block()
+
+    def _submit_blocks(self, final):
+        data = b''.join(self._buffer)
+        nfull_blocks = len(data) // self.block_size
+        block_starts = range(0, nfull_blocks * self.block_size, self.block_size)
+        for block_start in block_starts:
+            self._submit_block(data[block_start:block_start+self.block_size])
+        remainder = data[nfull_blocks * self.block_size:]
+        if final and len(remainder) > 0:
+            self._submit_block(remainder)
+            remainder = b''
+        self._buffer = [remainder]
+        self._buffer_size = len(remainder)
+
+    def _submit_block(self, block):
+        self._pending_blocks.append(self.pool.apply_async(compress_gzip_member, (block, self.compresslevel)))
+        while len(self._pending_blocks) > self.max_pending_blocks:
+            self._write_next_block()
+
+    def _write_next_block(self):
+        self.fileobj.write(self._pending_blocks.popleft().get())
+
+
+def compress_gzip_member(data, compresslevel=6):
+    """Compress data as a complete gzip member (with a zero modification time in its header).
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ZstdFile(object):
+    """Write-only file object which compresses its input into a single zstd frame, using a
+    zstandard.ZstdCompressor (which may be multi-threaded).
+    """
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self._compressobj = compressor.compressobj()
+
+    def write(self, data):
+        compressed_data = self._compressobj.compress(data)
+        if compressed_data:
+            self.fileobj.write(compressed_data)
+
+    def close(self):
+        self.fileobj.write(self._compressobj.flush())
+
+
+
+# ========
+# Transfer bundles
+# ========
+
+transfer_dirname = 'transfer'
+transfer_manifest_filename = 'transfer-manifest.yaml'
+bundle_manifest_filename = 'bundle-manifest.yaml'
+
+# Files written to each model directory by each stage, for use as package_for_transfer file_patterns
+transfer_stage_file_patterns = {
+    'build_models': ['alignment.pir', 'model.pdb.gz', 'sequence-identity.txt', 'modeling-log.yaml', 'restraints.rsr.gz'],
+    'cluster_models': ['unique_by_clustering'],
+    'refine_implicit_md': ['implicit-refined.pdb.gz', 'implicit-energies.txt', 'implicit-log.yaml', 'implicit-trajectory*'],
+    'solvate_models': ['nwaters.txt', 'solvated-model.npz'],
+    'refine_explicit_md': ['explicit-refined.pdb.gz', 'explicit-*.xml.gz', 'explicit-energies.txt', 'explicit-log.yaml', 'explicit-trajectory*'],
+}
+
+
+def package_for_transfer(process_only_these_targets=None, process_only_these_templates=None,
+                         file_patterns=None, bundle_size=2*1024**3, nthreads=None, verbose=False):
+    '''Export models as compressed transfer bundles, written to
+    packaged_models/transfer/[target id]/[target id]-export[n]-bundle[m].tgz.
+
+    MPI-enabled. Targets are distributed across ranks.
+
+    The files exported for each target are recorded, with their SHA-256 checksums, in
+    packaged_models/transfer/[target id]/transfer-manifest.yaml. Subsequent exports only include
+    models which have changed since the previous export, i.e. which contain a selected file which is
+    new or whose checksum has changed. Checksums are only recomputed for files whose size or
+    modification time differ from those in the manifest.
+
+    Each export is split into bundles of up to bundle_size bytes (uncompressed); models are not
+    split across bundles. The first member of each bundle (bundle-manifest.yaml) lists the files
+    it contains, with their checksums. Bundles are unpacked into a project with
+    import_transfer_bundles.
+
+    If the export of a target fails, the error is logged and the remaining targets are exported.
+    The failed target's manifest is left unchanged, so rerunning retries its export.
+
+    Parameters
+    ----------
+    process_only_these_targets : list of str
+    process_only_these_templates : list of str
+    file_patterns : list of str
+        Export only files matching these filename patterns (e.g. 'explicit-refined.pdb.gz' or
+        '*-log.yaml'), or written by these stages (see transfer_stage_file_patterns, e.g.
+        'refine_explicit_md'). Files in the target directory (e.g. sequence-identities.txt) are
+        subject to the same selection. Default: all files.
+    bundle_size : int
+    nthreads : int
+        Number of compression threads per rank. Default: one per CPU in this rank's share of the
+        node.
+    verbose : bool
+    '''
+    models_dir = ensembler.core.default_project_dirnames.models
+    transfer_dir = os.path.join(ensembler.core.default_project_dirnames.packaged_models, transfer_dirname)
+    if mpistate.rank == 0:
+        if not os.path.exists(transfer_dir):
+            os.makedirs(transfer_dir)
+    if nthreads is None:
+        nthreads = len(mpistate.node_cpu_share())
+    mpistate.comm.Barrier()
+
+    targets, templates_resolved_seq, templates_full_seq = ensembler.core.get_targets_and_templates()
+    target_ids = [
+        target.id for target in targets
+        if (not process_only_these_targets or target.id in process_only_these_targets)
+        and os.path.exists(os.path.join(models_dir, target.id))
+    ]
+
+    failed_target_ids = []
+    pool = ThreadPool(nthreads)
+    try:
+        for target_id in mpistate.iter_tasks(target_ids):
+            try:
+                export = export_target_for_transfer(
+                    target_id, process_only_these_templates=process_only_these_templates,
+                    file_patterns=file_patterns, bundle_size=bundle_size, pool=pool, nthreads=nthreads
+                )
+            except Exception:
+                logger.error('Failed to export target %s:\n%s' % (target_id, traceback.format_exc()))
+                failed_target_ids.append(target_id)
+                continue
+            if export is None:
+                print 'No changes to export for target %s' % target_id
+            else:
+                print 'Exported %d models for target %s in %d bundles' % (export['nmodels'], target_id, len(export['bundles']))
+                if verbose:
+                    for bundle in export['bundles']:
+                        print '  %s (%d bytes)' % (bundle['filename'], bundle['size'])
+    finally:
+        pool.close()
+        pool.join()
+
+    failed_target_ids = mpistate.comm.gather(failed_target_ids, root=0)
+    if mpistate.rank == 0:
+        failed_target_ids = sorted(sum(failed_target_ids, []))
+        if len(failed_target_ids) > 0:
+            print '%d targets failed to export (%s); rerun to retry them.' % (len(failed_target_ids), ', '.join(failed_target_ids))
+        print 'Done.'
+
+
+def export_target_for_transfer(target_id, process_only_these_templates=None, file_patterns=None,
+                               bundle_size=2*1024**3, pool=None, nthreads=1):
+    '''Export the models for a single target which have changed since the previous export (see
+    package_for_transfer).
+
+    Returns
+    -------
+    export : dict or None
+        The export record added to the transfer manifest, or None if nothing has changed.
+    '''
+    models_target_dir = os.path.join(ensembler.core.default_project_dirnames.models, target_id)
+    target_transfer_dir = os.path.join(ensembler.core.default_project_dirnames.packaged_models, transfer_dirname, target_id)
+    if not os.path.exists(target_transfer_dir):
+        os.makedirs(target_transfer_dir)
+    manifest_filepath = os.path.join(target_transfer_dir, transfer_manifest_filename)
+    transfer_manifest = {'target_id': target_id, 'exports': [], 'files': {}}
+    if os.path.exists(manifest_filepath):
+        with open(manifest_filepath) as manifest_file:
+            transfer_manifest = yaml.load(manifest_file, Loader=ensembler.core.YamlLoader)
+    export_index = len(transfer_manifest['exports'])
+
+    # Files are grouped by model directory, and files in the target directory form their own group
+    file_groups = [select_transfer_files(models_target_dir, file_patterns)]
+    nmodels_changed = 0
+    for template_id in sorted(os.listdir(models_target_dir)):
+        model_dir = os.path.join(models_target_dir, template_id)
+        if not os.path.isdir(model_dir):
+            continue
+        if process_only_these_templates and template_id not in process_only_these_templates:
+            continue
+        file_groups.append(select_transfer_files(model_dir, file_patterns))
+
+    changed_file_groups = []
+    mtimes_updated = False
+    for group_index, filepaths in enumerate(file_groups):
+        file_entries = []
+        changed = False
+        for filepath in filepaths:
+            file_stat = os.stat(filepath)
+            previous_entry = transfer_manifest['files'].get(filepath)
+            if previous_entry is not None and previous_entry['size'] == file_stat.st_size and previous_entry['mtime'] == file_stat.st_mtime:
+                sha256 = previous_entry['sha256']
+            else:
+                sha256 = file_sha256(filepath)
+            if previous_entry is None or previous_entry['sha256'] != sha256:
+                changed = True
+            file_entries.append((filepath, {'sha256': sha256, 'size': file_stat.st_size, 'mtime': file_stat.st_mtime}))
+        if changed:
+            changed_file_groups.append(file_entries)
+            if group_index > 0:
+                nmodels_changed += 1
+        else:
+            # Record any updated modification times, so unchanged files need not be rehashed next time
+            for filepath, file_entry in file_entries:
+                if transfer_manifest['files'][filepath]['mtime'] != file_entry['mtime']:
+                    transfer_manifest['files'][filepath]['mtime'] = file_entry['mtime']
+                    mtimes_updated = True
+
+    if len(changed_file_groups) == 0:
+        if mtimes_updated:
+            write_transfer_manifest(manifest_filepath, transfer_manifest)
+        return None
+
+    # Models are assigned to bundles in order, without being split across bundles
+    bundled_file_groups = [[]]
+    bundled_size = 0
+    for file_entries in changed_file_groups:
+        group_size = sum([file_entry['size'] for filepath, file_entry in file_entries])
+        if len(bundled_file_groups[-1]) > 0 and bundled_size + group_size > bundle_size:
+            bundled_file_groups.append([])
+            bundled_size = 0
+        bundled_file_groups[-1].append(file_entries)
+        bundled_size += group_size
+
+    export = {
+        'export': export_index,
+        'datestamp': ensembler.core.get_utcnow_formatted(),
+        'file_patterns': file_patterns,
+        'nmodels': nmodels_changed,
+        'bundles': [],
+    }
+    for bundle_index, file_groups_in_bundle in enumerate(bundled_file_groups):
+        bundle_filename = '%s-export%03d-bundle%03d.tgz' % (target_id, export_index, bundle_index)
+        bundle_file_entries = [file_entry for file_entries in file_groups_in_bundle for file_entry in file_entries]
+        bundle_manifest = {
+            'target_id': target_id,
+            'export': export_index,
+            'bundle': bundle_index,
+            'files': dict([(filepath, {'sha256': file_entry['sha256'], 'size': file_entry['size']}) for filepath, file_entry in bundle_file_entries]),
+        }
+        bundle_size_bytes, bundle_sha256 = write_transfer_bundle(
+            os.path.join(target_transfer_dir, bundle_filename), bundle_manifest,
+            [filepath for filepath, file_entry in bundle_file_entries], pool=pool, nthreads=nthreads
+        )
+        export['bundles'].append({'filename': bundle_filename, 'size': bundle_size_bytes, 'sha256': bundle_sha256, 'nfiles': len(bundle_file_entries)})
+        for filepath, file_entry in bundle_file_entries:
+            file_entry['bundle'] = bundle_filename
+            transfer_manifest['files'][filepath] = file_entry
+
+    # The manifest is only updated once all bundles have been written
+    transfer_manifest['exports'].append(export)
+    write_transfer_manifest(manifest_filepath, transfer_manifest)
+    return export
+
+
+def write_transfer_manifest(manifest_filepath, transfer_manifest):
+    # Replaced atomically, so an interrupted write leaves the previous manifest intact
+    with open(manifest_filepath + '.partial', 'w') as manifest_file:
+        yaml.dump(transfer_manifest, manifest_file, default_flow_style=False, Dumper=ensembler.core.YamlDumper)
+    os.rename(manifest_filepath + '.partial', manifest_filepath)
+
+
+def select_transfer_files(dirpath, file_patterns=None):
+    '''List the files in a directory (not including subdirectories) which match any of the given
+    filename patterns or stage names (see package_for_transfer).
+
+    Returns
+    -------
+    filepaths : list of str
+        Sorted paths, each of the form [dirpath]/[filename].
+    '''
+    if file_patterns:
+        expanded_file_patterns = []
+        for file_pattern in file_patterns:
+            expanded_file_patterns += transfer_stage_file_patterns.get(file_pattern, [file_pattern])
+    filepaths = []
+    for filename in sorted(os.listdir(dirpath)):
+        filepath = os.path.join(dirpath, filename)
+        if not os.path.isfile(filepath) or filename.endswith('.partial'):
+            continue
+        if file_patterns and not any([fnmatch.fnmatch(filename, file_pattern) for file_pattern in expanded_file_patterns]):
+            continue
+        filepaths.append(filepath)
+    return filepaths
+
+
+def write_transfer_bundle(bundle_filepath, bundle_manifest, filepaths, pool=None, nthreads=1):
+    '''Write a gzipped tar bundle, containing bundle-manifest.yaml followed by the given files
+    (with paths relative to the project directory). Compressed in parallel blocks (see
+    ParallelGzipFile).
+
+    Returns
+    -------
+    size : int
+        Bundle size, in bytes.
+    sha256 : str
+    '''
+    partial_filepath = bundle_filepath + '.partial'
+    close_pool = False
+    if pool is None:
+        pool = ThreadPool(nthreads)
+        close_pool = True
+    try:
+        with open(partial_filepath, 'wb') as bundle_file:
+            checksummed_file = ChecksummedFile(bundle_file)
+            compressed_file = ParallelGzipFile(checksummed_file, pool, nthreads)
+            tar = tarfile.open(fileobj=compressed_file, mode='w|')
+            manifest_contents = yaml.dump(bundle_manifest, default_flow_style=False, Dumper=ensembler.core.YamlDumper)
+            manifest_tarinfo = tarfile.TarInfo(bundle_manifest_filename)
+            manifest_tarinfo.size = len(manifest_contents)
+            manifest_tarinfo.mtime = time.time()
+            tar.addfile(manifest_tarinfo, io.BytesIO(manifest_contents))
+            for filepath in filepaths:
+                tar.add(filepath, arcname=os.path.normpath(filepath), recursive=False)
+            tar.close()
+            compressed_file.close()
+    except:
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        raise
+    finally:
+        if close_pool:
+            pool.close()
+            pool.join()
+    os.rename(partial_filepath, bundle_filepath)
+    return checksummed_file.size, checksummed_file.hexdigest()
+
+
+def read_bundle_manifest(bundle_filepath):
+    '''Read the manifest of a transfer bundle (its first member), without unpacking the bundle.
+    '''
+    with tarfile.open(bundle_filepath, 'r:gz') as tar:
+        member = tar.next()
+        if member is None or member.name != bundle_manifest_filename:
+            raise Exception('%s is not a transfer bundle (no %s found).' % (bundle_filepath, bundle_manifest_filename))
+        return yaml.load(tar.extractfile(member).read(), Loader=ensembler.core.YamlLoader)
+
+
+def import_transfer_bundles(bundle_filepaths, project_dir='.', nthreads=None, verbose=False):
+    '''Unpack transfer bundles (written by package_for_transfer) into a project directory.
+
+    MPI-enabled. Bundles are distributed across ranks, and each rank unpacks nthreads bundles
+    concurrently. Where a file is contained in bundles from more than one export of the same target,
+    only the copy from the latest export is unpacked. The checksum of each file is checked against
+    the bundle manifest before the file is moved into place.
+
+    Parameters
+    ----------
+    bundle_filepaths : list of str
+    project_dir : str
+    nthreads : int
+        Default: one per CPU in this rank's share of the node.
+    verbose : bool
+    '''
+    if nthreads is None:
+        nthreads = len(mpistate.node_cpu_share())
+
+    # Find the bundle from which each file should be unpacked
+    bundle_filepaths = sorted(bundle_filepaths)
+    bundle_manifests = [read_bundle_manifest(bundle_filepath) for bundle_filepath in bundle_filepaths]
+    latest_bundles = {}
+    for bundle_index, bundle_manifest in enumerate(bundle_manifests):
+        for filepath in bundle_manifest['files']:
+            key = (bundle_manifest['target_id'], filepath)
+            if key not in latest_bundles or bundle_manifest['export'] >= bundle_manifests[latest_bundles[key]]['export']:
+                latest_bundles[key] = bundle_index
+    bundle_filepaths_to_unpack = [set() for bundle_filepath in bundle_filepaths]
+    for (target_id, filepath), bundle_index in latest_bundles.items():
+        bundle_filepaths_to_unpack[bundle_index].add(filepath)
+
+    unpack_tasks = [
+        (bundle_filepaths[bundle_index], project_dir, bundle_filepaths_to_unpack[bundle_index])
+        for bundle_index in range(mpistate.rank, len(bundle_filepaths), mpistate.size)
+    ]
+    pool = ThreadPool(max(1, nthreads))
+    try:
+        nfiles_unpacked = pool.map(unpack_transfer_bundle_task, unpack_tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    if verbose:
+        for (bundle_filepath, project_dir, filepaths), nfiles in zip(unpack_tasks, nfiles_unpacked):
+            print 'Unpacked %d files from %s' % (nfiles, bundle_filepath)
+
+    nfiles_unpacked = mpistate.comm.gather(sum(nfiles_unpacked), root=0)
+    if mpistate.rank == 0:
+        print 'Unpacked %d files from %d bundles.' % (sum(nfiles_unpacked), len(bundle_filepaths))
+        print 'Done.'
+
+
+def unpack_transfer_bundle_task(args):
+    return unpack_transfer_bundle(*args)
+
+
+def unpack_transfer_bundle(bundle_filepath, project_dir='.', filepaths=None):
+    '''Unpack the files from a transfer bundle into a project directory, checking their checksums.
+
+    Parameters
+    ----------
+    bundle_filepath : str
+    project_dir : str
+    filepaths : set of str or None
+        Unpack only these files (paths relative to the project directory). Default: all files.
+
+    Returns
+    -------
+    nfiles : int
+        Number of files unpacked.
+    '''
+    nfiles = 0
+    with tarfile.open(bundle_filepath, 'r:gz') as tar:
+        bundle_manifest = None
+        for member in tar:
+            if member.name == bundle_manifest_filename:
+                bundle_manifest = yaml.load(tar.extractfile(member).read(), Loader=ensembler.core.YamlLoader)
+                continue
+            if bundle_manifest is None:
+                raise Exception('%s is not a transfer bundle (no %s found).' % (bundle_filepath, bundle_manifest_filename))
+            filepath = os.path.normpath(member.name)
+            if os.path.isabs(filepath) or filepath.split(os.sep)[0] == os.pardir:
+                raise Exception('Unsafe path %s in bundle %s' % (member.name, bundle_filepath))
+            if not member.isfile() or (filepaths is not None and filepath not in filepaths):
+                continue
+
+            output_filepath = os.path.join(project_dir, filepath)
+            output_dirpath = os.path.dirname(output_filepath)
+            try:
+                os.makedirs(output_dirpath)
+            except OSError:
+                if not os.path.isdir(output_dirpath):
+                    raise
+            partial_filepath = output_filepath + '.partial'
+            sha256 = hashlib.sha256()
+            member_file = tar.extractfile(member)
+            with open(partial_filepath, 'wb') as output_file:
+                while True:
+                    data = member_file.read(1024*1024)
+                    if not data:
+                        break
+                    sha256.update(data)
+                    output_file.write(data)
+            if sha256.hexdigest() != bundle_manifest['files'][filepath]['sha256']:
+                os.remove(partial_filepath)
+                raise Exception('Checksum mismatch for %s in bundle %s' % (filepath, bundle_filepath))
+            os.rename(partial_filepath, output_filepath)
+            os.utime(output_filepath, (member.mtime, member.mtime))
+            nfiles += 1
+    return nfiles
+
+
+def file_sha256(filepath):
+    with open(filepath, 'rb') as input_file:
+        sha256 = hashlib.sha256()
+        while True:
+            data = input_file.read(1024*1024)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
@@ -1,15 +1,18 @@
 import os
 import datetime
+import random
 import traceback
 import gzip
 import sys
 import subprocess
+import hashlib
 import yaml
-from collections import deque
 import numpy as np
 import Bio
 import ensembler
 import ensembler.version
+import ensembler.coordinate_store
+import ensembler.reporters
 from ensembler.core import mpistate, logger
 import simtk.unit as unit
 import simtk.openmm as openmm
@@ -32,12 +35,64 @@ def refine_implicit_md(
         minimization_steps=20,
         pH=7.0,
         retry_failed_runs=False,
-        cpu_platform_threads=1):
+        cpu_platform_threads=1,
+        write_coordinate_store=False,
+        checkpoint_interval=None,
+        trajectory_format='pdb.gz',
+        trajectory_stride=1,
+        trajectory_protein_only=False,
+        adaptive_sim_length=False,
+        min_sim_length=20.0 * unit.picoseconds,
+        plateau_window=20,
+        plateau_tolerance=1.0,
+        hmr=False,
+        hydrogen_mass=4.0 * unit.amu,
+        cpu_packing=False):
     # TODO - refactor
     '''Run MD refinement in implicit solvent.
 
     MPI-enabled.
+
+    If write_trajectory is True, a frame is written to 'implicit-trajectory.[trajectory_format]'
+    every trajectory_stride iterations (of 500 steps). trajectory_format can be 'pdb.gz' (gzipped
+    multi-model PDB), or the much cheaper binary formats 'dcd' or 'xtc', for which the topology is
+    written to 'implicit-trajectory-topol.pdb'. If trajectory_protein_only is True, only protein
+    atoms are written. See ensembler.reporters.
+
+    If write_coordinate_store is True, refined models are also added to a per-target coordinate
+    store (see ensembler.coordinate_store.CoordinateStore).
+
+    If hmr is True, hydrogen masses are repartitioned to hydrogen_mass (see
+    repartition_hydrogen_mass), which allows a timestep of up to 4 fs to be used, e.g.
+    timestep=4.0*unit.femtoseconds. The setting is recorded in the stage metadata.
+
+    If adaptive_sim_length is True, sim_length is treated as a maximum, and each simulation is
+    stopped early once its potential energy has plateaued, though not before min_sim_length. The
+    potential energy is considered to have plateaued once the drift over the last plateau_window
+    iterations (of 500 steps), estimated by a linear fit, is less than plateau_tolerance times the
+    standard deviation of the energies about that fit (see check_energy_plateau). The length
+    actually simulated is recorded as 'simulated_length' in 'implicit-log.yaml'.
+
+    If checkpoint_interval is set, an OpenMM checkpoint ('implicit-checkpoint.chk') is written to
+    the model directory every checkpoint_interval iterations (of 500 steps). An unfinished
+    simulation (e.g. one killed at the end of a job's walltime) is then resumed from its last
+    checkpoint, rather than restarted, and 'implicit-energies.txt' and any trajectory are appended
+    to, after discarding entries written since that checkpoint. The checkpoint is deleted once the
+    simulation has finished. Checkpoints can only be loaded on the same
+    OpenMM Platform on which they were written.
+
+    If cpu_packing is True, the OpenMM CPU Platform is used, with the available CPU cores
+    (allowing for CPU affinity and cgroup quotas; see ensembler.core.get_available_cpus) split
+    between several concurrent refinement tasks, each pinned to its own core set. When run as a
+    single process, the number of CpuThreads per task is chosen from the estimated system size
+    (see estimate_refinement_natoms and choose_cpu_threads), and that many local worker
+    processes are started to fill the available cores. When run with multiple (MPI or local
+    executor) ranks, the cores of each node are instead split evenly between the ranks on it,
+    and cpu_platform_threads is ignored.
     '''
+    if cpu_packing and cpu_packing_available():
+        return run_with_cpu_packing(refine_implicit_md, dict(locals()), 'refine_implicit_md')
+
     gpuid = mpistate.rank % gpupn
 
     models_dir = os.path.abspath(ensembler.core.default_project_dirnames.models)
@@ -49,7 +104,12 @@ def refine_implicit_md(
     else:
         selected_template_indices = range(len(templates_resolved_seq))
 
-    if not openmm_platform:
+    if cpu_packing:
+        if openmm_platform not in (None, 'CPU'):
+            raise Exception('cpu_packing can only be used with the OpenMM CPU platform')
+        openmm_platform = 'CPU'
+        cpu_platform_threads = pin_to_node_cpu_share()
+    elif not openmm_platform:
         openmm_platform = auto_select_openmm_platform()
 
     if openmm_platform == 'CPU':
@@ -65,6 +125,7 @@ def refine_implicit_md(
 
     nsteps_per_iteration = 500
     niterations = int((sim_length / timestep) / nsteps_per_iteration)
+    min_niterations = int((min_sim_length / timestep) / nsteps_per_iteration)
 
     def simulate_implicit_md():
 
@@ -87,72 +148,102 @@ def refine_implicit_md(
         topology = modeller.getTopology()
         positions = modeller.getPositions()
 
-        if verbose: print "Constructing System object..."
-        if cutoff is None:
-            system = forcefield.createSystem(topology, nonbondedMethod=app.NoCutoff, constraints=app.HBonds)
-        else:
-            system = forcefield.createSystem(topology, nonbondedMethod=app.CutoffNonPeriodic, nonbondedCutoff=cutoff, constraints=app.HBonds)
+        def create_system(topology):
+            if verbose: print "Constructing System object..."
+            if cutoff is None:
+                system = forcefield.createSystem(topology, nonbondedMethod=app.NoCutoff, constraints=app.HBonds)
+            else:
+                system = forcefield.createSystem(topology, nonbondedMethod=app.CutoffNonPeriodic, nonbondedCutoff=cutoff, constraints=app.HBonds)
+            if hmr:
+                repartition_hydrogen_mass(system, hydrogen_mass=hydrogen_mass)
+            return system
+
+        # All models for a target share the same sequence and reference protonation variants, so
+        # the System is normally constructed only once per target.
+        system = get_cached_system(system_cache, topology, create_system)
 
         if verbose: print "Creating Context..."
         integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
         context = openmm.Context(system, integrator, platform, platform_properties)
         context.setPositions(positions)
 
-        if verbose: print "Minimizing structure..."
-        openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
+        checkpoint_filename = os.path.join(model_dir, 'implicit-checkpoint.chk')
+        start_iteration = 0
+        if checkpoint_interval:
+            start_iteration = load_checkpoint(context, checkpoint_filename, nsteps_per_iteration * timestep, verbose=verbose)
+
+        if start_iteration == 0:
+            if verbose: print "Minimizing structure..."
+            openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
 
         if write_trajectory:
-            # Open trajectory for writing.
+            # Open trajectory for writing. When resuming, frames written since the last
+            # checkpoint are discarded, as for the energies.
             if verbose: print "Opening trajectory for writing..."
-            trajectory_filename = os.path.join(model_dir, 'implicit-trajectory.pdb.gz')
-            trajectory_outfile = gzip.open(trajectory_filename, 'w')
-            app.PDBFile.writeHeader(topology, file=trajectory_outfile)
+            trajectory_reporter = ensembler.reporters.open_trajectory_reporter(
+                model_dir, 'implicit', topology, context, trajectory_format=trajectory_format,
+                stride=trajectory_stride, protein_only=trajectory_protein_only, start_iteration=start_iteration
+            )
 
         # Open energy trajectory for writing
         energy_filename = os.path.join(model_dir, 'implicit-energies.txt')
-        energy_outfile = open(energy_filename, 'w')
-        energy_outfile.write('# iteration | simulation time (ps) | potential_energy (kT) | kinetic_energy (kT) | ns per day\n')
+        energy_outfile = open_energy_file(energy_filename, '# iteration | simulation time (ps) | potential_energy (kT) | kinetic_energy (kT) | ns per day\n', start_iteration)
+        potential_energies = read_potential_energies(energy_filename) if start_iteration > 0 else []
 
         if verbose: print "Running dynamics..."
         import time
         initial_time = time.time()
-        for iteration in range(niterations):
+        initial_simulation_time = context.getState().getTime()
+        for iteration in range(start_iteration, niterations):
             # integrate dynamics
             integrator.step(nsteps_per_iteration)
             # get current state
-            state = context.getState(getEnergy=True, getPositions=True)
+            state = context.getState(getEnergy=True)
             simulation_time = state.getTime()
             potential_energy = state.getPotentialEnergy()
             kinetic_energy = state.getKineticEnergy()
             final_time = time.time()
             elapsed_time = (final_time - initial_time) * unit.seconds
-            ns_per_day = (simulation_time / elapsed_time) / (unit.nanoseconds / unit.day)
-            if verbose: print "  %8.1f ps : potential %8.3f kT | kinetic %8.3f kT | %.3f ns/day | %.3f s remain" % (simulation_time / unit.picoseconds, potential_energy / kT, kinetic_energy / kT, ns_per_day, elapsed_time * (niterations-iteration-1) / (iteration+1) / unit.seconds)
+            ns_per_day = ((simulation_time - initial_simulation_time) / elapsed_time) / (unit.nanoseconds / unit.day)
+            if verbose: print "  %8.1f ps : potential %8.3f kT | kinetic %8.3f kT | %.3f ns/day | %.3f s remain" % (simulation_time / unit.picoseconds, potential_energy / kT, kinetic_energy / kT, ns_per_day, elapsed_time * (niterations-iteration-1) / (iteration-start_iteration+1) / unit.seconds)
 
             # Check energies are still finite.
             if np.isnan(potential_energy/kT) or np.isnan(kinetic_energy/kT):
                 raise Exception("Potential or kinetic energies are nan.")
 
             if write_trajectory:
-                app.PDBFile.writeModel(topology, state.getPositions(), file=trajectory_outfile, modelIndex=iteration)
+                trajectory_reporter.report(iteration, context)
 
             # write data
             energy_outfile.write("  %8d %8.1f %8.3f %8.3f %.3f\n" % (iteration, simulation_time / unit.picoseconds, potential_energy / kT, kinetic_energy / kT, ns_per_day))
             energy_outfile.flush()
 
+            if checkpoint_interval and (iteration+1) % checkpoint_interval == 0:
+                write_checkpoint(context, checkpoint_filename)
+
+            potential_energies.append(potential_energy / kT)
+            if adaptive_sim_length and iteration+1 >= min_niterations and check_energy_plateau(potential_energies, window=plateau_window, tolerance=plateau_tolerance):
+                if verbose: print "Potential energy has plateaued; stopping after %.1f ps." % (simulation_time / unit.picoseconds)
+                break
+
         if write_trajectory:
-            app.PDBFile.writeFooter(topology, file=trajectory_outfile)
-            trajectory_outfile.close()
+            trajectory_reporter.close()
 
         energy_outfile.close()
 
         # Write final PDB file.
+        state = context.getState(getPositions=True)
         pdb_outfile = gzip.open(pdb_filename, 'w')
         app.PDBFile.writeHeader(topology, file=pdb_outfile)
         app.PDBFile.writeFile(topology, state.getPositions(), file=pdb_outfile)
         app.PDBFile.writeFooter(topology, file=pdb_outfile)
         pdb_outfile.close()
 
+        if os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+        return state.getTime()
+
 
 
 
@@ -171,36 +262,15 @@ def refine_implicit_md(
         # Determine protonation state to use throughout
         # ========
 
-        # Determine highest-identity model.
-        seqids_filepath = os.path.join(models_target_dir, 'sequence-identities.txt')
-        if not os.path.exists(seqids_filepath):
-            print 'ERROR: sequence-identities.txt file not found at path %s' % seqids_filepath
+        # Computed (or read from the cache) on rank 0 only, then broadcast
+        if mpistate.rank == 0:
+            variants = get_reference_protonation_variants(models_target_dir, forcefield, ff_files, pH=pH, verbose=verbose)
+        else:
+            variants = None
+        variants = mpistate.comm.bcast(variants, root=0)
+        if variants is None:
             continue
-        with open(seqids_filepath, 'r') as seqids_file:
-            seqids_data = [line.split() for line in seqids_file.readlines()]
-
-        reference_pdb_found = False
-        for seqid_data in seqids_data:
-            reference_template, reference_identity = seqid_data
-            reference_pdb_filepath = os.path.join(models_target_dir, reference_template, 'model.pdb.gz')
-            if not os.path.exists(reference_pdb_filepath):
-                continue
-
-            with gzip.open(reference_pdb_filepath) as reference_pdb_file:
-                reference_pdb = app.PDBFile(reference_pdb_file)
-
-            if verbose:
-                print "Using %s as highest identity model (%s%%)" % (reference_template, reference_identity)
-
-            reference_pdb_found = True
-            break
 
-        if not reference_pdb_found:
-            print 'ERROR: reference PDB model not found at path'
-
-        # Add missing protons.
-        modeller = app.Modeller(reference_pdb.topology, reference_pdb.positions)
-        variants = modeller.addHydrogens(forcefield, pH=pH)
         if verbose:
             print "Reference variants extracted:"
             if variants != None:
@@ -210,13 +280,20 @@ def refine_implicit_md(
                 print ""
             else: print variants
 
+        # Systems constructed for this target, keyed by topology fingerprint
+        system_cache = {}
+
         if template_seqid_cutoff:
             process_only_these_templates = ensembler.core.select_templates_by_seqid_cutoff(target.id, seqid_cutoff=template_seqid_cutoff)
             selected_template_indices = [i for i, seq in enumerate(templates_resolved_seq) if seq.id in process_only_these_templates]
 
         ntemplates_selected = len(selected_template_indices)
 
-        for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
+        def expected_implicit_md_cost(template_index):
+            template = templates_resolved_seq[selected_template_indices[template_index]]
+            return _expected_refinement_cost(os.path.join(models_target_dir, template.id), 'model.pdb.gz', 'implicit-log.yaml', unique_by_clustering_only=True)
+
+        for template_index in mpistate.iter_tasks(range(ntemplates_selected), key=expected_implicit_md_cost):
             template = templates_resolved_seq[selected_template_indices[template_index]]
 
             model_dir = os.path.join(models_target_dir, template.id)
@@ -243,6 +320,7 @@ def refine_implicit_md(
                 continue
 
             pdb_filename = os.path.join(model_dir, 'implicit-refined.pdb.gz')
+            checkpoint_filename = os.path.join(model_dir, 'implicit-checkpoint.chk')
 
             print "-------------------------------------------------------------------------"
             print "Simulating %s => %s in implicit solvent for %.1f ps (MPI rank: %d, GPU ID: %d)" % (target.id, template.id, niterations * nsteps_per_iteration * timestep / unit.picoseconds, mpistate.rank, gpuid)
@@ -261,17 +339,21 @@ def refine_implicit_md(
 
             try:
                 start = datetime.datetime.utcnow()
-                simulate_implicit_md()
+                simulated_length = simulate_implicit_md()
                 timing = ensembler.core.strf_timedelta(datetime.datetime.utcnow() - start)
                 log_data = {
                     'finished': True,
                     'timing': timing,
+                    'simulated_length': '%s' % simulated_length.in_units_of(unit.picoseconds),
                     'successful': True,
                     }
                 log_file.log(new_log_data=log_data)
             except Exception as e:
                 trbk = traceback.format_exc()
                 timing = ensembler.core.strf_timedelta(datetime.datetime.utcnow() - start)
+                # A failed simulation should not be resumed from its checkpoint
+                if os.path.exists(checkpoint_filename):
+                    os.remove(checkpoint_filename)
                 log_data = {
                     'exception': e,
                     'traceback': ensembler.core.literal_str(trbk),
@@ -286,6 +368,12 @@ def refine_implicit_md(
 
         mpistate.comm.Barrier()
 
+        if write_coordinate_store:
+            ensembler.coordinate_store.update_coordinate_store(
+                models_target_dir, 'refine_implicit_md',
+                [templates_resolved_seq[template_index].id for template_index in selected_template_indices]
+            )
+
         if mpistate.rank == 0:
             project_metadata = ensembler.core.ProjectMetadata(project_stage='refine_implicit_md', target_id=target.id)
 
@@ -302,6 +390,9 @@ def refine_implicit_md(
                 'timing': ensembler.core.strf_timedelta(target_timedelta),
                 'ff': ff,
                 'implicit_water_model': implicit_water_model,
+                'timestep': '%s' % timestep,
+                'hmr': hmr,
+                'hydrogen_mass': '%s' % hydrogen_mass if hmr else None,
                 'nsuccessful_refinements': nsuccessful_refinements,
                 'python_version': sys.version.split('|')[0].strip(),
                 'python_full_version': ensembler.core.literal_str(sys.version),
@@ -322,6 +413,326 @@ def refine_implicit_md(
         print 'Done.'
 
 
+def load_checkpoint(context, checkpoint_filepath, iteration_length, verbose=False):
+    """
+    Load an OpenMM checkpoint into a Context, if one exists.
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+    checkpoint_filepath : str
+    iteration_length : simtk.unit.Quantity
+        Simulation time per iteration, used to determine the iteration from which to resume.
+    verbose : bool
+
+    Returns
+    -------
+    start_iteration : int
+        0 if no checkpoint could be loaded.
+    """
+    if not os.path.exists(checkpoint_filepath):
+        return 0
+    try:
+        with open(checkpoint_filepath, 'rb') as checkpoint_file:
+            context.loadCheckpoint(checkpoint_file.read())
+    except Exception as e:
+        print 'WARNING: could not load checkpoint %s (%s); restarting simulation.' % (checkpoint_filepath, e)
+        return 0
+    start_iteration = int(round(context.getState().getTime() / iteration_length))
+    if verbose: print "Resuming from checkpoint at iteration %d..." % start_iteration
+    return start_iteration
+
+
+def write_checkpoint(context, checkpoint_filepath):
+    """
+    Write an OpenMM checkpoint for a Context. The checkpoint is written to a temporary file which
+    then replaces any previous checkpoint, so an interrupted write cannot corrupt it.
+    """
+    tmp_checkpoint_filepath = checkpoint_filepath + '.tmp'
+    with open(tmp_checkpoint_filepath, 'wb') as checkpoint_file:
+        checkpoint_file.write(context.createCheckpoint())
+    os.rename(tmp_checkpoint_filepath, checkpoint_filepath)
+
+
+def read_potential_energies(energy_filepath):
+    """
+    Read the potential energies (kT) from an energies file written by a refinement simulation.
+
+    Returns
+    -------
+    potential_energies : list of float
+    """
+    potential_energies = []
+    if not os.path.exists(energy_filepath):
+        return potential_energies
+    with open(energy_filepath) as energy_file:
+        for line in energy_file:
+            words = line.split()
+            if len(words) > 2 and not line.startswith('#'):
+                potential_energies.append(float(words[2]))
+    return potential_energies
+
+
+def check_energy_plateau(potential_energies, window=20, tolerance=1.0):
+    """
+    Check whether a potential energy time series has plateaued.
+
+    A straight line is fitted to the last window values. The series is considered to have
+    plateaued if the drift over the window according to that fit is smaller than tolerance times
+    the standard deviation of the values about the fit, i.e. if any remaining trend is small
+    compared with the fluctuations.
+
+    Parameters
+    ----------
+    potential_energies : list of float
+        One value per iteration
+    window : int
+        Number of most recent iterations to consider
+    tolerance : float
+
+    Returns
+    -------
+    plateaued : bool
+        False if fewer than window values are available.
+    """
+    if len(potential_energies) < window or window < 3:
+        return False
+    energies = np.array(potential_energies[-window:])
+    x = np.arange(window)
+    slope, intercept = np.polyfit(x, energies, 1)
+    residuals_std = np.std(energies - (slope * x + intercept))
+    drift = abs(slope) * (window - 1)
+    return drift < tolerance * residuals_std
+
+
+def open_energy_file(energy_filepath, header, start_iteration=0):
+    """
+    Open an energies file for writing. If resuming from start_iteration > 0, lines for previous
+    iterations are kept, and any for later iterations (written after the checkpoint) discarded.
+
+    Returns
+    -------
+    energy_outfile : file
+    """
+    if start_iteration > 0 and os.path.exists(energy_filepath):
+        with open(energy_filepath) as energy_infile:
+            lines = energy_infile.readlines()
+        energy_outfile = open(energy_filepath, 'w')
+        for line in lines:
+            if line.startswith('#') or (len(line.split()) > 0 and int(line.split()[0]) < start_iteration):
+                energy_outfile.write(line)
+        energy_outfile.flush()
+        return energy_outfile
+    energy_outfile = open(energy_filepath, 'w')
+    energy_outfile.write(header)
+    return energy_outfile
+
+
+def get_reference_protonation_variants(models_target_dir, forcefield, ff_files, pH=7.0, verbose=False):
+    """
+    Determine the protonation variants of the highest sequence identity model for a target, to be
+    used for all models of that target.
+
+    The variants are cached in models/[target]/protonation-variants.yaml, along with the force
+    field files and pH used and the reference model (its templateid and the SHA-1 of its
+    model.pdb.gz file). They are only computed if no cache exists for the same force field, pH and
+    reference model, so they are recomputed if the reference model is rebuilt, or if a model with
+    higher sequence identity becomes available.
+
+    Parameters
+    ----------
+    models_target_dir : str
+    forcefield : simtk.openmm.app.ForceField
+    ff_files : list of str
+        Force field files from which forcefield was constructed
+    pH : float
+    verbose : bool
+
+    Returns
+    -------
+    variants : list or None
+        Variant name (or None) for each residue, as returned by
+        simtk.openmm.app.Modeller.addHydrogens. None if no reference model could be found.
+    """
+    # Determine highest-identity model.
+    seqids_filepath = os.path.join(models_target_dir, 'sequence-identities.txt')
+    if not os.path.exists(seqids_filepath):
+        print 'ERROR: sequence-identities.txt file not found at path %s' % seqids_filepath
+        return None
+    with open(seqids_filepath, 'r') as seqids_file:
+        seqids_data = [line.split() for line in seqids_file.readlines()]
+
+    reference_pdb_found = False
+    for seqid_data in seqids_data:
+        reference_template, reference_identity = seqid_data
+        reference_pdb_filepath = os.path.join(models_target_dir, reference_template, 'model.pdb.gz')
+        if os.path.exists(reference_pdb_filepath):
+            reference_pdb_found = True
+            break
+
+    if not reference_pdb_found:
+        print 'ERROR: reference PDB model not found in %s' % models_target_dir
+        return None
+
+    reference_sha1 = file_sha1(reference_pdb_filepath)
+
+    variants_filepath = os.path.join(models_target_dir, ensembler.core.protonation_variants_filename)
+    if os.path.exists(variants_filepath):
+        with open(variants_filepath) as variants_file:
+            variants_data = yaml.load(variants_file, Loader=ensembler.core.YamlLoader)
+        if (
+            variants_data.get('ff_files') == list(ff_files)
+            and variants_data.get('pH') == float(pH)
+            and variants_data.get('reference_template') == reference_template
+            and variants_data.get('reference_sha1') == reference_sha1
+        ):
+            if verbose:
+                print "Using cached protonation variants from %s (reference model: %s)" % (variants_filepath, reference_template)
+            return variants_data['variants']
+
+    with gzip.open(reference_pdb_filepath) as reference_pdb_file:
+        reference_pdb = app.PDBFile(reference_pdb_file)
+
+    if verbose:
+        print "Using %s as highest identity model (%s%%)" % (reference_template, reference_identity)
+
+    # Add missing protons.
+    modeller = app.Modeller(reference_pdb.topology, reference_pdb.positions)
+    variants = modeller.addHydrogens(forcefield, pH=pH)
+
+    variants_data = {
+        'reference_template': reference_template,
+        'reference_sha1': reference_sha1,
+        'ff_files': list(ff_files),
+        'pH': float(pH),
+        'variants': [str(variant) if variant is not None else None for variant in variants],
+    }
+    with open(variants_filepath, 'w') as variants_file:
+        yaml.dump(variants_data, variants_file, default_flow_style=False, Dumper=ensembler.core.YamlDumper)
+
+    return variants_data['variants']
+
+
+def repartition_hydrogen_mass(system, hydrogen_mass=4.0 * unit.amu):
+    """
+    Hydrogen mass repartitioning. The mass of each hydrogen is increased to hydrogen_mass, and the
+    added mass is subtracted from the heavy atom to which it is bonded, so the total mass is
+    unchanged. This slows the fastest remaining motions, allowing a timestep of ~4 fs to be used
+    with constrained bonds to hydrogen.
+
+    Hydrogens are identified by mass, and their heavy atoms from the System's constraints, so
+    bonds to hydrogen must be constrained (e.g. constraints=app.HBonds). Hydrogens constrained to
+    each other (i.e. those of rigid waters) are left unchanged. Hydrogens which have already been
+    repartitioned are not recognized as such, so repeated calls have no further effect.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+        Modified in place.
+    hydrogen_mass : simtk.unit.Quantity
+
+    Returns
+    -------
+    nrepartitioned : int
+        Number of hydrogens repartitioned
+    """
+    max_hydrogen_mass = 1.5 * unit.amu
+
+    def is_hydrogen(particle_index):
+        mass = system.getParticleMass(particle_index)
+        return 0.0 * unit.amu < mass < max_hydrogen_mass
+
+    heavy_atom_partners = {}
+    water_hydrogens = set()
+    for constraint_index in range(system.getNumConstraints()):
+        particle1, particle2, distance = system.getConstraintParameters(constraint_index)
+        particle1_is_hydrogen = is_hydrogen(particle1)
+        particle2_is_hydrogen = is_hydrogen(particle2)
+        if particle1_is_hydrogen and particle2_is_hydrogen:
+            water_hydrogens.update([particle1, particle2])
+        elif particle1_is_hydrogen:
+            heavy_atom_partners[particle1] = particle2
+        elif particle2_is_hydrogen:
+            heavy_atom_partners[particle2] = particle1
+
+    nrepartitioned = 0
+    for hydrogen_index, heavy_atom_index in heavy_atom_partners.items():
+        if hydrogen_index in water_hydrogens:
+            continue
+        transferred_mass = hydrogen_mass - system.getParticleMass(hydrogen_index)
+        system.setParticleMass(hydrogen_index, hydrogen_mass)
+        system.setParticleMass(heavy_atom_index, system.getParticleMass(heavy_atom_index) - transferred_mass)
+        nrepartitioned += 1
+    return nrepartitioned
+
+
+def get_cached_system(system_cache, topology, create_system):
+    """
+    Get the System for a Topology from a cache keyed by topology fingerprint (see
+    topology_fingerprint), constructing and caching it if there is none for an identical Topology.
+    A Context takes its own copy of the System, so the cached object can be reused.
+
+    Parameters
+    ----------
+    system_cache : dict
+        {topology fingerprint: simtk.openmm.System}
+    topology : simtk.openmm.app.Topology
+    create_system : function
+        Called with topology to construct the System if it is not cached.
+
+    Returns
+    -------
+    system : simtk.openmm.System
+    """
+    fingerprint = topology_fingerprint(topology)
+    if fingerprint not in system_cache:
+        system_cache[fingerprint] = create_system(topology)
+    return system_cache[fingerprint]
+
+
+def topology_fingerprint(topology):
+    """
+    Returns a hash which identifies an OpenMM Topology by its chains, residues, atoms and bonds, so
+    that a System constructed for one Topology can be reused for any other with the same
+    fingerprint.
+
+    Parameters
+    ----------
+    topology : simtk.openmm.app.Topology
+
+    Returns
+    -------
+    fingerprint : str
+    """
+    lines = []
+    for chain in topology.chains():
+        lines.append('chain')
+        for residue in chain.residues():
+            lines.append('residue %s' % residue.name)
+            for atom in residue.atoms():
+                element_symbol = atom.element.symbol if atom.element is not None else ''
+                lines.append('atom %s %s' % (atom.name, element_symbol))
+    for atom1, atom2 in topology.bonds():
+        lines.append('bond %d %d' % (atom1.index, atom2.index))
+    return hashlib.sha1('\n'.join(lines).encode('ascii')).hexdigest()
+
+
+def _expected_refinement_cost(model_dir, input_filename, output_filename, unique_by_clustering_only=False):
+    """Rough relative cost of a refinement task, used to order the MPI task queue.
+
+    Models which will be skipped (missing input, or output already present) are given zero cost.
+    Otherwise the size of the gzipped input model is used as a proxy for its number of atoms.
+    Previously failed runs (which will only be retried if retry_failed_runs is set) are also given
+    zero cost, as the log file is not parsed here.
+    """
+    input_filepath = os.path.join(model_dir, input_filename)
+    if not os.path.exists(input_filepath) or os.path.exists(os.path.join(model_dir, output_filename)):
+        return 0
+    if unique_by_clustering_only and not os.path.exists(os.path.join(model_dir, 'unique_by_clustering')):
+        return 0
+    return os.path.getsize(input_filepath)
+
+
 def auto_select_openmm_platform():
     for platform_name in ['CUDA', 'OpenCL', 'CPU', 'Reference']:
         try:
@@ -334,15 +745,440 @@ def auto_select_openmm_platform():
     raise Exception('No OpenMM platform found')
 
 
+# Approximate van der Waals radii (nm) of solute atoms, as used by app.Modeller.addSolvent
+# (sigma * 2**(1/6) / 2 for the amber99 atom types), keyed by element symbol
+nwaters_estimator_atom_radii = {
+    'H': 0.10,
+    'C': 0.19,
+    'N': 0.18,
+    'O': 0.17,
+    'S': 0.20,
+}
+nwaters_estimator_default_atom_radius = 0.19
+# Radius (nm) of a TIP3P water molecule, and the number density of the pre-equilibrated water box
+# used by app.Modeller.addSolvent (waters / nm**3)
+nwaters_estimator_water_radius = 0.177
+nwaters_estimator_water_density = 33.4
+
+
+def estimate_solute_excluded_volume(topology, positions, grid_spacing=0.1*unit.nanometers):
+    '''Estimate the volume from which water is excluded by a solute, by marking the points of a
+    grid which lie within (atom radius + water radius) of any solute atom.
+
+    Parameters
+    ----------
+    topology : simtk.openmm.app.Topology
+    positions : simtk.unit.Quantity wrapping list of simtk.openmm.Vec3
+    grid_spacing : simtk.unit.Quantity
+
+    Returns
+    -------
+    excluded_volume : simtk.unit.Quantity
+    '''
+    xyz = np.array(positions.value_in_unit(unit.nanometers))
+    grid_spacing = grid_spacing.value_in_unit(unit.nanometers)
+
+    atom_radii = np.array([
+        nwaters_estimator_atom_radii.get(atom.element.symbol if atom.element is not None else None, nwaters_estimator_default_atom_radius)
+        for atom in topology.atoms()
+    ])
+    exclusion_radii = atom_radii + nwaters_estimator_water_radius
+
+    # grid covering the solute plus the largest exclusion radius
+    grid_origin = xyz.min(axis=0) - exclusion_radii.max() - grid_spacing
+    grid_shape = np.ceil((xyz.max(axis=0) + exclusion_radii.max() + grid_spacing - grid_origin) / grid_spacing).astype(int)
+    xyz = xyz - grid_origin
+
+    excluded = np.zeros(grid_shape, dtype=bool)
+    atom_gridpoints = np.floor(xyz / grid_spacing).astype(int)
+    # each set of atoms with the same exclusion radius is processed with a single stencil of
+    # grid offsets, measured from the grid cell containing the atom
+    for exclusion_radius in np.unique(exclusion_radii):
+        atom_indices = np.where(exclusion_radii == exclusion_radius)[0]
+        max_offset = int(np.ceil(exclusion_radius / grid_spacing)) + 1
+        offset_range = np.arange(-max_offset, max_offset + 1)
+        offsets = np.array(np.meshgrid(offset_range, offset_range, offset_range, indexing='ij')).reshape(3, -1).T
+        for chunk_start in range(0, len(atom_indices), 500):
+            chunk_atom_indices = atom_indices[chunk_start:chunk_start+500]
+            gridpoints = atom_gridpoints[chunk_atom_indices][:, np.newaxis, :] + offsets[np.newaxis, :, :]
+            gridpoint_xyz = (gridpoints + 0.5) * grid_spacing
+            distances_sq = ((gridpoint_xyz - xyz[chunk_atom_indices][:, np.newaxis, :]) ** 2).sum(axis=2)
+            gridpoints = gridpoints[distances_sq < exclusion_radius ** 2]
+            excluded[gridpoints[:, 0], gridpoints[:, 1], gridpoints[:, 2]] = True
+
+    return excluded.sum() * grid_spacing ** 3 * unit.nanometers ** 3
+
+
+def estimate_nwaters(topology, positions, padding, grid_spacing=0.1*unit.nanometers, scale_factor=1.0):
+    '''Estimate the number of waters which app.Modeller.addSolvent would add to a model, without
+    solvating it.
+
+    The solvent box is a cube with edge length equal to the largest dimension of the model plus
+    2*padding, as constructed by addSolvent. The number of waters is the water density times the
+    volume of the box minus the volume excluded by the model (see
+    estimate_solute_excluded_volume).
+
+    Parameters
+    ----------
+    topology : simtk.openmm.app.Topology
+    positions : simtk.unit.Quantity wrapping list of simtk.openmm.Vec3
+    padding : simtk.unit.Quantity
+    grid_spacing : simtk.unit.Quantity
+    scale_factor : float
+        Multiplies the estimate, e.g. a correction factor obtained by calibration against
+        addSolvent (see solvate_models).
+
+    Returns
+    -------
+    nwaters : int
+    '''
+    xyz = np.array(positions.value_in_unit(unit.nanometers))
+    box_edge = (xyz.max(axis=0) - xyz.min(axis=0)).max() + 2 * padding.value_in_unit(unit.nanometers)
+    excluded_volume = estimate_solute_excluded_volume(topology, positions, grid_spacing=grid_spacing)
+    solvent_volume = box_edge ** 3 - excluded_volume.value_in_unit(unit.nanometers ** 3)
+    return int(round(scale_factor * nwaters_estimator_water_density * solvent_volume))
+
+
+def solvate_model(topology, positions, forcefield, padding):
+    '''Solvate a model using app.Modeller.addSolvent.
+
+    Returns
+    -------
+    modeller : simtk.openmm.app.Modeller
+        Contains the solvated model
+    nwaters : int
+        Number of waters added (not including any ions)
+    '''
+    modeller = app.Modeller(topology, positions)
+    modeller.addSolvent(forcefield, model='tip3p', padding=padding)
+    nsolute_residues = len([residue for residue in topology.residues()])
+    return modeller, len(get_water_residues(modeller.getTopology(), nsolute_residues))
+
+
+def get_water_residues(topology, nsolute_residues):
+    '''Returns the water residues of a solvated model, i.e. those following the first
+    nsolute_residues residues.
+    '''
+    return [residue for (residue_index, residue) in enumerate(topology.residues()) if residue_index >= nsolute_residues and residue.name == 'HOH']
+
+
+def delete_farthest_waters(modeller, nsolute_residues, target_nwaters):
+    '''Delete waters from a solvated model, in order of decreasing distance from the solute, to
+    leave target_nwaters waters.
+
+    The distance of each water is measured from its oxygen to the nearest solute heavy atom, using
+    the minimum image convention. Ties are resolved by residue order, so the result is
+    deterministic.
+
+    Parameters
+    ----------
+    modeller : simtk.openmm.app.Modeller
+        Modified in place. The solute must be contained in the first nsolute_residues residues.
+    nsolute_residues : int
+    target_nwaters : int
+
+    Returns
+    -------
+    nwaters : int
+        Number of waters remaining
+    '''
+    topology = modeller.getTopology()
+    water_residues = get_water_residues(topology, nsolute_residues)
+    nwaters = len(water_residues)
+    ndelete = nwaters - target_nwaters
+    if ndelete <= 0:
+        return nwaters
+
+    xyz = np.array(modeller.getPositions().value_in_unit(unit.nanometers))
+    box = np.array(topology.getUnitCellDimensions().value_in_unit(unit.nanometers))
+    solute_heavy_atom_indices = [
+        atom.index for (residue_index, residue) in enumerate(topology.residues()) if residue_index < nsolute_residues
+        for atom in residue.atoms() if atom.element is None or atom.element.symbol != 'H'
+    ]
+    solute_heavy_atom_xyz = xyz[solute_heavy_atom_indices]
+    water_oxygen_xyz = np.array([xyz[[atom for atom in residue.atoms()][0].index] for residue in water_residues])
+
+    water_solute_distances = np.zeros(nwaters)
+    for chunk_start in range(0, nwaters, 256):
+        displacements = water_oxygen_xyz[chunk_start:chunk_start+256, np.newaxis, :] - solute_heavy_atom_xyz[np.newaxis, :, :]
+        displacements -= box * np.round(displacements / box)
+        water_solute_distances[chunk_start:chunk_start+256] = np.sqrt((displacements ** 2).sum(axis=2).min(axis=1))
+
+    # stable sort, so that ties are resolved by residue order
+    farthest_water_indices = np.argsort(-water_solute_distances, kind='mergesort')[:ndelete]
+    modeller.delete([water_residues[index] for index in sorted(farthest_water_indices)])
+    return target_nwaters
+
+
+def file_sha1(filepath):
+    with open(filepath, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def write_solvated_model_npz(filepath, topology, positions, nsolute_residues, solute_sha1, water_model='tip3p'):
+    '''Write the solvent (waters and ions) of a solvated model to a compressed NumPy archive. The
+    solute is not stored, but referred to by the SHA-1 of the file from which it was read
+    (i.e. implicit-refined.pdb.gz). See read_solvated_model_npz.
+
+    Parameters
+    ----------
+    filepath : str
+    topology : simtk.openmm.app.Topology
+    positions : simtk.unit.Quantity wrapping list of simtk.openmm.Vec3
+    nsolute_residues : int
+        The solute is contained in the first nsolute_residues residues.
+    solute_sha1 : str
+    water_model : str
+    '''
+    solvent_residues = [residue for (residue_index, residue) in enumerate(topology.residues()) if residue_index >= nsolute_residues]
+    solvent_atoms = [atom for residue in solvent_residues for atom in residue.atoms()]
+    first_solvent_atom_index = solvent_atoms[0].index if len(solvent_atoms) > 0 else 0
+    xyz = np.array(positions.value_in_unit(unit.nanometers))
+    solvent_bonds = [
+        (atom1.index - first_solvent_atom_index, atom2.index - first_solvent_atom_index)
+        for (atom1, atom2) in topology.bonds() if atom1.index >= first_solvent_atom_index and atom2.index >= first_solvent_atom_index
+    ]
+    with open(filepath, 'wb') as npz_file:
+        np.savez_compressed(
+            npz_file,
+            solute_sha1=np.array(solute_sha1),
+            water_model=np.array(water_model),
+            unit_cell_dimensions=np.array(topology.getUnitCellDimensions().value_in_unit(unit.nanometers)),
+            residue_names=np.array([residue.name for residue in solvent_residues]),
+            residue_natoms=np.array([len([atom for atom in residue.atoms()]) for residue in solvent_residues], dtype=int),
+            atom_names=np.array([atom.name for atom in solvent_atoms]),
+            atom_elements=np.array([atom.element.symbol if atom.element is not None else '' for atom in solvent_atoms]),
+            bonds=np.array(solvent_bonds, dtype=int).reshape(-1, 2),
+            positions=xyz[first_solvent_atom_index:].astype(np.float32),
+        )
+
+
+def read_solvated_model_npz(filepath, solute_topology, solute_positions):
+    '''Read the solvent written by write_solvated_model_npz, and combine it with the solute.
+
+    Parameters
+    ----------
+    filepath : str
+    solute_topology : simtk.openmm.app.Topology
+    solute_positions : simtk.unit.Quantity wrapping list of simtk.openmm.Vec3
+
+    Returns
+    -------
+    modeller : simtk.openmm.app.Modeller
+        Contains the solvated model
+    solute_sha1 : str
+    water_model : str
+    '''
+    with open(filepath, 'rb') as npz_file:
+        npz = np.load(npz_file)
+        solute_sha1 = str(npz['solute_sha1'])
+        water_model = str(npz['water_model'])
+        unit_cell_dimensions = npz['unit_cell_dimensions']
+        residue_names = npz['residue_names']
+        residue_natoms = npz['residue_natoms']
+        atom_names = npz['atom_names']
+        atom_elements = npz['atom_elements']
+        bonds = npz['bonds']
+        solvent_xyz = npz['positions'].astype(np.float64)
+
+    solvent_topology = app.Topology()
+    solvent_chain = solvent_topology.addChain()
+    solvent_atoms = []
+    for residue_name, natoms in zip(residue_names, residue_natoms):
+        residue = solvent_topology.addResidue(str(residue_name), solvent_chain)
+        for atom_index in range(len(solvent_atoms), len(solvent_atoms) + natoms):
+            element = app.element.get_by_symbol(str(atom_elements[atom_index])) if atom_elements[atom_index] else None
+            solvent_atoms.append(solvent_topology.addAtom(str(atom_names[atom_index]), element, residue))
+    for atom_index1, atom_index2 in bonds:
+        solvent_topology.addBond(solvent_atoms[atom_index1], solvent_atoms[atom_index2])
+
+    modeller = app.Modeller(solute_topology, solute_positions)
+    modeller.add(solvent_topology, [openmm.Vec3(*atom_xyz) for atom_xyz in solvent_xyz] * unit.nanometers)
+    modeller.topology.setUnitCellDimensions(openmm.Vec3(*unit_cell_dimensions) * unit.nanometers)
+    return modeller, solute_sha1, water_model
+
+
+# Approximate number of atoms per OpenMM CPU thread at which refinement simulations scale well
+cpu_packing_natoms_per_thread = {
+    'refine_implicit_md': 1500,
+    'refine_explicit_md': 10000,
+}
+
+
+def estimate_refinement_natoms(project_stage, process_only_these_targets=None):
+    '''Estimate the number of atoms in the systems simulated by a refinement stage, from the first
+    model found for each target.
+
+    For refine_implicit_md, hydrogens are added before simulation, so models without hydrogens
+    are assumed to gain roughly one per heavy atom. For refine_explicit_md, the number of atoms in
+    the waters to be added (nwaters-use.txt) is included.
+
+    Parameters
+    ----------
+    project_stage : str
+        refine_implicit_md|refine_explicit_md
+    process_only_these_targets : list of str
+
+    Returns
+    -------
+    natoms : int or None
+        The largest estimate over all targets, or None if no models were found.
+    '''
+    models_dir = os.path.abspath(ensembler.core.default_project_dirnames.models)
+    model_filename = {'refine_implicit_md': 'model.pdb.gz', 'refine_explicit_md': 'implicit-refined.pdb.gz'}[project_stage]
+    natoms_estimates = []
+    for target_id in sorted(os.listdir(models_dir)):
+        if process_only_these_targets and target_id not in process_only_these_targets: continue
+        models_target_dir = os.path.join(models_dir, target_id)
+        if not os.path.isdir(models_target_dir): continue
+        for template_id in sorted(os.listdir(models_target_dir)):
+            model_filepath = os.path.join(models_target_dir, template_id, model_filename)
+            if not os.path.exists(model_filepath): continue
+            with gzip.open(model_filepath) as model_file:
+                atom_names = [line[12:16].strip() for line in model_file if line.startswith('ATOM') or line.startswith('HETATM')]
+            natoms = len(atom_names)
+            if project_stage == 'refine_implicit_md' and not any(atom_name.startswith('H') for atom_name in atom_names):
+                natoms *= 2
+            elif project_stage == 'refine_explicit_md':
+                nwaters_filepath = os.path.join(models_target_dir, 'nwaters-use.txt')
+                if os.path.exists(nwaters_filepath):
+                    with open(nwaters_filepath) as nwaters_file:
+                        natoms += 3 * int(nwaters_file.readline())
+            natoms_estimates.append(natoms)
+            break
+    if len(natoms_estimates) == 0:
+        return None
+    return max(natoms_estimates)
+
+
+def choose_cpu_threads(natoms, ncpus, natoms_per_thread):
+    '''Choose the number of OpenMM CpuThreads to use for a simulation of natoms atoms, such that
+    each thread has roughly natoms_per_thread atoms, limited to ncpus.
+    '''
+    return int(max(1, min(ncpus, round(float(natoms) / natoms_per_thread))))
+
+
+def cpu_packing_available():
+    '''Whether the available CPU cores can be packed with concurrent local worker processes (see
+    run_with_cpu_packing), i.e. whether this is the only process and MPI has not yet been
+    initialized. If MPI has been initialized with a single rank, a warning is logged, and the
+    stage instead runs one task at a time, pinned to the rank's share of the CPU cores.
+    '''
+    if mpistate.is_single_process():
+        return True
+    if ensembler.core.mpi_initialized() and mpistate.size == 1:
+        logger.warning(
+            'cpu_packing: MPI has already been initialized, so local worker processes cannot be '
+            'started; running refinement tasks one at a time instead.'
+        )
+    return False
+
+
+def run_with_cpu_packing(stage_function, stage_kwargs, project_stage):
+    '''Run a refinement stage with the available CPU cores packed with concurrent tasks.
+
+    The number of CpuThreads per task is chosen from the estimated system size, and the cores
+    are split into that many core sets. A local worker process (see
+    ensembler.core.MPIState.local_executor) is started for each core set, pinned to it, and runs
+    the stage with cpu_platform_threads set to the size of its core set.
+
+    If the stage raises an exception on any worker, the failure is logged with the worker's core
+    set and reported to the other workers, which stop before starting their next task (see
+    ensembler.core.LocalComm); a LocalWorkerError is then raised.
+
+    Parameters
+    ----------
+    stage_function : function
+        refine_implicit_md|refine_explicit_md
+    stage_kwargs : dict
+        Arguments with which the stage function was called
+    project_stage : str
+    '''
+    cpus = ensembler.core.get_available_cpus()
+    natoms = estimate_refinement_natoms(project_stage, process_only_these_targets=stage_kwargs['process_only_these_targets'])
+    if natoms is None:
+        nthreads = len(cpus)
+    else:
+        nthreads = choose_cpu_threads(natoms, len(cpus), cpu_packing_natoms_per_thread[project_stage])
+    ntasks = max(1, len(cpus) // nthreads)
+    core_sets = ensembler.core.split_cpus(cpus, ntasks)
+    logger.info(
+        'CPU packing: %d CPUs available; running %d concurrent tasks with %s CpuThreads each '
+        '(estimated system size: %s atoms)' % (
+            len(cpus), ntasks, '/'.join(sorted(set(['%d' % len(core_set) for core_set in core_sets]))), natoms
+        )
+    )
+
+    stage_kwargs = dict(stage_kwargs)
+    stage_kwargs['cpu_packing'] = False
+    stage_kwargs['openmm_platform'] = 'CPU'
+    try:
+        with mpistate.local_executor(ntasks):
+            core_set = core_sets[mpistate.rank]
+            ensembler.core.set_cpu_affinity(core_set)
+            stage_kwargs['cpu_platform_threads'] = len(core_set)
+            try:
+                stage_function(**stage_kwargs)
+            except ensembler.core.LocalWorkerError:
+                # another worker failed
+                raise
+            except Exception:
+                logger.error(
+                    'CPU packing worker %d (CPUs %s) failed in %s' % (
+                        mpistate.rank, ','.join(['%d' % cpu for cpu in core_set]), project_stage
+                    )
+                )
+                # re-raised, so that the local executor reports the failure to the other workers
+                raise
+    finally:
+        ensembler.core.set_cpu_affinity(cpus)
+
+
+def pin_to_node_cpu_share():
+    '''Pin this rank to its share of the CPU cores on its node (see
+    ensembler.core.MPIState.node_cpu_share). Must be called by all ranks.
+
+    Returns
+    -------
+    ncpus : int
+        Number of CPUs in this rank's share
+    '''
+    cpus = mpistate.node_cpu_share()
+    ensembler.core.set_cpu_affinity(cpus)
+    logger.debug('Rank %d pinned to CPUs %s' % (mpistate.rank, ','.join(['%d' % cpu for cpu in cpus])))
+    return len(cpus)
+
+
 def solvate_models(process_only_these_targets=None, process_only_these_templates=None,
                    template_seqid_cutoff=None,
                    ff='amber99sbildn',
                    water_model='tip3p',
                    verbose=False,
-                   padding=None):
+                   padding=None,
+                   estimate_nwaters_analytically=False,
+                   calibration_sample_size=0,
+                   keep_solvated_models=False):
     '''Solvate models which have been subjected to MD refinement with implicit solvent.
 
     MPI-enabled.
+
+    Parameters
+    ----------
+    estimate_nwaters_analytically : bool
+        Rather than solvating each model, estimate the number of waters from the volume of the
+        solvent box minus the volume excluded by the model (see estimate_nwaters). This is much
+        faster, since the solvated coordinates are not used.
+    calibration_sample_size : int
+        If estimating analytically, first solvate a sample of this many models per target (evenly
+        spaced across the selected templates) with app.Modeller.addSolvent. The ratio of the
+        solvated to the estimated number of waters across the sample is used to scale the
+        estimates for all other models, and the calibration is recorded in the stage metadata.
+        Sampled models are given their solvated number of waters.
+    keep_solvated_models : bool
+        Write the solvent of each solvated model to a compressed NumPy archive
+        ([model_dir]/solvated-model.npz; see write_solvated_model_npz). refine_explicit_md then
+        reaches the target number of waters by trimming this box, rather than solvating again.
+        Ignored if estimating analytically.
     '''
     if padding is None:
         padding = 10.0 * unit.angstroms
@@ -379,7 +1215,86 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
 
         ntemplates_selected = len(selected_template_indices)
 
-        for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
+        def expected_solvation_cost(template_index):
+            template = templates_resolved_seq[selected_template_indices[template_index]]
+            return _expected_refinement_cost(os.path.join(models_target_dir, template.id), 'implicit-refined.pdb.gz', 'nwaters.txt')
+
+        def unsolvated_model_filename(template_index):
+            template = templates_resolved_seq[selected_template_indices[template_index]]
+            model_dir = os.path.join(models_target_dir, template.id)
+            model_filename = os.path.join(model_dir, 'implicit-refined.pdb.gz')
+            if os.path.exists(model_filename) and not os.path.exists(os.path.join(model_dir, 'nwaters.txt')):
+                return model_filename
+
+        # ===========
+        # Calibration
+        # ===========
+
+        scale_factor = 1.0
+        calibration = None
+        calibration_template_indices = []
+        if estimate_nwaters_analytically and calibration_sample_size > 0:
+            if mpistate.rank == 0:
+                unsolvated_template_indices = [
+                    template_index for template_index in range(ntemplates_selected)
+                    if unsolvated_model_filename(template_index)
+                ]
+                if len(unsolvated_template_indices) > 0:
+                    sample_indices = np.unique(np.linspace(0, len(unsolvated_template_indices) - 1, calibration_sample_size).astype(int))
+                    calibration_template_indices = [unsolvated_template_indices[i] for i in sample_indices]
+            calibration_template_indices = mpistate.comm.bcast(calibration_template_indices, root=0)
+
+            calibration_data = []
+            for template_index in mpistate.iter_tasks(calibration_template_indices, key=expected_solvation_cost):
+                try:
+                    model_filename = unsolvated_model_filename(template_index)
+                    if model_filename is None:
+                        # solvated (or removed) since the calibration sample was chosen
+                        continue
+                    with gzip.open(model_filename) as model_file:
+                        pdb = app.PDBFile(model_file)
+                    nwaters_estimated = estimate_nwaters(pdb.topology, pdb.positions, padding)
+                    modeller, nwaters_solvated = solvate_model(pdb.topology, pdb.positions, forcefield, padding)
+                    calibration_data.append((template_index, nwaters_estimated, nwaters_solvated))
+                except Exception as e:
+                    # the model is handled (and any error recorded) in the main loop below
+                    logger.debug('nwaters estimator calibration failed for template index %d: %r' % (template_index, e))
+            calibration_data_gathered = mpistate.comm.gather(calibration_data, root=0)
+
+            if mpistate.rank == 0:
+                calibration_data = sorted(sum(calibration_data_gathered, []))
+                if len(calibration_data) > 0:
+                    nwaters_estimated = np.array([data[1] for data in calibration_data], dtype=float)
+                    nwaters_solvated = np.array([data[2] for data in calibration_data], dtype=float)
+                    scale_factor = nwaters_solvated.sum() / nwaters_estimated.sum()
+                    relative_errors = (nwaters_estimated - nwaters_solvated) / nwaters_solvated
+                    calibrated_relative_errors = (scale_factor * nwaters_estimated - nwaters_solvated) / nwaters_solvated
+                    calibration = {
+                        'nsamples': len(calibration_data),
+                        'scale_factor': float(scale_factor),
+                        'mean_abs_relative_error': float(np.abs(relative_errors).mean()),
+                        'max_abs_relative_error': float(np.abs(relative_errors).max()),
+                        'calibrated_mean_abs_relative_error': float(np.abs(calibrated_relative_errors).mean()),
+                        'calibrated_max_abs_relative_error': float(np.abs(calibrated_relative_errors).max()),
+                    }
+                    logger.info(
+                        'nwaters estimator calibration (target: %s, %d models): scale factor = %.4f, '
+                        'mean abs relative error = %.4f (uncalibrated: %.4f)' % (
+                            target.id, len(calibration_data), scale_factor,
+                            calibration['calibrated_mean_abs_relative_error'], calibration['mean_abs_relative_error']
+                        )
+                    )
+                    for template_index, nwaters_estimated, nwaters_solvated in calibration_data:
+                        template = templates_resolved_seq[selected_template_indices[template_index]]
+                        with open(os.path.join(models_target_dir, template.id, 'nwaters.txt'), 'w') as nwaters_file:
+                            nwaters_file.write('%d\n' % nwaters_solvated)
+            scale_factor = mpistate.comm.bcast(scale_factor, root=0)
+
+        # ========
+        # Solvate
+        # ========
+
+        for template_index in mpistate.iter_tasks(range(ntemplates_selected), key=expected_solvation_cost):
             template = templates_resolved_seq[selected_template_indices[template_index]]
 
             model_dir = os.path.join(models_target_dir, template.id)
@@ -402,25 +1317,21 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
                 with gzip.open(model_filename) as model_file:
                     pdb = app.PDBFile(model_file)
 
-                # Count initial atoms.
-                natoms_initial = len(pdb.positions)
-
-                # Add solvent
-                if verbose: print "Solvating model..."
-                modeller = app.Modeller(pdb.topology, pdb.positions)
-                modeller.addSolvent(forcefield, model='tip3p', padding=padding)
-                positions = modeller.getPositions()
-
-                # Get number of particles per water molecule by inspecting the last residue in the topology
-                resi_generator = modeller.topology.residues()
-                resi_deque = deque(resi_generator, maxlen=1)
-                last_resi = resi_deque.pop()
-                nparticles_per_water = len([atom for atom in last_resi.atoms()])
-
-                # Count final atoms.
-                natoms_final = len(positions)
-                nwaters = (natoms_final - natoms_initial) / nparticles_per_water
-                if verbose: print "Solvated model contains %d waters" % nwaters
+                if estimate_nwaters_analytically:
+                    if verbose: print "Estimating number of waters..."
+                    nwaters = estimate_nwaters(pdb.topology, pdb.positions, padding, scale_factor=scale_factor)
+                    if verbose: print "Solvated model estimated to contain %d waters" % nwaters
+                else:
+                    if verbose: print "Solvating model..."
+                    modeller, nwaters = solvate_model(pdb.topology, pdb.positions, forcefield, padding)
+                    if verbose: print "Solvated model contains %d waters" % nwaters
+                    if keep_solvated_models:
+                        write_solvated_model_npz(
+                            os.path.join(model_dir, ensembler.core.solvated_model_filename),
+                            modeller.getTopology(), modeller.getPositions(),
+                            len([residue for residue in pdb.topology.residues()]),
+                            file_sha1(model_filename), water_model='tip3p'
+                        )
 
                 # Record waters.
                 with open(nwaters_filename, 'w') as nwaters_file:
@@ -445,6 +1356,9 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
                 'template_seqid_cutoff': template_seqid_cutoff,
                 'process_only_these_targets': process_only_these_targets,
                 'process_only_these_templates': process_only_these_templates,
+                'nwaters_method': 'estimate' if estimate_nwaters_analytically else 'solvate',
+                'nwaters_estimator_calibration': calibration,
+                'keep_solvated_models': keep_solvated_models,
                 'python_version': sys.version.split('|')[0].strip(),
                 'python_full_version': ensembler.core.literal_str(sys.version),
                 'ensembler_version': ensembler.version.short_version,
@@ -604,11 +1518,50 @@ def refine_explicit_md(
         minimization_steps=20,
         write_solvated_model=False, careful_cleaning=True,
         cpu_platform_threads=1,
-        retry_failed_runs=False):
+        retry_failed_runs=False,
+        write_coordinate_store=False,
+        checkpoint_interval=None,
+        trajectory_format='pdb.gz',
+        trajectory_stride=1,
+        trajectory_protein_only=True,
+        adaptive_sim_length=False,
+        min_sim_length=20.0 * unit.picoseconds,
+        plateau_window=20,
+        plateau_tolerance=1.0,
+        hmr=False,
+        hydrogen_mass=4.0 * unit.amu,
+        reuse_solvated_models=True,
+        cpu_packing=False):
     '''Run MD refinement in explicit solvent.
 
     MPI-enabled.
+
+    If write_trajectory is True, frames are written to 'explicit-trajectory.[trajectory_format]',
+    with the trajectory_* options as described for refine_implicit_md. By default, only protein
+    atoms are written.
+
+    If write_coordinate_store is True, refined models are also added to a per-target coordinate
+    store (see ensembler.coordinate_store.CoordinateStore).
+
+    If checkpoint_interval is set, unfinished simulations are resumed from periodic checkpoints
+    ('explicit-checkpoint.chk'), as described for refine_implicit_md.
+
+    If adaptive_sim_length is True, simulations are stopped once the potential energy has
+    plateaued, as described for refine_implicit_md.
+
+    If hmr is True, hydrogen masses are repartitioned, as described for refine_implicit_md. The
+    repartitioned masses are retained in the serialized System ('explicit-system.xml.gz').
+
+    If reuse_solvated_models is True, models whose solvated box was stored by solvate_models
+    (keep_solvated_models=True) are brought to the target number of waters by trimming that box,
+    rather than being solvated again.
+
+    If cpu_packing is True, CPU cores are split between concurrent refinement tasks, as described
+    for refine_implicit_md.
     '''
+    if cpu_packing and cpu_packing_available():
+        return run_with_cpu_packing(refine_explicit_md, dict(locals()), 'refine_explicit_md')
+
     gpuid = mpistate.rank % gpupn
 
     models_dir = os.path.abspath(ensembler.core.default_project_dirnames.models)
@@ -620,7 +1573,12 @@ def refine_explicit_md(
     else:
         selected_template_indices = range(len(templates_resolved_seq))
 
-    if not openmm_platform:
+    if cpu_packing:
+        if openmm_platform not in (None, 'CPU'):
+            raise Exception('cpu_packing can only be used with the OpenMM CPU platform')
+        openmm_platform = 'CPU'
+        cpu_platform_threads = pin_to_node_cpu_share()
+    elif not openmm_platform:
         openmm_platform = auto_select_openmm_platform()
 
     if openmm_platform == 'CPU':
@@ -638,6 +1596,7 @@ def refine_explicit_md(
 
     nsteps_per_iteration = 500
     niterations = int((sim_length / timestep) / nsteps_per_iteration)
+    min_niterations = int((min_sim_length / timestep) / nsteps_per_iteration)
 
     def solvate_pdb(pdb, target_nwaters, water_model=water_model):
         """
@@ -659,93 +1618,80 @@ def refine_explicit_md(
 
         ALGORITHM
 
-        The system is initially solvated with a box of size 'boxsize_guess'.
-        If the system has too few waters, the boxsize is scaled by boxsize_enlarge_factor
-        Once a sufficient number of waters are present, the last few waters are deleted to ensure target_nwaters is achieved.
-
-        TODO
-
-        There is no error checking to be sure that waters are not initially present in the system or that initially-present molecules are not deleted.
+        If solvate_models stored a solvated box for this model (see write_solvated_model_npz),
+        holding between target_nwaters and 10% more waters, that box is used. Otherwise, a cubic
+        box is chosen to hold slightly more than target_nwaters waters, given the density of water
+        and the volume excluded by the solute (see estimate_solute_excluded_volume), and the system
+        is solvated once. addSolvent is run with a fixed random seed (used to place ions), and if
+        the box nonetheless holds too few waters, the water density observed in that box is used
+        to choose a larger one. The waters farthest from the solute are then deleted to achieve
+        target_nwaters, so the result is deterministic.
 
         """
 
-        natoms_per_solvent = 3
+        # Fractional excess of waters to aim for before trimming, and max number of solvation attempts
+        nwaters_excess_fraction = 0.05
+        max_solvation_attempts = 5
+        # Max fractional excess of waters in a stored solvated model to be trimmed
+        max_reused_nwaters_excess_fraction = 0.1
+
+        nresidues_initial = len([r for r in pdb.topology.residues()])
+        if verbose: print "System initially has %d atoms (0 waters)" % (len(pdb.positions))
+
+        # Reuse the solvated model written by solvate_models, if it was solvated from the same
+        # model with the same water model, and has enough (but not too many) waters
+        modeller = None
+        solvated_model_filepath = os.path.join(model_dir, ensembler.core.solvated_model_filename)
+        if reuse_solvated_models and os.path.exists(solvated_model_filepath):
+            stored_modeller, solute_sha1, stored_water_model = read_solvated_model_npz(solvated_model_filepath, pdb.topology, pdb.positions)
+            nwaters = len(get_water_residues(stored_modeller.getTopology(), nresidues_initial))
+            if solute_sha1 != file_sha1(model_filename) or stored_water_model != water_model:
+                if verbose: print "Stored solvated model is out of date; resolvating..."
+            elif not target_nwaters <= nwaters <= target_nwaters * (1.0 + max_reused_nwaters_excess_fraction):
+                if verbose: print "Stored solvated model has %d waters; resolvating..." % nwaters
+            else:
+                if verbose: print "Reusing stored solvated model with %d waters" % nwaters
+                modeller = stored_modeller
+
+        if modeller is None:
+            solute_xyz = np.array(pdb.positions.value_in_unit(unit.nanometers))
+            solute_extent = (solute_xyz.max(axis=0) - solute_xyz.min(axis=0)).max()
+            excluded_volume = estimate_solute_excluded_volume(pdb.topology, pdb.positions).value_in_unit(unit.nanometers**3)
+            density = nwaters_estimator_water_density
+
+            # Solvate a box slightly larger than required for target_nwaters.
+            for attempt in range(max_solvation_attempts):
+                box_edge = max(solute_extent, (target_nwaters * (1.0 + nwaters_excess_fraction) / density + excluded_volume) ** (1.0/3.0))
+                if verbose: print "Final target of %d waters, so attempting box size %.3f nm..." % (target_nwaters, box_edge)
+                modeller = app.Modeller(pdb.topology, pdb.positions)
+                topology = modeller.getTopology()
+                topology.setUnitCellDimensions(openmm.Vec3(box_edge, box_edge, box_edge) * unit.nanometers)
+                # addSolvent places neutralizing ions at randomly chosen waters; use a fixed seed so
+                # that the solvated system is reproducible, without disturbing the global random state
+                random_state = random.getstate()
+                random.seed(0)
+                try:
+                    modeller.addSolvent(forcefield, model=water_model)
+                finally:
+                    random.setstate(random_state)
+                nwaters = len(get_water_residues(modeller.getTopology(), nresidues_initial))
+                if verbose: print "  actual %d waters" % nwaters
+                if nwaters >= target_nwaters:
+                    break
+                density = nwaters / (box_edge**3 - excluded_volume)
+            else:
+                raise Exception("Malfunction in solvate_pdb: failed to solvate with at least %d waters after %d attempts" % (target_nwaters, max_solvation_attempts))
 
-        # Count initial atoms.
-        natoms_initial = len(pdb.positions)
-        if verbose: print "System initially has %d atoms (0 waters)" % (natoms_initial)
+        # Delete the waters farthest from the solute to achieve target.
+        if verbose: print "Will delete %d waters..." % (nwaters - target_nwaters)
+        delete_farthest_waters(modeller, nresidues_initial, target_nwaters)
 
-        # Solvate with zero padding to determine min number of waters and minimal unit cell dimensions.
-        modeller = app.Modeller(pdb.topology, pdb.positions)
-        modeller.addSolvent(forcefield, model=water_model, padding=0.0*unit.angstroms)
-        topology = modeller.getTopology()
-        positions = modeller.getPositions()
-        box_min = topology.getUnitCellDimensions()
-        natoms_min = len(positions) # minimal number of atoms
-        nwaters_min = (natoms_min - natoms_initial) / natoms_per_solvent # minimal number of waters
-        volume_min = box_min[0] * box_min[1] * box_min[2]
-        residues = [ r for r in topology.residues() ] # build a list of residues
-        nresidues_min = len(residues) # number of residues
-        if verbose: print "Minimally solvated system has %d atoms (%d waters)" % (natoms_min, nwaters_min)
-
-        # Increase the box size by 10% and resolvate.
-        scale = 1.1
-        modeller = app.Modeller(pdb.topology, pdb.positions)
+        # Get topology and positions.
         topology = modeller.getTopology()
-        topology.setUnitCellDimensions(box_min * scale)
-        modeller.addSolvent(forcefield, model=water_model)
         positions = modeller.getPositions()
-        box_enlarged = topology.getUnitCellDimensions()
-        natoms_enlarged = len(positions) # minimal number of atoms
-        nwaters_enlarged = (natoms_enlarged - natoms_initial) / natoms_per_solvent # minimal number of waters
-        volume_enlarged = box_enlarged[0] * box_enlarged[1] * box_enlarged[2]
-        density = (nwaters_enlarged - nwaters_min) / (volume_enlarged - volume_min)
-        if verbose: print "Enlarged solvated system has %d atoms (%d waters) : density of %.3f waters / nm^3" % (natoms_enlarged, nwaters_enlarged, density / (1.0 / unit.nanometer**3))
-
-        # Aim for slightly more waters than target.
-        over_target = False
-        extra_nwaters = 100
-        while not over_target:
-            delta_volume = (target_nwaters + extra_nwaters - nwaters_min) / density
-            scale = ((volume_min + delta_volume) / volume_min)**(1.0/3.0)
-            if verbose: print "Final target of %d waters, so attempting box size %s to achieve %d waters..." % (target_nwaters, str(box_min * scale), target_nwaters + extra_nwaters)
-            delta_volume = (target_nwaters + extra_nwaters - nwaters_min) / density
-            modeller = app.Modeller(pdb.topology, pdb.positions)
-            topology = modeller.getTopology()
-            topology.setUnitCellDimensions(box_min * scale)
-            modeller.addSolvent(forcefield, model=water_model)
-            positions = modeller.getPositions()
-            topology = modeller.getTopology()
-            natoms = len(positions) # minimal number of atoms
-            nwaters = (natoms - natoms_initial) / natoms_per_solvent # minimal number of waters
-            if verbose: print "  actual %d waters" % nwaters
-            if (nwaters > target_nwaters):
-                over_target = True
-            else:
-                extra_nwaters += 100
-
-        # Delete waters to achieve target.
-        ndelete = nwaters - target_nwaters
-        if (ndelete > 0):
-            if verbose: print "Will delete %d waters..." % ndelete
-            residues = [ r for r in topology.residues() ] # build a list of residues
-            nresidues = len(residues)
-
-            # Select a random subset to delete.
-            indices = np.random.permutation(range(nresidues_min,nresidues))
-            residues_to_delete = list()
-            for index in indices[0:ndelete]:
-                residues_to_delete.append(residues[index])
 
-            modeller.delete(residues_to_delete)
-
-            # Get topology and positions.
-            topology = modeller.getTopology()
-            positions = modeller.getPositions()
-
-            # Count number of waters.
-            natoms_final = len(positions)
-            nwaters = (natoms_final - natoms_initial) / 3
+        # Count number of waters.
+        nwaters = len(get_water_residues(topology, nresidues_initial))
 
         if (nwaters != target_nwaters):
             raise Exception("Malfunction in solvate_pdb: nwaters = %d, target_nwaters = %d" % (nwaters, target_nwaters))
@@ -773,6 +1719,9 @@ def refine_explicit_md(
         if verbose: print "Constructing System object..."
         system = forcefield.createSystem(topology, nonbondedMethod=nonbondedMethod, constraints=app.HBonds)
         if verbose: print "  system has %d atoms" % (system.getNumParticles())
+        if hmr:
+            if verbose: print "Repartitioning hydrogen masses..."
+            repartition_hydrogen_mass(system, hydrogen_mass=hydrogen_mass)
 
         # Add barostat.
         if verbose: print "Adding barostat..."
@@ -784,26 +1733,36 @@ def refine_explicit_md(
         context = openmm.Context(system, integrator, platform, platform_properties)
         context.setPositions(positions)
 
-        if verbose: print "Minimizing structure..."
-        openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
+        checkpoint_filename = os.path.join(model_dir, 'explicit-checkpoint.chk')
+        start_iteration = 0
+        if checkpoint_interval:
+            start_iteration = load_checkpoint(context, checkpoint_filename, nsteps_per_iteration * timestep, verbose=verbose)
+
+        if start_iteration == 0:
+            if verbose: print "Minimizing structure..."
+            openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
 
         if write_trajectory:
-            # Open trajectory for writing.
+            # Open trajectory for writing. When resuming, frames written since the last
+            # checkpoint are discarded, as for the energies.
             if verbose: print "Opening trajectory for writing..."
-            trajectory_filename = os.path.join(model_dir, 'explicit-trajectory.pdb.gz')
-            trajectory_outfile = gzip.open(trajectory_filename, 'w')
-            app.PDBFile.writeHeader(pdb.topology, file=trajectory_outfile)
+            trajectory_reporter = ensembler.reporters.open_trajectory_reporter(
+                model_dir, 'explicit', topology, context, trajectory_format=trajectory_format,
+                stride=trajectory_stride, protein_only=trajectory_protein_only, start_iteration=start_iteration
+            )
 
         # Open energy trajectory for writing
         energy_filename = os.path.join(model_dir, 'explicit-energies.txt')
-        energy_outfile = open(energy_filename, 'w')
-        energy_outfile.write('# iteration | simulation time (ps) | potential_energy (kT) | kinetic_energy (kT) | volume (nm^3) | ns per day\n')
+        energy_outfile = open_energy_file(energy_filename, '# iteration | simulation time (ps) | potential_energy (kT) | kinetic_energy (kT) | volume (nm^3) | ns per day\n', start_iteration)
+        potential_energies = read_potential_energies(energy_filename) if start_iteration > 0 else []
 
         if verbose: print "Running dynamics..."
-        context.setVelocitiesToTemperature(temperature)
+        if start_iteration == 0:
+            context.setVelocitiesToTemperature(temperature)
         import time
         initial_time = time.time()
-        for iteration in range(niterations):
+        initial_simulation_time = context.getState().getTime()
+        for iteration in range(start_iteration, niterations):
             # integrate dynamics
             integrator.step(nsteps_per_iteration)
             # get current state
@@ -813,23 +1772,29 @@ def refine_explicit_md(
             kinetic_energy = state.getKineticEnergy()
             final_time = time.time()
             elapsed_time = (final_time - initial_time) * unit.seconds
-            ns_per_day = (simulation_time / elapsed_time) / (unit.nanoseconds / unit.day)
+            ns_per_day = ((simulation_time - initial_simulation_time) / elapsed_time) / (unit.nanoseconds / unit.day)
             box_vectors = state.getPeriodicBoxVectors()
             volume_in_nm3 = (box_vectors[0][0] * box_vectors[1][1] * box_vectors[2][2]) / (unit.nanometers**3) # TODO: Use full determinant
-            remaining_time = elapsed_time * (niterations-iteration-1) / (iteration+1)
+            remaining_time = elapsed_time * (niterations-iteration-1) / (iteration-start_iteration+1)
             if verbose: print "  %8.1f ps : potential %8.3f kT | kinetic %8.3f kT | volume %.3f nm^3 | %.3f ns/day | %.3f s remain" % (simulation_time / unit.picoseconds, potential_energy / kT, kinetic_energy / kT, volume_in_nm3, ns_per_day, remaining_time / unit.seconds)
 
             if write_trajectory:
-                state = context.getState(getPositions=True)
-                app.PDBFile.writeModel(pdb.topology, state.getPositions(), file=trajectory_outfile, modelIndex=iteration)
+                trajectory_reporter.report(iteration, context)
 
             # write data
             energy_outfile.write("  %8d %8.1f %8.3f %8.3f %.3f %.3f\n" % (iteration, simulation_time / unit.picoseconds, potential_energy / kT, kinetic_energy / kT, volume_in_nm3, ns_per_day))
             energy_outfile.flush()
 
+            if checkpoint_interval and (iteration+1) % checkpoint_interval == 0:
+                write_checkpoint(context, checkpoint_filename)
+
+            potential_energies.append(potential_energy / kT)
+            if adaptive_sim_length and iteration+1 >= min_niterations and check_energy_plateau(potential_energies, window=plateau_window, tolerance=plateau_tolerance):
+                if verbose: print "Potential energy has plateaued; stopping after %.1f ps." % (simulation_time / unit.picoseconds)
+                break
+
         if write_trajectory:
-            app.PDBFile.writeFooter(pdb.topology, file=trajectory_outfile)
-            trajectory_outfile.close()
+            trajectory_reporter.close()
 
         energy_outfile.close()
 
@@ -855,6 +1820,11 @@ def refine_explicit_md(
         with gzip.open(state_filename+'.gz', 'w') as state_file:
             state_file.write(openmm.XmlSerializer.serialize(state))
 
+        if os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+        return state.getTime()
+
 
     for target in targets:
         if process_only_these_targets and (target.id not in process_only_these_targets):
@@ -879,7 +1849,11 @@ def refine_explicit_md(
 
         ntemplates_selected = len(selected_template_indices)
 
-        for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
+        def expected_explicit_md_cost(template_index):
+            template = templates_resolved_seq[selected_template_indices[template_index]]
+            return _expected_refinement_cost(os.path.join(models_target_dir, template.id), 'implicit-refined.pdb.gz', 'explicit-log.yaml', unique_by_clustering_only=True)
+
+        for template_index in mpistate.iter_tasks(range(ntemplates_selected), key=expected_explicit_md_cost):
             template = templates_resolved_seq[selected_template_indices[template_index]]
 
             model_dir = os.path.join(models_target_dir, template.id)
@@ -909,6 +1883,7 @@ def refine_explicit_md(
             system_filename = os.path.join(model_dir, 'explicit-system.xml')
             integrator_filename = os.path.join(model_dir, 'explicit-integrator.xml')
             state_filename = os.path.join(model_dir, 'explicit-state.xml')
+            checkpoint_filename = os.path.join(model_dir, 'explicit-checkpoint.chk')
 
             print "-------------------------------------------------------------------------"
             print "Simulating %s => %s in explicit solvent for %.1f ps" % (target.id, template.id, niterations * nsteps_per_iteration * timestep / unit.picoseconds)
@@ -932,12 +1907,13 @@ def refine_explicit_md(
                     pdb = app.PDBFile(model_file)
                 [positions, topology] = solvate_pdb(pdb, nwaters)
 
-                simulate_explicit_md()
+                simulated_length = simulate_explicit_md()
 
                 timing = ensembler.core.strf_timedelta(datetime.datetime.utcnow() - start)
                 log_data = {
                     'finished': True,
                     'timing': timing,
+                    'simulated_length': '%s' % simulated_length.in_units_of(unit.picoseconds),
                     'successful': True,
                     }
                 log_file.log(new_log_data=log_data)
@@ -945,6 +1921,9 @@ def refine_explicit_md(
             except Exception as e:
                 trbk = traceback.format_exc()
                 timing = ensembler.core.strf_timedelta(datetime.datetime.utcnow() - start)
+                # A failed simulation should not be resumed from its checkpoint
+                if os.path.exists(checkpoint_filename):
+                    os.remove(checkpoint_filename)
                 log_data = {
                     'exception': e,
                     'traceback': ensembler.core.literal_str(trbk),
@@ -959,6 +1938,12 @@ def refine_explicit_md(
 
         mpistate.comm.Barrier()
 
+        if write_coordinate_store:
+            ensembler.coordinate_store.update_coordinate_store(
+                models_target_dir, 'refine_explicit_md',
+                [templates_resolved_seq[template_index].id for template_index in selected_template_indices]
+            )
+
         if mpistate.rank == 0:
             project_metadata = ensembler.core.ProjectMetadata(project_stage='refine_explicit_md', target_id=target.id)
             datestamp = ensembler.core.get_utcnow_formatted()
@@ -974,6 +1959,9 @@ def refine_explicit_md(
                 'timing': ensembler.core.strf_timedelta(target_timedelta),
                 'ff': ff,
                 'water_model': water_model,
+                'timestep': '%s' % timestep,
+                'hmr': hmr,
+                'hydrogen_mass': '%s' % hydrogen_mass if hmr else None,
                 'nsuccessful_refinements': nsuccessful_refinements,
                 'python_version': sys.version.split('|')[0].strip(),
                 'python_full_version': ensembler.core.literal_str(sys.version),
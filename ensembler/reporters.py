@@ -0,0 +1,271 @@
+import os
+import abc
+import gzip
+import numpy as np
+import mdtraj
+import mdtraj.formats
+import mdtraj.utils
+import simtk.unit as unit
+import simtk.openmm.app as app
+
+
+trajectory_formats = ['pdb.gz', 'dcd', 'xtc']
+
+
+class TrajectoryReporter(object):
+    """Abstract base class for trajectory reporters used by the refinement simulation loops.
+
+    The simulation loop calls report(iteration, context) after each iteration. Positions are only
+    requested from the Context on iterations which are to be written, i.e. every stride
+    iterations.
+
+    Subclasses must implement _write_frame(xyz, box_vectors, time, iteration), which is passed the
+    positions (nm; protein atoms only if protein_only), box vectors (nm), time (ps) and iteration
+    of each frame to be written, and should override close if the trajectory file needs to be
+    closed or finalized.
+
+    Parameters
+    ----------
+    filepath : str
+    topology : simtk.openmm.app.Topology
+        Topology of the simulated system
+    stride : int
+        Write a frame every stride iterations.
+    protein_only : bool
+        Write only protein atoms (e.g. omitting solvent and ions).
+    start_iteration : int
+        Iteration from which a simulation is being resumed (e.g. from a checkpoint). If greater
+        than 0, any existing trajectory file is appended to, after discarding any frames written
+        for iterations from start_iteration on (e.g. since the checkpoint), so that the
+        trajectory holds start_iteration // stride frames before new frames are added.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, filepath, topology, stride=1, protein_only=False, start_iteration=0):
+        self.filepath = filepath
+        self.stride = stride
+        self.append = start_iteration > 0 and os.path.exists(filepath)
+        # Frames are written on iterations stride-1, 2*stride-1, ...
+        self.nframes_kept = start_iteration // stride
+        if protein_only:
+            self.atom_indices = mdtraj.Topology.from_openmm(topology).select('protein')
+            self.topology = subset_openmm_topology(topology, self.atom_indices)
+        else:
+            self.atom_indices = None
+            self.topology = topology
+
+    def report(self, iteration, context):
+        if (iteration + 1) % self.stride != 0:
+            return
+        state = context.getState(getPositions=True)
+        xyz = state.getPositions(asNumpy=True).value_in_unit(unit.nanometers)
+        if self.atom_indices is not None:
+            xyz = xyz[self.atom_indices]
+        box_vectors = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(unit.nanometers)
+        self._write_frame(xyz, box_vectors, state.getTime().value_in_unit(unit.picoseconds), iteration)
+
+    @abc.abstractmethod
+    def _write_frame(self, xyz, box_vectors, time, iteration):
+        pass
+
+    def close(self):
+        pass
+
+    def write_topology_file(self, topology_filepath, context):
+        """Write a PDB file, containing the current positions, from which the trajectory file's
+        topology can be read.
+        """
+        state = context.getState(getPositions=True)
+        positions = state.getPositions(asNumpy=True)
+        if self.atom_indices is not None:
+            positions = positions[self.atom_indices]
+        with open(topology_filepath, 'w') as topology_file:
+            app.PDBFile.writeFile(self.topology, positions, file=topology_file)
+
+
+class PDBTrajectoryReporter(TrajectoryReporter):
+    """Writes a gzipped multi-model PDB file.
+
+    When appending, the existing file is rewritten with only the models to be kept, i.e. without
+    any later or incomplete models, or its footer (CONECT and END records).
+    """
+    def __init__(self, filepath, topology, stride=1, protein_only=False, start_iteration=0):
+        super(PDBTrajectoryReporter, self).__init__(filepath, topology, stride=stride, protein_only=protein_only, start_iteration=start_iteration)
+        if self.append:
+            with gzip.open(filepath, 'r') as previous_file:
+                previous_lines = previous_file.readlines()
+            self._file = gzip.open(filepath, 'w')
+            self._file.writelines(previous_lines[:pdb_trajectory_models_end(previous_lines, nmodels=self.nframes_kept)])
+        else:
+            self._file = gzip.open(filepath, 'w')
+            app.PDBFile.writeHeader(self.topology, file=self._file)
+
+    def _write_frame(self, xyz, box_vectors, time, iteration):
+        app.PDBFile.writeModel(self.topology, xyz * unit.nanometers, file=self._file, modelIndex=iteration)
+
+    def close(self):
+        app.PDBFile.writeFooter(self.topology, file=self._file)
+        self._file.close()
+
+
+class DCDTrajectoryReporter(TrajectoryReporter):
+    """Writes a DCD file, using mdtraj.
+
+    mdtraj cannot append to DCD files, so when appending, the existing frames to be kept are read
+    and written back to a new file first.
+    """
+    def __init__(self, filepath, topology, stride=1, protein_only=False, start_iteration=0):
+        super(DCDTrajectoryReporter, self).__init__(filepath, topology, stride=stride, protein_only=protein_only, start_iteration=start_iteration)
+        previous_frames = None
+        if self.append:
+            with mdtraj.formats.DCDTrajectoryFile(filepath, mode='r') as previous_file:
+                previous_frames = [data[:self.nframes_kept] if data is not None else None for data in previous_file.read()]
+        self._file = mdtraj.formats.DCDTrajectoryFile(filepath, mode='w')
+        if previous_frames is not None and len(previous_frames[0]) > 0:
+            xyz, cell_lengths, cell_angles = previous_frames
+            self._file.write(xyz, cell_lengths=cell_lengths, cell_angles=cell_angles)
+
+    def _write_frame(self, xyz, box_vectors, time, iteration):
+        cell_lengths = None
+        cell_angles = None
+        if self.topology.getUnitCellDimensions() is not None:
+            a, b, c, alpha, beta, gamma = mdtraj.utils.box_vectors_to_lengths_and_angles(*box_vectors)
+            cell_lengths = np.array([[a, b, c]]) * 10.0
+            cell_angles = np.array([[alpha, beta, gamma]])
+        # DCD files are in angstroms
+        self._file.write(np.array([xyz]) * 10.0, cell_lengths=cell_lengths, cell_angles=cell_angles)
+
+    def close(self):
+        self._file.close()
+
+
+class XTCTrajectoryReporter(TrajectoryReporter):
+    """Writes an XTC file, using mdtraj.
+
+    As for DCDTrajectoryReporter, existing frames are rewritten when appending.
+    """
+    def __init__(self, filepath, topology, stride=1, protein_only=False, start_iteration=0):
+        super(XTCTrajectoryReporter, self).__init__(filepath, topology, stride=stride, protein_only=protein_only, start_iteration=start_iteration)
+        previous_frames = None
+        if self.append:
+            with mdtraj.formats.XTCTrajectoryFile(filepath, mode='r') as previous_file:
+                previous_frames = [data[:self.nframes_kept] if data is not None else None for data in previous_file.read()]
+        self._file = mdtraj.formats.XTCTrajectoryFile(filepath, mode='w')
+        if previous_frames is not None and len(previous_frames[0]) > 0:
+            xyz, time, step, box = previous_frames
+            self._file.write(xyz, time=time, step=step, box=box)
+
+    def _write_frame(self, xyz, box_vectors, time, iteration):
+        box = None
+        if self.topology.getUnitCellDimensions() is not None:
+            box = np.array([box_vectors])
+        self._file.write(np.array([xyz]), time=np.array([time]), step=np.array([iteration]), box=box)
+
+    def close(self):
+        self._file.close()
+
+
+def pdb_trajectory_models_end(lines, nmodels=None):
+    """Find the end of the models in the lines of a multi-model PDB file, i.e. the index of the line
+    following the last ENDMDL record (or the nmodels-th, if there are more). If there is no complete
+    model, or nmodels is 0, the index of the first coordinate, MODEL or footer record is returned
+    (i.e. the end of the header).
+
+    Parameters
+    ----------
+    lines : list of str
+    nmodels : int, optional
+        Maximum number of models to keep.
+
+    Returns
+    -------
+    models_end : int
+    """
+    header_end = None
+    models_end = None
+    nmodels_found = 0
+    for index, line in enumerate(lines):
+        if line.startswith('ENDMDL'):
+            if nmodels is None or nmodels_found < nmodels:
+                models_end = index + 1
+                nmodels_found += 1
+        elif header_end is None and line.startswith(('MODEL', 'ATOM', 'HETATM', 'TER', 'CONECT', 'END')):
+            header_end = index
+    if models_end is not None:
+        return models_end
+    if header_end is not None:
+        return header_end
+    return len(lines)
+
+
+def open_trajectory_reporter(model_dir, prefix, topology, context, trajectory_format='pdb.gz', stride=1, protein_only=False, start_iteration=0):
+    """Open a trajectory reporter for a refinement simulation, writing to
+    [model_dir]/[prefix]-trajectory.[trajectory_format].
+
+    For the binary formats, the topology is written as [model_dir]/[prefix]-trajectory-topol.pdb
+    (unless appending).
+
+    Parameters
+    ----------
+    model_dir : str
+    prefix : str
+        e.g. 'implicit' or 'explicit'
+    topology : simtk.openmm.app.Topology
+    context : simtk.openmm.Context
+    trajectory_format : str
+        pdb.gz|dcd|xtc
+    stride : int
+    protein_only : bool
+    start_iteration : int
+        Iteration from which the simulation is being resumed, if any (see TrajectoryReporter).
+
+    Returns
+    -------
+    reporter : TrajectoryReporter
+    """
+    reporter_classes = {
+        'pdb.gz': PDBTrajectoryReporter,
+        'dcd': DCDTrajectoryReporter,
+        'xtc': XTCTrajectoryReporter,
+    }
+    if trajectory_format not in reporter_classes:
+        raise Exception('Trajectory format "%s" not recognized. Options: %s' % (trajectory_format, ', '.join(trajectory_formats)))
+    trajectory_filepath = os.path.join(model_dir, '%s-trajectory.%s' % (prefix, trajectory_format))
+    reporter = reporter_classes[trajectory_format](trajectory_filepath, topology, stride=stride, protein_only=protein_only, start_iteration=start_iteration)
+    if trajectory_format != 'pdb.gz' and not reporter.append:
+        reporter.write_topology_file(os.path.join(model_dir, '%s-trajectory-topol.pdb' % prefix), context)
+    return reporter
+
+
+def subset_openmm_topology(topology, atom_indices):
+    """Construct an OpenMM Topology containing only the given atoms (and the bonds between them).
+
+    Parameters
+    ----------
+    topology : simtk.openmm.app.Topology
+    atom_indices : list of int
+
+    Returns
+    -------
+    subset_topology : simtk.openmm.app.Topology
+    """
+    atom_indices = set(atom_indices)
+    subset_topology = app.Topology()
+    subset_atoms = {}
+    for chain in topology.chains():
+        subset_chain = None
+        for residue in chain.residues():
+            subset_residue = None
+            for atom in residue.atoms():
+                if atom.index not in atom_indices:
+                    continue
+                if subset_chain is None:
+                    subset_chain = subset_topology.addChain()
+                if subset_residue is None:
+                    subset_residue = subset_topology.addResidue(residue.name, subset_chain)
+                subset_atoms[atom] = subset_topology.addAtom(atom.name, atom.element, subset_residue)
+    for atom1, atom2 in topology.bonds():
+        if atom1 in subset_atoms and atom2 in subset_atoms:
+            subset_topology.addBond(subset_atoms[atom1], subset_atoms[atom2])
+    subset_topology.setUnitCellDimensions(topology.getUnitCellDimensions())
+    return subset_topology
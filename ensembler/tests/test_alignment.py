@@ -0,0 +1,79 @@
+import os
+import Bio.SeqIO
+import Bio.pairwise2
+import Bio.SubsMat.MatrixInfo
+import ensembler
+import ensembler.alignment
+import ensembler.utils
+from nose.plugins.attrib import attr
+
+integration_test_resources_dir = os.path.join(ensembler.core.installation_toplevel_dir, ensembler.core.default_installation_dirnames.tests_integration_test_resources)
+
+
+def read_sequences():
+    targets = list(Bio.SeqIO.parse(os.path.join(integration_test_resources_dir, 'targets', 'targets.fa'), 'fasta'))
+    templates = list(Bio.SeqIO.parse(os.path.join(integration_test_resources_dir, 'templates', 'templates-resolved-seq.fa'), 'fasta'))
+    return [str(target.seq) for target in targets], [str(template.seq) for template in templates]
+
+
+@attr('unit')
+def test_align_target_templates_matches_pairwise2():
+    target_seqs, template_seqs = read_sequences()
+    for target_seq in target_seqs:
+        alns = ensembler.alignment.align_target_templates(target_seq, template_seqs, block_size=7)
+        assert len(alns) == len(template_seqs)
+        for template_seq, aln in zip(template_seqs, alns):
+            ref_aln = Bio.pairwise2.align.globalds(target_seq, template_seq, Bio.SubsMat.MatrixInfo.gonnet, -10, -0.5)
+            assert aln[0][0] == ref_aln[0][0]
+            assert aln[0][1] == ref_aln[0][1]
+            assert abs(aln[0][2] - ref_aln[0][2]) < 1e-6
+
+
+@attr('unit')
+def test_align_target_templates_low_complexity():
+    # Many equal-scoring alignments - checks that the same one is selected as by pairwise2
+    target_seq = 'GAGGAAGAGGGA'
+    template_seqs = ['GA', 'AAGA', 'GGGAAG', 'AGAGAGAGAGAGAGAG', 'G']
+    alns = ensembler.alignment.align_target_templates(target_seq, template_seqs)
+    for template_seq, aln in zip(template_seqs, alns):
+        ref_aln = Bio.pairwise2.align.globalds(target_seq, template_seq, Bio.SubsMat.MatrixInfo.gonnet, -10, -0.5)
+        assert aln[0][:2] == ref_aln[0][:2]
+
+
+@attr('unit')
+def test_calculate_seq_identity_upper_bounds():
+    target_seqs, template_seqs = read_sequences()
+    for target_seq in target_seqs:
+        alns = ensembler.alignment.align_target_templates(target_seq, template_seqs)
+        scores, seqid_upper_bounds = ensembler.alignment.calculate_seq_identity_upper_bounds(target_seq, template_seqs, block_size=5)
+        for aln, score, seqid_upper_bound in zip(alns, scores, seqid_upper_bounds):
+            nidentities = len([1 for res1, res2 in zip(aln[0][0], aln[0][1]) if res1 == res2])
+            seqid = 100 * float(nidentities) / min(len(target_seq), len(aln[0][1].replace('-', '')))
+            assert abs(score - aln[0][2]) < 1e-6
+            assert seqid_upper_bound >= seqid - 1e-6
+
+
+@attr('unit')
+def test_alignment_cache():
+    target_seqs, template_seqs = read_sequences()
+    target_seq = target_seqs[0]
+    with ensembler.utils.enter_temp_dir():
+        cache = ensembler.alignment.AlignmentCache('alignment-cache.sqlite')
+        assert cache.get_many(target_seq, template_seqs) == [None] * len(template_seqs)
+        aln = ensembler.alignment.align_target_templates(target_seq, template_seqs[:1])[0]
+        entries = [
+            ensembler.alignment.AlignmentCacheEntry(cache.key(target_seq, template_seqs[0]), aln[0][0], aln[0][1], aln[0][2], 50., 60.),
+            ensembler.alignment.AlignmentCacheEntry(cache.key(target_seq, template_seqs[1]), None, None, None, None, 10.),
+        ]
+        cache.add_many(entries)
+        cache.close()
+
+        cache = ensembler.alignment.AlignmentCache('alignment-cache.sqlite')
+        found = cache.get_many(target_seq, template_seqs)
+        assert found[:2] == entries
+        assert found[2:] == [None] * (len(template_seqs) - 2)
+        assert ensembler.alignment.aln_from_cache_entry(found[0]) == aln
+        # A change of alignment parameters must not hit the existing entries
+        cache = ensembler.alignment.AlignmentCache('alignment-cache.sqlite', gap_open=-11)
+        assert cache.get_many(target_seq, template_seqs[:2]) == [None, None]
+        cache.close()
@@ -0,0 +1,79 @@
+import os
+import gzip
+import shutil
+import numpy as np
+import mdtraj
+import ensembler
+import ensembler.coordinate_store
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_coordinate_store():
+    template_filepath = os.path.abspath(os.path.join('tests', 'resources', 'mock_template.pdb'))
+    templateids = ['mock_template_%d' % i for i in range(3)]
+
+    with enter_temp_dir():
+        for i, templateid in enumerate(templateids):
+            os.mkdir(templateid)
+            with open(template_filepath, 'rb') as template_file:
+                with gzip.open(os.path.join(templateid, 'model.pdb.gz'), 'wb') as model_file:
+                    shutil.copyfileobj(template_file, model_file)
+
+        store = ensembler.coordinate_store.CoordinateStore('.', 'build_models')
+        assert store.append_models(templateids[:2] + ['nonexistent_template']) == templateids[:2]
+        assert store.append_models(templateids) == templateids[2:]
+        assert store.read_index() == {templateid: i for i, templateid in enumerate(templateids)}
+
+        traj = ensembler.coordinate_store.load_models('.', 'build_models', templateids[::-1])
+        ref_traj = mdtraj.load([os.path.join(templateid, 'model.pdb.gz') for templateid in templateids[::-1]])
+        assert traj.n_frames == 3
+        assert traj.topology == ref_traj.topology
+        assert np.allclose(traj.xyz, ref_traj.xyz, atol=1e-3)
+
+        CAatoms = ref_traj.topology.select('name CA')
+        traj = store.load([templateids[2], templateids[0]], atom_indices=CAatoms)
+        assert traj.n_frames == 2
+        assert traj.topology == ref_traj.topology.subset(CAatoms)
+        assert np.allclose(traj.xyz, ref_traj.xyz[[0, 2]][:, CAatoms], atol=1e-3)
+
+    assert ensembler.coordinate_store.contiguous_runs([0, 1, 2, 5, 7, 8]) == [(0, 3), (5, 1), (7, 2)]
+
+
+@attr('unit')
+def test_coordinate_store_stale_models():
+    template_filepath = os.path.abspath(os.path.join('tests', 'resources', 'mock_template.pdb'))
+    templateids = ['mock_template_%d' % i for i in range(2)]
+
+    with enter_temp_dir():
+        for templateid in templateids:
+            os.mkdir(templateid)
+            with open(template_filepath, 'rb') as template_file:
+                with gzip.open(os.path.join(templateid, 'model.pdb.gz'), 'wb') as model_file:
+                    shutil.copyfileobj(template_file, model_file)
+
+        store = ensembler.coordinate_store.CoordinateStore('.', 'build_models')
+        assert store.append_models(templateids) == templateids
+        assert store.stale_templateids(templateids) == []
+
+        # Rebuild the second model with shifted coordinates
+        model_filepath = os.path.join(templateids[1], 'model.pdb.gz')
+        rebuilt_model = mdtraj.load_pdb(model_filepath)
+        rebuilt_model.xyz += 1.0
+        rebuilt_model.save_pdb(os.path.join(templateids[1], 'model.pdb'))
+        with open(os.path.join(templateids[1], 'model.pdb'), 'rb') as pdb_file:
+            with gzip.open(model_filepath, 'wb') as model_file:
+                shutil.copyfileobj(pdb_file, model_file)
+        model_mtime = os.stat(model_filepath).st_mtime + 10
+        os.utime(model_filepath, (model_mtime, model_mtime))
+        assert store.stale_templateids(templateids) == templateids[1:]
+
+        traj = ensembler.coordinate_store.load_models('.', 'build_models', templateids)
+        assert np.allclose(traj.xyz[1], rebuilt_model.xyz[0], atol=1e-3)
+
+        assert store.append_models(templateids) == templateids[1:]
+        assert store.read_index() == {templateids[0]: 0, templateids[1]: 2}
+        assert store.stale_templateids(templateids) == []
+        traj = store.load(templateids)
+        assert np.allclose(traj.xyz[1], rebuilt_model.xyz[0], atol=1e-3)
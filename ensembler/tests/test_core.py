@@ -1,3 +1,7 @@
+import sys
+import time
+import tempfile
+import subprocess
 import ensembler
 import ensembler.param_parsers
 import simtk.unit
@@ -18,4 +22,120 @@ def test_parse_api_params_string():
 @attr('unit')
 def test_eval_quantity_string():
     quantity = ensembler.param_parsers.eval_quantity_string('2 picoseconds')
-    assert quantity == 2 * simtk.unit.picosecond
\ No newline at end of file
+    assert quantity == 2 * simtk.unit.picosecond
+
+
+@attr('unit')
+def test_mpistate_iter_tasks():
+    mpistate = ensembler.core.mpistate
+    tasks = ['a', 'bbb', 'cc', 'dddd']
+    distributed_tasks = [task for task in mpistate.iter_tasks(tasks, key=len)]
+    if mpistate.size == 1:
+        assert distributed_tasks == ['dddd', 'bbb', 'cc', 'a']
+    else:
+        gathered_tasks = mpistate.comm.gather(distributed_tasks, root=0)
+        if mpistate.rank == 0:
+            assert sorted([task for sublist in gathered_tasks for task in sublist]) == sorted(tasks)
+
+
+def run_python_code(code, timeout=120):
+    """Run Python code in a new interpreter, in which MPI has not been initialized (as required by
+    MPIState.local_executor). Returns the exit status and output."""
+    with tempfile.TemporaryFile() as output_file:
+        process = subprocess.Popen([sys.executable, '-c', code], stdout=output_file, stderr=subprocess.STDOUT)
+        start_time = time.time()
+        while process.poll() is None:
+            if time.time() - start_time > timeout:
+                process.kill()
+                raise Exception('Timed out running code:\n%s' % code)
+            time.sleep(0.1)
+        output_file.seek(0)
+        return process.returncode, output_file.read()
+
+
+@attr('unit')
+def test_mpistate_local_executor():
+    exit_status, output = run_python_code('''
+from ensembler.core import mpistate
+tasks = range(10)
+with mpistate.local_executor(nworkers=3):
+    distributed_tasks = [task for task in mpistate.iter_tasks(tasks)]
+    gathered_tasks = mpistate.comm.gather((mpistate.rank, distributed_tasks), root=0)
+    gathered_tasks = mpistate.comm.bcast(gathered_tasks, root=0)
+    assert [rank for rank, sublist in gathered_tasks] == [0, 1, 2]
+    assert sorted([task for rank, sublist in gathered_tasks for task in sublist]) == tasks
+assert mpistate.rank == 0
+assert mpistate.size == 1
+''')
+    assert exit_status == 0, output
+
+
+@attr('unit')
+def test_mpistate_local_executor_worker_failure():
+    # A failing worker must not leave the other processes waiting for it
+    exit_status, output = run_python_code('''
+import ensembler.core
+from ensembler.core import mpistate
+try:
+    with mpistate.local_executor(nworkers=3):
+        if mpistate.rank == 1:
+            raise ValueError('worker failure')
+        mpistate.comm.Barrier()
+except ensembler.core.LocalWorkerError as e:
+    assert 'worker failure' in str(e)
+    print 'LocalWorkerError raised'
+''', timeout=60)
+    assert exit_status == 0, output
+    assert 'LocalWorkerError raised' in output
+
+
+@attr('unit')
+def test_mpistate_local_executor_stops_between_tasks():
+    # After a worker fails, the other workers should stop before starting another task, rather
+    # than at the next collective operation
+    exit_status, output = run_python_code('''
+import time
+import ensembler.core
+from ensembler.core import mpistate
+assert mpistate.is_single_process()
+ntasks_done = 0
+try:
+    with mpistate.local_executor(nworkers=2):
+        for task in mpistate.iter_tasks(range(100)):
+            if mpistate.rank == 1:
+                raise ValueError('worker failure')
+            time.sleep(0.05)
+            ntasks_done += 1
+        mpistate.comm.Barrier()
+except ensembler.core.LocalWorkerError as e:
+    assert ntasks_done < 50, ntasks_done
+    print 'LocalWorkerError raised'
+''', timeout=60)
+    assert exit_status == 0, output
+    assert 'LocalWorkerError raised' in output
+
+
+@attr('unit')
+def test_mpistate_is_single_process_after_mpi_init():
+    # Once MPI has been initialized, the local executor cannot be started, even with a single rank
+    exit_status, output = run_python_code('''
+import ensembler.core
+from ensembler.core import mpistate
+assert mpistate.is_single_process()
+import mpi4py.MPI
+assert mpistate.size == 1
+assert not mpistate.is_single_process()
+print 'is_single_process False'
+''', timeout=60)
+    assert exit_status == 0, output
+    assert 'is_single_process False' in output
+
+
+@attr('unit')
+def test_cpu_lists():
+    assert ensembler.core.parse_cpu_list('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert ensembler.core.split_cpus(range(8), 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    available_cpus = ensembler.core.get_available_cpus()
+    assert len(available_cpus) > 0
+    if ensembler.core.mpistate.size == 1:
+        assert ensembler.core.mpistate.node_cpu_share() == available_cpus
@@ -1,8 +1,9 @@
 import os
+import time
 import shutil
 import datetime
 
-from mock import Mock
+from mock import Mock, patch
 from nose.plugins.attrib import attr
 
 import ensembler
@@ -53,6 +54,63 @@ def test_build_model():
         assert os.path.getsize(model_filepath) > 0
 
 
+def mock_run_modeller_build_request(env, build_request):
+    # Run in each worker's scratch directory
+    with open('scratch-file', 'w') as scratch_file:
+        scratch_file.write(build_request.template_id)
+    if build_request.template_id == 'crash':
+        os._exit(1)
+    if build_request.template_id == 'slow':
+        # so that results arrive out of order
+        time.sleep(0.5)
+    return build_request.template_id != 'fail'
+
+
+@attr('unit')
+def test_modeller_worker_pool():
+    template_ids = ['slow', 'ok', 'fail', 'crash', 'ok']
+    build_requests = [
+        ensembler.modeling.ModellerBuildRequest('mock_target', template_id, None, None, None, None, False, None)
+        for template_id in template_ids
+    ]
+    with patch('ensembler.modeling.get_modeller_env'), patch('ensembler.modeling.run_modeller_build_request', mock_run_modeller_build_request), \
+            patch('ensembler.core.mpi_initialized', return_value=False) as mpi_initialized:
+        modeller_pool = ensembler.modeling.ModellerWorkerPool(nworkers=2)
+        modeller_pool.poll_interval = 0.2
+        scratch_dirs = [worker.scratch_dir for worker in modeller_pool._workers]
+        for build_request in build_requests:
+            modeller_pool.submit(build_request)
+        # The crashed worker is reported as unsuccessful, and replaced
+        assert modeller_pool.wait() == [True, True, False, False, True]
+        assert all([worker.process.is_alive() for worker in modeller_pool._workers])
+        modeller_pool.submit(build_requests[1])
+        assert modeller_pool.wait() == [True]
+        scratch_dirs += [worker.scratch_dir for worker in modeller_pool._workers]
+        modeller_pool.close()
+        assert not any([os.path.exists(scratch_dir) for scratch_dir in scratch_dirs])
+
+        # Scratch directories are also removed if the workers are terminated
+        try:
+            with ensembler.modeling.ModellerWorkerPool(nworkers=2) as modeller_pool:
+                scratch_dirs = [worker.scratch_dir for worker in modeller_pool._workers]
+                modeller_pool.submit(build_requests[0])
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        assert not any([os.path.exists(scratch_dir) for scratch_dir in scratch_dirs])
+
+        # Workers are not forked once MPI has been initialized; models are built in the calling
+        # process instead
+        mpi_initialized.return_value = True
+        cwd = os.getcwd()
+        with ensembler.modeling.ModellerWorkerPool(nworkers=2) as modeller_pool:
+            assert modeller_pool._workers == []
+            modeller_pool.submit(build_requests[2])
+            modeller_pool.submit(build_requests[1])
+            assert modeller_pool.wait() == [False, True]
+        assert os.getcwd() == cwd
+
+
 @attr('integration')
 def test_align_command():
     ref_resources_dirpath = os.path.abspath(os.path.join('tests', 'integration_test_resources'))
@@ -62,6 +120,7 @@ def test_align_command():
         args = {
             '--targets': ','.join(targets),
             '--templates': ','.join(templates),
+            '--template_seqid_cutoff': None,
             '--verbose': False,
         }
 
@@ -95,12 +154,15 @@ def test_build_models_command():
             '--template_seqid_cutoff': None,
             '--templates': ','.join(['KC1D_HUMAN_D0_4KB8_D', 'KC1D_HUMAN_D0_4HNF_A']),
             '--write_modeller_restraints_file': None,
+            '--nmodeller_workers': None,
+            '--write_coordinate_store': False,
             '--verbose': False,
             '--help': False,
         }
         ensembler.cli_commands.build_models.dispatch(args)
-        assert os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'model.pdb'))
-        assert os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4HNF_A', 'model.pdb'))
+        assert os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'model.pdb.gz'))
+        assert os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4HNF_A', 'model.pdb.gz'))
+        assert not os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'model.pdb'))
         assert not os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'restraints.rsr.gz'))
         assert not os.path.exists(os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4HNF_A', 'restraints.rsr.gz'))
 
@@ -110,6 +172,45 @@ def test_cluster_models():
     with integration_test_context(set_up_project_stage='modeled'):
         ensembler.modeling.cluster_models()
 
+@attr('unit')
+def test_cluster_models_distributed():
+    with integration_test_context(set_up_project_stage='modeled'):
+        models_target_dir = os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0')
+        ensembler.modeling.cluster_models()
+        with open(os.path.join(models_target_dir, 'unique-models.txt')) as uniques_file:
+            serial_unique_templateids = uniques_file.read().split()
+        ensembler.modeling.cluster_models(distributed=True, block_size=1)
+        with open(os.path.join(models_target_dir, 'unique-models.txt')) as uniques_file:
+            distributed_unique_templateids = uniques_file.read().split()
+        assert distributed_unique_templateids == serial_unique_templateids
+
+
+@attr('unit')
+def test_cluster_models_incremental():
+    with integration_test_context(set_up_project_stage='modeled'):
+        models_target_dir = os.path.join(ensembler.core.default_project_dirnames.models, 'EGFR_HUMAN_D0')
+        ensembler.modeling.cluster_models()
+        with open(os.path.join(models_target_dir, 'unique-models.txt')) as uniques_file:
+            unique_templateids = uniques_file.read().split()
+
+        # Drop the last model from the cached results, as if it had been built since clustering
+        clustering_cache = ensembler.modeling.read_clustering_cache(models_target_dir)
+        new_templateid = clustering_cache['templateids'][-1]
+        previous_unique_indices = [i for i, templateid in enumerate(clustering_cache['unique_templateids']) if templateid != new_templateid]
+        ensembler.modeling.write_clustering_cache(
+            models_target_dir,
+            clustering_cache['templateids'][:-1],
+            [clustering_cache['unique_templateids'][i] for i in previous_unique_indices],
+            clustering_cache['unique_CA_xyz'][previous_unique_indices],
+            clustering_cache['cutoff'],
+        )
+
+        ensembler.modeling.cluster_models(incremental=True)
+        with open(os.path.join(models_target_dir, 'unique-models.txt')) as uniques_file:
+            assert uniques_file.read().split() == unique_templateids
+        assert ensembler.modeling.read_clustering_cache(models_target_dir)['templateids'] == clustering_cache['templateids']
+
+
 @attr('unit')
 def test_cluster_models_command():
     with integration_test_context(set_up_project_stage='modeled'):
@@ -117,6 +218,9 @@ def test_cluster_models_command():
             '--targetsfile': False,
             '--targets': False,
             '--cutoff': False,
+            '--distributed': False,
+            '--block_size': False,
+            '--incremental': False,
             '--verbose': False,
             '--help': False,
         }
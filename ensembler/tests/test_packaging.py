@@ -0,0 +1,189 @@
+import os
+import tarfile
+import hashlib
+import yaml
+import numpy as np
+import simtk.unit as unit
+import simtk.openmm as openmm
+import ensembler
+import ensembler.packaging
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_clone_velocities():
+    # Two rigid three-site molecules
+    system = openmm.System()
+    positions = np.array([
+        [0.0, 0.0, 0.0], [0.1, 0.0, 0.0], [-0.03, 0.09, 0.0],
+        [1.0, 1.0, 1.0], [1.1, 1.0, 1.0], [0.97, 1.09, 1.0],
+    ])
+    for molecule_index in range(2):
+        system.addParticle(16.0)
+        system.addParticle(1.0)
+        system.addParticle(1.0)
+        first_particle = 3 * molecule_index
+        for particle1, particle2 in [(0, 1), (0, 2), (1, 2)]:
+            distance = np.linalg.norm(positions[first_particle + particle1] - positions[first_particle + particle2])
+            system.addConstraint(first_particle + particle1, first_particle + particle2, distance)
+    integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(positions * unit.nanometers)
+    state_xml = openmm.XmlSerializer.serialize(context.getState(getPositions=True, getVelocities=True, getEnergy=True))
+
+    masses = np.array([system.getParticleMass(index) / unit.amu for index in range(system.getNumParticles())])
+    constraint_batches = ensembler.packaging.batch_constraints(system, masses)
+    assert len(constraint_batches) == 3
+
+    velocities = ensembler.packaging.maxwell_boltzmann_velocities(masses, 300.0 * unit.kelvin, np.random.RandomState([0, 1]))
+    ensembler.packaging.constrain_velocities(velocities, positions, masses, constraint_batches)
+    for particle1, particle2 in [(0, 1), (0, 2), (1, 2), (3, 4), (3, 5), (4, 5)]:
+        direction = positions[particle1] - positions[particle2]
+        assert abs(np.dot(velocities[particle1] - velocities[particle2], direction)) < 1e-6
+
+    state = openmm.XmlSerializer.deserialize(ensembler.packaging.replace_state_velocities(state_xml, velocities, masses))
+    state_velocities = state.getVelocities(asNumpy=True) / (unit.nanometers / unit.picoseconds)
+    assert np.allclose(state_velocities, velocities)
+    kinetic_energy = 0.5 * (masses * (velocities ** 2).sum(axis=1)).sum()
+    assert abs(state.getKineticEnergy() / unit.kilojoules_per_mole - kinetic_energy) < 1e-6
+
+
+@attr('unit')
+def test_archive_runs():
+    with enter_temp_dir():
+        for run in range(2):
+            os.makedirs(os.path.join('RUN%d' % run, 'subdir'))
+            for filename in ['system.xml', 'state0.xml', os.path.join('subdir', 'template.txt')]:
+                with open(os.path.join('RUN%d' % run, filename), 'w') as run_file:
+                    run_file.write('RUN%d %s\n' % (run, filename) * 10000)
+
+        run_archiver = ensembler.packaging.RunArchiver(nthreads=2)
+        for run in range(2):
+            run_archiver.submit('.', 'RUN%d' % run, 'RUN%d.tgz' % run)
+        index_entries = run_archiver.wait()
+        run_archiver.close()
+        ensembler.packaging.write_archive_index('.', index_entries)
+
+        with open('archive-index.yaml') as index_file:
+            archive_index = yaml.load(index_file, Loader=ensembler.core.YamlLoader)
+        assert sorted(archive_index.keys()) == ['RUN0', 'RUN1']
+        for run in range(2):
+            archive_filename = 'RUN%d.tgz' % run
+            with open(archive_filename, 'rb') as archive_file:
+                assert archive_index['RUN%d' % run]['sha256'] == hashlib.sha256(archive_file.read()).hexdigest()
+            assert archive_index['RUN%d' % run]['size'] == os.path.getsize(archive_filename)
+            with tarfile.open(archive_filename) as tar:
+                assert tar.getnames() == ['RUN%d' % run] + [os.path.join('RUN%d' % run, name) for name in ['subdir', 'state0.xml', 'system.xml', os.path.join('subdir', 'template.txt')]]
+                assert tar.extractfile(os.path.join('RUN%d' % run, 'system.xml')).read() == open(os.path.join('RUN%d' % run, 'system.xml'), 'rb').read()
+
+        # Archiving is reproducible
+        index_entry = ensembler.packaging.archive_directory('.', 'RUN0', 'RUN0-repeat.tgz', nthreads=1)
+        assert index_entry['sha256'] == archive_index['RUN0']['sha256']
+
+
+@attr('unit')
+def test_write_deduplicated_file():
+    with enter_temp_dir():
+        os.mkdir('payloads')
+        for run in range(3):
+            os.mkdir('RUN%d' % run)
+        assert ensembler.packaging.write_deduplicated_file(os.path.join('RUN0', 'integrator.xml'), '<Integrator/>\n', 'payloads')
+        assert not ensembler.packaging.write_deduplicated_file(os.path.join('RUN1', 'integrator.xml'), '<Integrator/>\n', 'payloads')
+        assert ensembler.packaging.write_deduplicated_file(os.path.join('RUN2', 'integrator.xml'), '<Integrator type="2"/>\n', 'payloads')
+        assert len(os.listdir('payloads')) == 2
+        assert os.path.samefile(os.path.join('RUN0', 'integrator.xml'), os.path.join('RUN1', 'integrator.xml'))
+        assert not os.path.samefile(os.path.join('RUN0', 'integrator.xml'), os.path.join('RUN2', 'integrator.xml'))
+
+        # Rewriting a file replaces the link, leaving the other RUNs unaffected
+        ensembler.packaging.write_deduplicated_file(os.path.join('RUN1', 'integrator.xml'), '<Integrator type="2"/>\n', 'payloads')
+        assert os.path.samefile(os.path.join('RUN1', 'integrator.xml'), os.path.join('RUN2', 'integrator.xml'))
+        with open(os.path.join('RUN0', 'integrator.xml')) as integrator_file:
+            assert integrator_file.read() == '<Integrator/>\n'
+        assert sorted(os.listdir('RUN1')) == ['integrator.xml']
+
+        # A rebuild without deduplication also replaces the link, rather than writing through it
+        payload_filepath = os.path.join('payloads', hashlib.sha256('<Integrator type="2"/>\n').hexdigest())
+        ensembler.packaging.replace_file_contents(os.path.join('RUN2', 'integrator.xml'), '<Integrator type="3"/>\n')
+        with open(os.path.join('RUN2', 'integrator.xml')) as integrator_file:
+            assert integrator_file.read() == '<Integrator type="3"/>\n'
+        with open(os.path.join('RUN1', 'integrator.xml')) as integrator_file:
+            assert integrator_file.read() == '<Integrator type="2"/>\n'
+        with open(payload_filepath) as payload_file:
+            assert payload_file.read() == '<Integrator type="2"/>\n'
+        assert sorted(os.listdir('RUN2')) == ['integrator.xml']
+
+
+@attr('unit')
+def test_transfer_bundles():
+    with enter_temp_dir():
+        models_target_dir = os.path.join('models', 'EGFR_HUMAN_D0')
+        for template_id in ['KC1D_HUMAN_D0_4HNF_A', 'KC1D_HUMAN_D0_4KB8_D']:
+            os.makedirs(os.path.join(models_target_dir, template_id))
+            for filename in ['model.pdb.gz', 'explicit-refined.pdb.gz', 'explicit-log.yaml']:
+                with open(os.path.join(models_target_dir, template_id, filename), 'w') as model_file:
+                    model_file.write('%s %s\n' % (template_id, filename))
+        file_patterns = ['explicit-refined.pdb.gz', '*-log.yaml']
+
+        export = ensembler.packaging.export_target_for_transfer('EGFR_HUMAN_D0', file_patterns=file_patterns, bundle_size=1)
+        assert export['nmodels'] == 2
+        assert len(export['bundles']) == 2
+        assert ensembler.packaging.export_target_for_transfer('EGFR_HUMAN_D0', file_patterns=file_patterns) is None
+
+        # Refreshed modification times of unchanged files are recorded, even though nothing is exported
+        touched_filepath = os.path.join(models_target_dir, 'KC1D_HUMAN_D0_4HNF_A', 'explicit-log.yaml')
+        touched_mtime = os.stat(touched_filepath).st_mtime + 10
+        os.utime(touched_filepath, (touched_mtime, touched_mtime))
+        touched_mtime = os.stat(touched_filepath).st_mtime
+        assert ensembler.packaging.export_target_for_transfer('EGFR_HUMAN_D0', file_patterns=file_patterns) is None
+        with open(os.path.join('packaged_models', 'transfer', 'EGFR_HUMAN_D0', 'transfer-manifest.yaml')) as manifest_file:
+            transfer_manifest = yaml.load(manifest_file, Loader=ensembler.core.YamlLoader)
+        assert transfer_manifest['files'][touched_filepath]['mtime'] == touched_mtime
+
+        # Only the changed model is exported again
+        changed_filepath = os.path.join(models_target_dir, 'KC1D_HUMAN_D0_4KB8_D', 'explicit-refined.pdb.gz')
+        with open(changed_filepath, 'w') as model_file:
+            model_file.write('changed\n')
+        export = ensembler.packaging.export_target_for_transfer('EGFR_HUMAN_D0', file_patterns=file_patterns)
+        assert export['nmodels'] == 1
+
+        transfer_dir = os.path.join('packaged_models', 'transfer', 'EGFR_HUMAN_D0')
+        bundle_filepaths = [os.path.join(transfer_dir, filename) for filename in os.listdir(transfer_dir) if filename.endswith('.tgz')]
+        assert len(bundle_filepaths) == 3
+        ensembler.packaging.import_transfer_bundles(bundle_filepaths, project_dir='imported', nthreads=2)
+        for template_id in ['KC1D_HUMAN_D0_4HNF_A', 'KC1D_HUMAN_D0_4KB8_D']:
+            assert sorted(os.listdir(os.path.join('imported', models_target_dir, template_id))) == ['explicit-log.yaml', 'explicit-refined.pdb.gz']
+        with open(os.path.join('imported', changed_filepath)) as model_file:
+            assert model_file.read() == 'changed\n'
+
+
+@attr('unit')
+def test_packaging_manifest():
+    with enter_temp_dir():
+        assert ensembler.packaging.read_packaging_manifest('.') == {}
+        ensembler.packaging.append_packaging_manifest_record('.', {'run': 0, 'template': 'KC1D_HUMAN_D0_4HNF_A', 'status': 'complete', 'checksums': {'system.xml': '0123abcd'}})
+        ensembler.packaging.append_packaging_manifest_record('.', {'run': 1, 'template': 'KC1D_HUMAN_D0_4KB8_D', 'status': 'failed', 'error': 'IOError: File explicit-state.xml not found'})
+        ensembler.packaging.append_packaging_manifest_record('.', {'run': 1, 'template': 'KC1D_HUMAN_D0_4KB8_D', 'status': 'complete', 'checksums': {}})
+        with open(ensembler.packaging.packaging_manifest_filename) as manifest_file:
+            assert len(manifest_file.readlines()) == 3
+        records = ensembler.packaging.read_packaging_manifest('.')
+        assert records[0]['checksums'] == {'system.xml': '0123abcd'}
+        assert records[1]['status'] == 'complete'
+
+        # A truncated record is skipped
+        with open(ensembler.packaging.packaging_manifest_filename, 'a') as manifest_file:
+            manifest_file.write('- {run: 2, status: compl')
+        records = ensembler.packaging.read_packaging_manifest('.')
+        assert sorted(records.keys()) == [0, 1]
+
+        # Records appended by other ranks are read before they are merged into the project manifest
+        ensembler.packaging.append_packaging_manifest_record('.', {'run': 3, 'template': 'KC1D_HUMAN_D0_4HNF_A', 'status': 'complete', 'checksums': {}}, rank=2)
+        ensembler.packaging.append_packaging_manifest_record('.', {'run': 2, 'template': 'KC1D_HUMAN_D0_4KB8_D', 'status': 'failed', 'error': 'IOError'}, rank=1)
+        ensembler.packaging.append_packaging_manifest_record('.', {'run': 2, 'template': 'KC1D_HUMAN_D0_4KB8_D', 'status': 'complete', 'checksums': {}}, rank=2)
+        assert os.path.exists('packaging-manifest.rank2.yaml')
+        records = ensembler.packaging.read_packaging_manifest('.')
+        assert sorted(records.keys()) == [0, 1, 2, 3]
+        assert records[2]['status'] == 'complete'
+        ensembler.packaging.merge_packaging_manifests('.')
+        assert sorted(os.listdir('.')) == [ensembler.packaging.packaging_manifest_filename]
+        assert ensembler.packaging.read_packaging_manifest('.') == records
@@ -0,0 +1,247 @@
+import os
+import gzip
+import shutil
+import yaml
+import numpy as np
+import mdtraj
+import simtk.unit as unit
+import simtk.openmm as openmm
+import simtk.openmm.app as app
+import ensembler
+import ensembler.refinement
+import ensembler.reporters
+from ensembler.utils import enter_temp_dir
+from mock import Mock
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_check_energy_plateau():
+    random_state = np.random.RandomState(0)
+    fluctuations = list(random_state.normal(scale=5.0, size=40))
+    decreasing_energies = [-1000.0 - 20.0 * i + fluctuations[i] for i in range(40)]
+    plateaued_energies = decreasing_energies[:20] + [-1400.0 + fluctuation for fluctuation in fluctuations[20:]]
+
+    assert not ensembler.refinement.check_energy_plateau(decreasing_energies, window=20)
+    assert ensembler.refinement.check_energy_plateau(plateaued_energies, window=20)
+    assert not ensembler.refinement.check_energy_plateau(plateaued_energies[:10], window=20)
+
+
+@attr('unit')
+def test_repartition_hydrogen_mass():
+    pdb_filepath = os.path.join(
+        'tests', 'integration_test_resources', 'models', 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'explicit-refined.pdb.gz'
+    )
+    with gzip.open(pdb_filepath) as pdb_file:
+        pdb = app.PDBFile(pdb_file)
+    forcefield = app.ForceField('amber99sbildn.xml', 'tip3p.xml')
+    system = forcefield.createSystem(pdb.topology, nonbondedMethod=app.CutoffPeriodic, constraints=app.HBonds, rigidWater=True)
+    masses = [system.getParticleMass(index) / unit.amu for index in range(system.getNumParticles())]
+
+    nrepartitioned = ensembler.refinement.repartition_hydrogen_mass(system, hydrogen_mass=4.0*unit.amu)
+    repartitioned_masses = [system.getParticleMass(index) / unit.amu for index in range(system.getNumParticles())]
+    assert nrepartitioned > 0
+    assert abs(sum(masses) - sum(repartitioned_masses)) < 1e-6
+    for atom in pdb.topology.atoms():
+        if atom.residue.name == 'HOH':
+            assert repartitioned_masses[atom.index] == masses[atom.index]
+        elif atom.element == app.element.hydrogen:
+            assert abs(repartitioned_masses[atom.index] - 4.0) < 1e-6
+
+    # Repeated calls have no further effect
+    assert ensembler.refinement.repartition_hydrogen_mass(system) == 0
+
+
+@attr('unit')
+def test_estimate_nwaters():
+    model_dir = os.path.join('tests', 'integration_test_resources', 'models', 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4HNF_A')
+    with gzip.open(os.path.join(model_dir, 'implicit-refined.pdb.gz')) as pdb_file:
+        pdb = app.PDBFile(pdb_file)
+    with open(os.path.join(model_dir, 'nwaters.txt')) as nwaters_file:
+        nwaters_solvated = int(nwaters_file.readline())
+
+    nwaters_estimated = ensembler.refinement.estimate_nwaters(pdb.topology, pdb.positions, 10.0 * unit.angstroms)
+    assert abs(nwaters_estimated - nwaters_solvated) < 0.05 * nwaters_solvated
+    assert ensembler.refinement.estimate_nwaters(pdb.topology, pdb.positions, 10.0 * unit.angstroms, scale_factor=0.5) < nwaters_estimated
+
+
+
+@attr('unit')
+def test_write_and_read_solvated_model():
+    pdb_filepath = os.path.join(
+        'tests', 'integration_test_resources', 'models', 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'explicit-refined.pdb.gz'
+    )
+    with gzip.open(pdb_filepath) as pdb_file:
+        pdb = app.PDBFile(pdb_file)
+    solute = app.Modeller(pdb.topology, pdb.positions)
+    solute.delete([residue for residue in pdb.topology.residues() if residue.name in ['HOH', 'NA', 'CL']])
+    nsolute_residues = len([residue for residue in solute.topology.residues()])
+    nwaters = len(ensembler.refinement.get_water_residues(pdb.topology, nsolute_residues))
+
+    with enter_temp_dir():
+        ensembler.refinement.write_solvated_model_npz(
+            'solvated-model.npz', pdb.topology, pdb.positions, nsolute_residues, 'solute-sha1', water_model='tip3p'
+        )
+        modeller, solute_sha1, water_model = ensembler.refinement.read_solvated_model_npz(
+            'solvated-model.npz', solute.topology, solute.positions
+        )
+
+    assert solute_sha1 == 'solute-sha1'
+    assert water_model == 'tip3p'
+    assert modeller.topology.getNumAtoms() == pdb.topology.getNumAtoms()
+    assert modeller.topology.getNumBonds() == pdb.topology.getNumBonds()
+    positions = np.array(modeller.positions.value_in_unit(unit.nanometers))
+    assert abs(positions - np.array(pdb.positions.value_in_unit(unit.nanometers))).max() < 1e-5
+
+    assert ensembler.refinement.delete_farthest_waters(modeller, nsolute_residues, nwaters - 100) == nwaters - 100
+    assert len(ensembler.refinement.get_water_residues(modeller.topology, nsolute_residues)) == nwaters - 100
+
+
+@attr('unit')
+def test_get_reference_protonation_variants():
+    models_target_dir = os.path.abspath(os.path.join('tests', 'integration_test_resources', 'models', 'EGFR_HUMAN_D0'))
+    templateids = ['KC1D_HUMAN_D0_4HNF_A', 'KC1D_HUMAN_D0_4KB8_D']
+    ff_files = ['amber99sbildn.xml', 'amber99_obc.xml']
+    forcefield = app.ForceField(*ff_files)
+
+    with enter_temp_dir():
+        shutil.copy(os.path.join(models_target_dir, 'sequence-identities.txt'), '.')
+        for templateid in templateids:
+            os.mkdir(templateid)
+            shutil.copy(os.path.join(models_target_dir, templateid, 'model.pdb.gz'), templateid)
+
+        def read_variants_cache():
+            with open(ensembler.core.protonation_variants_filename) as variants_file:
+                return yaml.load(variants_file, Loader=ensembler.core.YamlLoader)
+
+        variants = ensembler.refinement.get_reference_protonation_variants('.', forcefield, ff_files)
+        assert variants is not None
+        assert read_variants_cache()['reference_template'] == templateids[0]
+        assert ensembler.refinement.get_reference_protonation_variants('.', forcefield, ff_files) == variants
+
+        # The highest identity model is no longer available
+        os.remove(os.path.join(templateids[0], 'model.pdb.gz'))
+        ensembler.refinement.get_reference_protonation_variants('.', forcefield, ff_files)
+        variants_cache = read_variants_cache()
+        assert variants_cache['reference_template'] == templateids[1]
+        assert variants_cache['reference_sha1'] == ensembler.refinement.file_sha1(os.path.join(templateids[1], 'model.pdb.gz'))
+
+        # The reference model is rebuilt
+        with gzip.open(os.path.join(templateids[1], 'model.pdb.gz'), 'rb') as model_file:
+            model_contents = model_file.read()
+        with gzip.open(os.path.join(templateids[1], 'model.pdb.gz'), 'wb') as model_file:
+            model_file.write(b'REMARK   1 REBUILT\n' + model_contents)
+        ensembler.refinement.get_reference_protonation_variants('.', forcefield, ff_files)
+        assert read_variants_cache()['reference_sha1'] == ensembler.refinement.file_sha1(os.path.join(templateids[1], 'model.pdb.gz'))
+
+
+@attr('unit')
+def test_topology_fingerprint():
+    pdb_filepath = os.path.join(
+        'tests', 'integration_test_resources', 'models', 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4HNF_A', 'model.pdb.gz'
+    )
+    forcefield = app.ForceField('amber99sbildn.xml', 'amber99_obc.xml')
+
+    def protonated_topology(variants=None):
+        with gzip.open(pdb_filepath) as pdb_file:
+            pdb = app.PDBFile(pdb_file)
+        modeller = app.Modeller(pdb.topology, pdb.positions)
+        variants = modeller.addHydrogens(forcefield, variants=variants)
+        return modeller.topology, variants
+
+    # Models with identical topologies share a System
+    topology, variants = protonated_topology()
+    identical_topology, identical_variants = protonated_topology(variants)
+    assert ensembler.refinement.topology_fingerprint(identical_topology) == ensembler.refinement.topology_fingerprint(topology)
+    system_cache = {}
+    create_system = Mock(side_effect=lambda topology: openmm.System())
+    system = ensembler.refinement.get_cached_system(system_cache, topology, create_system)
+    assert ensembler.refinement.get_cached_system(system_cache, identical_topology, create_system) is system
+    assert create_system.call_count == 1
+
+    # A different histidine protonation variant
+    his_index = [index for index, variant in enumerate(variants) if variant in ('HID', 'HIE')][0]
+    changed_variants = list(variants)
+    changed_variants[his_index] = 'HIE' if variants[his_index] == 'HID' else 'HID'
+    changed_topology, changed_variants = protonated_topology(changed_variants)
+    assert ensembler.refinement.topology_fingerprint(changed_topology) != ensembler.refinement.topology_fingerprint(topology)
+    assert ensembler.refinement.get_cached_system(system_cache, changed_topology, create_system) is not system
+    assert create_system.call_count == 2
+
+    # An additional bond
+    bonded_topology, bonded_variants = protonated_topology(variants)
+    atoms = list(bonded_topology.atoms())
+    bonded_topology.addBond(atoms[0], atoms[-1])
+    assert ensembler.refinement.topology_fingerprint(bonded_topology) != ensembler.refinement.topology_fingerprint(topology)
+
+
+@attr('unit')
+def test_interrupt_and_resume_simulation():
+    # A small Lennard-Jones system, run with the checkpoint, energy file and trajectory handling
+    # of the refinement stages, is interrupted between checkpoints and then resumed
+    natoms = 8
+    topology = app.Topology()
+    chain = topology.addChain()
+    system = openmm.System()
+    nonbonded_force = openmm.NonbondedForce()
+    for atom_index in range(natoms):
+        topology.addAtom('AR', app.element.argon, topology.addResidue('AR', chain))
+        system.addParticle(39.9 * unit.amu)
+        nonbonded_force.addParticle(0.0, 0.34 * unit.nanometers, 1.0 * unit.kilojoules_per_mole)
+    system.addForce(nonbonded_force)
+    positions = 0.5 * np.array([[i, j, k] for i in range(2) for j in range(2) for k in range(2)]) * unit.nanometers
+
+    nsteps_per_iteration = 10
+    timestep = 2.0 * unit.femtoseconds
+    checkpoint_interval = 3
+    trajectory_stride = 2
+    niterations = 10
+
+    def simulate(stop_iteration):
+        integrator = openmm.LangevinIntegrator(300.0 * unit.kelvin, 1.0 / unit.picoseconds, timestep)
+        context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+        context.setPositions(positions)
+        start_iteration = ensembler.refinement.load_checkpoint(context, 'checkpoint.chk', nsteps_per_iteration * timestep)
+        trajectory_reporters = [
+            ensembler.reporters.open_trajectory_reporter(
+                '.', trajectory_format.split('.')[0], topology, context, trajectory_format=trajectory_format,
+                stride=trajectory_stride, start_iteration=start_iteration
+            )
+            for trajectory_format in ensembler.reporters.trajectory_formats
+        ]
+        energy_outfile = ensembler.refinement.open_energy_file('energies.txt', '# iteration | potential_energy (kJ/mol)\n', start_iteration)
+        for iteration in range(start_iteration, stop_iteration):
+            integrator.step(nsteps_per_iteration)
+            for trajectory_reporter in trajectory_reporters:
+                trajectory_reporter.report(iteration, context)
+            potential_energy = context.getState(getEnergy=True).getPotentialEnergy()
+            energy_outfile.write('  %8d %8.3f\n' % (iteration, potential_energy / unit.kilojoules_per_mole))
+            energy_outfile.flush()
+            if (iteration+1) % checkpoint_interval == 0:
+                ensembler.refinement.write_checkpoint(context, 'checkpoint.chk')
+        for trajectory_reporter in trajectory_reporters:
+            trajectory_reporter.close()
+        energy_outfile.close()
+        return start_iteration
+
+    def load_trajectory(trajectory_format):
+        prefix = trajectory_format.split('.')[0]
+        if trajectory_format == 'pdb.gz':
+            return mdtraj.load('%s-trajectory.pdb.gz' % prefix)
+        return mdtraj.load('%s-trajectory.%s' % (prefix, trajectory_format), top='%s-trajectory-topol.pdb' % prefix)
+
+    with enter_temp_dir():
+        # Interrupted after iteration 7, with the last checkpoint written after iteration 5
+        assert simulate(8) == 0
+        interrupted_trajectories = dict([(trajectory_format, load_trajectory(trajectory_format)) for trajectory_format in ensembler.reporters.trajectory_formats])
+        assert simulate(niterations) == 6
+
+        with open('energies.txt') as energy_file:
+            iterations = [int(line.split()[0]) for line in energy_file if not line.startswith('#')]
+        assert iterations == range(niterations)
+        for trajectory_format in ensembler.reporters.trajectory_formats:
+            traj = load_trajectory(trajectory_format)
+            assert traj.n_frames == niterations // trajectory_stride
+            # The frames written before the checkpoint are kept, and the resumed simulation
+            # repeats the discarded one
+            assert np.allclose(traj.xyz[:4], interrupted_trajectories[trajectory_format].xyz, atol=1e-3)
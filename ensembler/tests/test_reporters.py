@@ -0,0 +1,100 @@
+import os
+import gzip
+import mdtraj
+import simtk.unit as unit
+import simtk.openmm as openmm
+import simtk.openmm.app as app
+import ensembler
+import ensembler.reporters
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+def setup_reference_context():
+    """Load an explicit-solvent refined model and create a Reference platform Context for it.
+
+    A System without forces is sufficient to test trajectory output.
+
+    Returns
+    -------
+    pdb_filepath : str
+    pdb : simtk.openmm.app.PDBFile
+    context : simtk.openmm.Context
+    """
+    pdb_filepath = os.path.abspath(os.path.join(
+        'tests', 'integration_test_resources', 'models', 'EGFR_HUMAN_D0', 'KC1D_HUMAN_D0_4KB8_D', 'explicit-refined.pdb.gz'
+    ))
+    with gzip.open(pdb_filepath) as pdb_file:
+        pdb = app.PDBFile(pdb_file)
+
+    system = openmm.System()
+    for atom in pdb.topology.atoms():
+        system.addParticle(1.0)
+    system.setDefaultPeriodicBoxVectors(*pdb.topology.getPeriodicBoxVectors())
+    integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(pdb.positions)
+    return pdb_filepath, pdb, context
+
+
+@attr('unit')
+def test_trajectory_reporters():
+    pdb_filepath, pdb, context = setup_reference_context()
+    ref_traj = mdtraj.load(pdb_filepath)
+    protein_atom_indices = ref_traj.topology.select('protein')
+
+    with enter_temp_dir():
+        for trajectory_format in ['dcd', 'xtc', 'pdb.gz']:
+            reporter = ensembler.reporters.open_trajectory_reporter(
+                '.', 'explicit', pdb.topology, context, trajectory_format=trajectory_format, stride=2, protein_only=True
+            )
+            for iteration in range(5):
+                reporter.report(iteration, context)
+            reporter.close()
+
+            trajectory_filename = 'explicit-trajectory.%s' % trajectory_format
+            if trajectory_format == 'pdb.gz':
+                traj = mdtraj.load(trajectory_filename)
+            else:
+                traj = mdtraj.load(trajectory_filename, top='explicit-trajectory-topol.pdb')
+            assert traj.n_frames == 2
+            assert traj.n_atoms == len(protein_atom_indices)
+            assert abs(traj.xyz[1] - ref_traj.xyz[0][protein_atom_indices]).max() < 0.01
+
+
+@attr('unit')
+def test_pdb_trajectory_reporter_append():
+    pdb_filepath, pdb, context = setup_reference_context()
+
+    with enter_temp_dir():
+        for start_iteration in [0, 2]:
+            reporter = ensembler.reporters.open_trajectory_reporter(
+                '.', 'explicit', pdb.topology, context, trajectory_format='pdb.gz', protein_only=True, start_iteration=start_iteration
+            )
+            for iteration in range(start_iteration, start_iteration + 2):
+                reporter.report(iteration, context)
+            reporter.close()
+
+        with gzip.open('explicit-trajectory.pdb.gz') as trajectory_file:
+            records = [line.split()[0] for line in trajectory_file if len(line.split()) > 0]
+        assert records.count('MODEL') == 4
+        assert records.count('ENDMDL') == 4
+        assert records.count('END') == 1
+        assert records[-1] == 'END'
+        assert mdtraj.load('explicit-trajectory.pdb.gz').n_frames == 4
+
+    assert ensembler.reporters.pdb_trajectory_models_end(
+        ['REMARK\n', 'MODEL 1\n', 'ATOM\n', 'ENDMDL\n', 'MODEL 2\n', 'ATOM\n']
+    ) == 4
+    assert ensembler.reporters.pdb_trajectory_models_end(['REMARK\n', 'CRYST1\n', 'END\n']) == 2
+
+
+@attr('unit')
+def test_trajectory_reporter_is_abstract():
+    topology = app.Topology()
+    try:
+        ensembler.reporters.TrajectoryReporter('trajectory', topology)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('TrajectoryReporter should not be instantiable')
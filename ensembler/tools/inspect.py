@@ -1,12 +1,12 @@
 import datetime
 import ensembler
+import ensembler.coordinate_store
 import os
 import re
 import numpy as np
 import pandas as pd
 import yaml
 import mdtraj
-import gzip
 from ensembler.core import logger, check_ensembler_modeling_stage_complete
 import warnings
 
@@ -220,18 +220,8 @@ class ModelSimilarities(object):
         self.df['unique_by_clustering'] = unique_models
 
     def _mk_traj(self):
-        with ensembler.utils.mk_temp_dir() as tmpdir:
-            model_filepaths = []
-            for m, model_filepath_gz in enumerate(self.model_filepaths):
-                logger.debug('Unzipping model {0}/{1}'.format(m, len(self.model_filepaths)))
-                with gzip.open(model_filepath_gz) as model_file:
-                    model_filepath = os.path.join(tmpdir, '{0}.pdb'.format(m))
-                    model_filepaths.append(model_filepath)
-                    model_text = model_file.read()
-                with open(model_filepath, 'w') as model_file:
-                    model_file.write(model_text)
-
-            self.traj = mdtraj.load(model_filepaths)
+        templateids_with_models = list(self.df.templateid[self.df.has_model])
+        self.traj = ensembler.coordinate_store.load_models(self.models_target_dir, self.ensembler_stage, templateids_with_models)
 
     def _get_seqids(self):
         seqid_filepath = os.path.join(self.models_target_dir, 'sequence-identities.txt')
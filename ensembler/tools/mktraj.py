@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import mdtraj
 import ensembler
+import ensembler.coordinate_store
 from ensembler.core import logger, check_ensembler_modeling_stage_complete
 
 
@@ -78,9 +79,7 @@ def mktraj(targetid, ensembler_stage=None, traj_filepath=None, topol_filepath=No
     df.to_csv(models_data_filepath, columns=['templateid', 'seqid'])
 
     # construct traj
-    traj = mdtraj.load_pdb(df.model_filepath[0])
-    for model_filepath in df.model_filepath[1:]:
-        traj += mdtraj.load_pdb(model_filepath)
+    traj = ensembler.coordinate_store.load_models(models_target_dir, ensembler_stage, list(df.templateid))
 
     # superpose structured C-alphas
     dssp = mdtraj.compute_dssp(traj[0])[0]